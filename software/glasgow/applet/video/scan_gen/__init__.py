@@ -9,7 +9,6 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 import asyncio
 import numpy as np
-import threading
 
 from amaranth import *
 from amaranth.build import *
@@ -26,8 +25,12 @@ from amaranth.lib.fifo import SyncFIFO
 from ..scan_gen.gateware.main_iobus import IOBus
 from ..scan_gen.gateware.structs import *
 from ..scan_gen.gateware.test_streams import *
-from ..scan_gen.interface.scan_server import ServerHost
+from ..scan_gen.interface.scan_server import ServerHost, POLICIES
+from ..scan_gen.register_bank import RegisterBank
+from ..scan_gen.stream_pipeline import StreamPipeline, RawCapture
+from ..scan_gen.frame_decoder import FrameDecoder
 from ..scan_gen.interface.scan_stream import ScanStream
+from ..scan_gen.interface.frame_ring import FrameRing, DEFAULT_NAME as FRAME_RING_NAME
 from ..scan_gen.interface.microscope import MicroscopeInterface
 from ..scan_gen.pattern_generators.hilbert import hilbert
 from ..scan_gen.pattern_generators.rectangles import vector_rectangle, vector_gradient_rectangle
@@ -49,7 +52,9 @@ class IOBusSubtarget(Elaboratable):
                 y_upper_limit_b1, y_upper_limit_b2,
                 y_lower_limit_b1, y_lower_limit_b2,
                 eight_bit_output, do_frame_sync, do_line_sync,
-                const_dwell_time, configuration, unpause, step_size, test_mode, board_version):
+                const_dwell_time, configuration, unpause, step_size, test_mode, board_version,
+                boxcar_average = None, compress_output = None, vector_commands = None,
+                serpentine = None):
         self.board_version = board_version
         if self.board_version == 0:
             self.data = data
@@ -69,7 +74,11 @@ class IOBusSubtarget(Elaboratable):
                             eight_bit_output, do_frame_sync, do_line_sync,
                             const_dwell_time, configuration, unpause, step_size,
                             test_mode = test_mode,
-                            is_simulation = False)
+                            is_simulation = False,
+                            boxcar_average = boxcar_average,
+                            compress_output = compress_output,
+                            vector_commands = vector_commands,
+                            serpentine = serpentine)
 
         self.pins = Signal(14)
 
@@ -176,17 +185,7 @@ class IOBusSubtarget(Elaboratable):
         return m
 
 class ScanGenInterface(MicroscopeInterface):
-    def __init__(self, iface, logger, device, __addr_scan_mode,
-                __addr_x_full_resolution_b1, __addr_x_full_resolution_b2,
-                __addr_y_full_resolution_b1,__addr_y_full_resolution_b2,
-                __addr_x_upper_limit_b1, __addr_x_upper_limit_b2,
-                __addr_x_lower_limit_b1, __addr_x_lower_limit_b2,
-                __addr_y_upper_limit_b1, __addr_y_upper_limit_b2,
-                __addr_y_lower_limit_b1, __addr_y_lower_limit_b2,
-                __addr_8_bit_output, __addr_do_frame_sync, __addr_do_line_sync,
-                __addr_configuration, __addr_unpause, __addr_step_size,
-                __addr_const_dwell_time,
-                is_simulation = False):
+    def __init__(self, iface, logger, device, registers, is_simulation = False):
         self.iface = iface
         self._logger = logger
         self.logging = True
@@ -194,36 +193,14 @@ class ScanGenInterface(MicroscopeInterface):
         self._device = device
 
         self.logging = True
-        self.text_file = open("packets.txt","w")
+        self._text_file = None
         self.is_simulation = is_simulation
         self.eight_bit_output = False
 
         ### ======= Registers =========
-        self.__addr_scan_mode = __addr_scan_mode
+        ## name -> (address, width in bytes), see ScanGenApplet.build
+        self.registers = RegisterBank(device, registers, self._logger, self._level)
         self.scan_mode = 0
-        self.__addr_x_full_resolution_b1 = __addr_x_full_resolution_b1
-        self.__addr_x_full_resolution_b2 = __addr_x_full_resolution_b2
-        self.__addr_y_full_resolution_b1 = __addr_y_full_resolution_b1
-        self.__addr_y_full_resolution_b2 = __addr_y_full_resolution_b2
-
-        self.__addr_x_upper_limit_b1 = __addr_x_upper_limit_b1
-        self.__addr_x_upper_limit_b2 = __addr_x_upper_limit_b2
-        self.__addr_x_lower_limit_b1 = __addr_x_lower_limit_b1
-        self.__addr_x_lower_limit_b2 = __addr_x_lower_limit_b2
-
-        self.__addr_y_upper_limit_b1 = __addr_y_upper_limit_b1
-        self.__addr_y_upper_limit_b2 = __addr_y_upper_limit_b2
-        self.__addr_y_lower_limit_b1 = __addr_y_lower_limit_b1
-        self.__addr_y_lower_limit_b2 = __addr_y_lower_limit_b2
-
-        self.__addr_8_bit_output = __addr_8_bit_output
-        self.__addr_do_frame_sync = __addr_do_frame_sync
-        self.__addr_do_line_sync = __addr_do_line_sync
-
-        self.__addr_configuration = __addr_configuration
-        self.__addr_unpause = __addr_unpause
-        self.__addr_step_size = __addr_step_size
-        self.__addr_const_dwell_time = __addr_const_dwell_time
         ## ======= end registers =======
 
         self.x_width = 0
@@ -259,122 +236,125 @@ class ScanGenInterface(MicroscopeInterface):
         print("writing", b1, b2)
         await self.iface.write([b2,b1])
 
-    async def set_2byte_register(self,val,addr_b1, addr_b2):
-        b1, b2 = get_two_bytes(val)
-        b1 = int(bits(b1))
-        b2 = int(bits(b2))
-        #print("writing", b1, b2)
-        await asyncio.gather(self._device.write_register(addr_b1, b1),
-        self._device.write_register(addr_b2, b2))
-        print("set 2 REGISTERS", val, "1:", addr_b1, "2:", addr_b1)
-
     async def set_8bit_output(self, val=1):
-        await self._device.write_register(self.__addr_8_bit_output, val)
+        await self.registers.set("eight_bit_output", val)
         if val == 1:
             self.eight_bit_output = True
         else:
             self.eight_bit_output = False
 
     async def set_frame_sync(self, val=1):
-        await self._device.write_register(self.__addr_do_frame_sync, val)
+        await self.registers.set("do_frame_sync", val)
 
     async def set_line_sync(self,val):
-        await self._device.write_register(self.__addr_do_line_sync, val)
+        await self.registers.set("do_line_sync", val)
 
     async def set_ROI(self, x_lower, x_upper, y_lower, y_upper):
-        await self.set_x_lower_limit(x_lower)
-        await self.set_x_upper_limit(x_upper)
-        await self.set_y_lower_limit(y_lower)
-        await self.set_y_upper_limit(y_upper)
+        async with self.registers.batch():
+            await self.set_x_lower_limit(x_lower)
+            await self.set_x_upper_limit(x_upper)
+            await self.set_y_lower_limit(y_lower)
+            await self.set_y_upper_limit(y_upper)
 
     async def set_x_resolution(self,val):
         assert(val > 0)
         self.x_width = val
-        ## subtract 1 to account for 0-indexing
-        await self.set_2byte_register(val-1,self.__addr_x_full_resolution_b1,self.__addr_x_full_resolution_b2)
-        await self.set_step_size()
-        print("REG:set x resolution:", val)
+        async with self.registers.batch():
+            ## subtract 1 to account for 0-indexing
+            await self.registers.set("x_full_resolution", val-1)
+            await self.set_step_size()
 
     async def set_y_resolution(self,val):
         assert(val > 0)
         self.y_height = val
-        ## subtract 1 to account for 0-indexing
-        await self.set_2byte_register(val-1,self.__addr_y_full_resolution_b1,self.__addr_y_full_resolution_b2)
-        await self.set_step_size()
-        print("REG:set y resolution:", val)
+        async with self.registers.batch():
+            ## subtract 1 to account for 0-indexing
+            await self.registers.set("y_full_resolution", val-1)
+            await self.set_step_size()
 
     async def set_x_upper_limit(self, val):
         assert(val >= 0)
         if val == 0:
             val = self.x_width
         self.x_upper_limit = val
-        await self.set_2byte_register(val-1,self.__addr_x_upper_limit_b1,self.__addr_x_upper_limit_b2)
-        print("REG: Set x upper", val)
+        await self.registers.set("x_upper_limit", val-1)
 
     async def set_x_lower_limit(self, val):
         assert(val >= 0)
         self.x_lower_limit = val
-        await self.set_2byte_register(val,self.__addr_x_lower_limit_b1,self.__addr_x_lower_limit_b2)
-        print("REG: Set x lower", val)
+        await self.registers.set("x_lower_limit", val)
 
     async def set_y_upper_limit(self, val):
         assert(val >= 0)
         if val == 0:
             val = self.y_height
         self.y_upper_limit = val
-        await self.set_2byte_register(val-1,self.__addr_y_upper_limit_b1,self.__addr_y_upper_limit_b2)
-        print("REG: Set y upper", val)
+        await self.registers.set("y_upper_limit", val-1)
 
     async def set_y_lower_limit(self, val):
         assert(val >= 0)
         self.y_lower_limit = val
-        await self.set_2byte_register(val,self.__addr_y_lower_limit_b1,self.__addr_y_lower_limit_b2)
-        print("REG: Set y lower", val)
+        await self.registers.set("y_lower_limit", val)
 
     async def set_frame_resolution(self,xval,yval):
-        await self.set_x_resolution(xval)
-        await self.set_y_resolution(yval)
-        print("REG: set frame resolution x:", xval, "y:", yval)
+        async with self.registers.batch():
+            await self.set_x_resolution(xval)
+            await self.set_y_resolution(yval)
 
     async def set_scan_mode(self, val):
         assert(3 >= val > 0)
-        await self._device.write_register(self.__addr_scan_mode, val)
+        await self.registers.set("scan_mode", val)
         self.scan_mode = val
         if self.logging:
             self._logger.info("set scan mode " + str(val))
-        print("REG: set scan mode", val)
 
     async def set_config_flag(self, val):
         assert(1 >= val >= 0)
-        await self._device.write_register(self.__addr_configuration, val)
-        print("REG: set config flag", val)
+        ## a strobe: always written, after everything staged before it
+        await self.registers.write("configuration", val)
 
     async def set_dwell_time(self, val):
         assert(val > 0)
         ## subtract 1 to account for 0-indexing
-        await self._device.write_register(self.__addr_const_dwell_time, val-1)
-        print("REG:set dwell time", val)
+        await self.registers.set("const_dwell_time", val-1)
+
+    async def set_boxcar_average(self, val):
+        ## 1: average all the samples of a dwell, 0: the running average of the last few
+        assert(1 >= val >= 0)
+        await self.registers.set("boxcar_average", val)
+
+    async def set_compress_output(self, val):
+        ## 1: compress 8-bit output, from the next config packet; ScanStream decodes it
+        assert(1 >= val >= 0)
+        await self.registers.set("compress_output", val)
+
+    async def set_vector_commands(self, val):
+        ## 1: vector mode reads commands (see pattern_generators.vector_commands)
+        ## rather than points, from the next config packet, which starts the pattern
+        assert(1 >= val >= 0)
+        await self.registers.set("vector_commands", val)
+
+    async def set_serpentine(self, val):
+        ## 1: scan every other line right to left, from the next config packet;
+        ## ScanStream puts the lines back
+        assert(1 >= val >= 0)
+        await self.registers.set("serpentine", val)
 
     async def pause(self):
-        await self._device.write_register(self.__addr_unpause, 0)
-        print("REG:paused")
+        await self.registers.write("unpause", 0)
 
     async def unpause(self):
-        await self._device.write_register(self.__addr_unpause, 1)
-        print("REG:unpaused")
+        await self.registers.write("unpause", 1)
 
     async def set_raster_mode(self):
-        await self._device.write_register(self.__addr_scan_mode, 1)
-        print("REG:set raster mode")
+        await self.set_scan_mode(1)
 
     async def set_vector_mode(self):
-        await self._device.write_register(self.__addr_scan_mode, 3)
-        print("REG:set vector mode")
+        await self.set_scan_mode(3)
 
     async def set_step_size(self):
         step_size = (16384//(max(self.x_width, self.y_height)))
-        await self._device.write_register(self.__addr_step_size, step_size)
-        print("REG:set step size", step_size)
+        await self.registers.set("step_size", step_size)
 
     async def benchmark(self):
         await self.set_frame_resolution(2048,2048)
@@ -391,7 +371,7 @@ class SG_EndpointInterface(ScanGenInterface):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.task_queue = TaskQueue()
-        self.server_host = ServerHost(self.process_cmd, self.task_queue)
+        self.server_host = ServerHost(self.process_cmds, self.task_queue)
         self.streaming = None
         self.logging = True
         print(f'logging? {self.logging}')
@@ -399,6 +379,22 @@ class SG_EndpointInterface(ScanGenInterface):
         self.write_buffer = ChunkedFIFO()
         self.in_tasks = TaskQueue()
 
+        ## packets read from USB are queued separately for each sink, so a slow
+        ## socket client or disk does not hold up reading
+        self.pipeline = None
+        self.pipeline_depth = 64
+        ## optional raw binary copy of everything read from USB
+        self.capture_path = None
+        ## set while the scan mode takes patterns from the data socket
+        self.patterning = asyncio.Event()
+
+
+    @property
+    def text_file(self):
+        ## packet dump of the test_* modes, only created when one of them runs
+        if self._text_file is None:
+            self._text_file = open("packets.txt", "w")
+        return self._text_file
 
     def start_servers(self, close_future):
         self.close_future = close_future
@@ -434,54 +430,73 @@ class SG_EndpointInterface(ScanGenInterface):
     #     future_data.set_result(n)
 
     async def recv_packet(self, n):
-        print(f'standing by to recieve pattern packet {n}...')
-        await self.data_server_future
-        print(f'reading from data server {n}')
+        ## a data client may disconnect and reconnect between patterns
+        reader = await self.server_host.wait_data_reader()
         if self.logging:
-            self._logger.info(f'reading from data server {n}')
-        print(self.server_host.data_reader)
-        print("data reader at eof?", self.server_host.data_reader.at_eof())
-        print(len(self.server_host.data_reader._buffer))
+            self._logger.debug(f'reading pattern packet {n} from data server')
         try:
-            data = await self.server_host.data_reader.readexactly(16384*3)
-            #data = await self.server_host.data_reader.read()
-            print(f'recieved {len(data)} points, {n}')
-            if self.logging:
-                self._logger.info(f'recieved points from server {n}')
-            await self.iface.write(list(data))
-            print(f'wrote data to iface {n}')
-            if self.logging:
-                self._logger.info(f'wrote data to iface {n}')
-            #await self.iface.flush()
-        except Exception as err:
-            print(f'error: {err}')
+            data = await reader.readexactly(16384*3)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self._logger.info(f'data client disconnected during pattern packet {n}, '
+                              f'waiting for the next one')
+            self.server_host.drop_data_connection(reader)
+            return False
+        await self.iface.write(data)
+        if self.logging:
+            self._logger.debug(f'wrote pattern packet {n} to iface')
+        return True
 
-    async def stream_data(self):
+    async def stream_patterns(self):
+        ## forward patterns from the data socket to USB OUT, independently of reading
         n = 0
         while True:
-            try:
-                if (self.scan_mode == 3) | (self.scan_mode == 2):
-                    await self.recv_packet(n)
-                if self.logging:
-                    self._logger.info(f'awaiting read {n}')
-                data = await self.iface.read(16384)
+            await self.patterning.wait()
+            if await self.recv_packet(n):
                 n += 1
-                if self.logging:
-                    self._logger.info(f'got read data {n}')
-                    self.text_file.write(str(data.tolist()))
-                self.server_host.data_writer.write(data)
-                await self.server_host.data_writer.drain()
-                if self.logging:
-                    self._logger.info(f'wrote data to socket {n}')
-            except Exception as exc:
-                print(f'error streaming: {exc}')
-                break
-
-    async def process_cmd(self, cmd):
-        c = str(cmd[0:2])
-        val = int(cmd[2:])
+
+    async def forward_to_socket(self, data):
+        ## every data connection gets the packet, through its own queue and policy
+        await self.data_server_future
+        await self.server_host.publish(data)
+
+    async def stream_data(self):
+        self.pipeline = StreamPipeline(functools.partial(self.iface.read, 16384),
+                                       depth = self.pipeline_depth, logger = self._logger)
+        ## lossless: packets are only dropped by each data connection's own policy, where
+        ## they are counted, so a client that asked for "block" gets every one
+        self.pipeline.add_sink("socket", self.forward_to_socket)
+        capture = None
+        if self.capture_path is not None:
+            capture = RawCapture(self.capture_path)
+            self.pipeline.add_sink("capture", capture.write)
+        patterns = asyncio.ensure_future(self.stream_patterns())
+        try:
+            await self.pipeline.run()
+        except Exception as exc:
+            print(f'error streaming: {exc}')
+        finally:
+            patterns.cancel()
+            if capture is not None:
+                capture.close()
+            self.server_host.log_stats(logging.INFO)
+
+    async def set_scan_mode(self, val):
+        await super().set_scan_mode(val)
+        if (val == 3) | (val == 2):
+            self.patterning.set()
+        else:
+            self.patterning.clear()
+
+    async def process_cmds(self, commands):
+        ## all commands of one request, applied in order before it is acknowledged;
+        ## register writes are coalesced across the whole request
+        async with self.registers.batch():
+            for c, val in commands:
+                await self.process_cmd(c, val)
+
+    async def process_cmd(self, c, val):
         if self.logging:
-            self._logger.info(f'cmd recieved: {cmd} - {val}')
+            self._logger.info(f'cmd recieved: {c} - {val}')
         if c == "ps":
             if val == 0:
                 await self.pause()
@@ -491,11 +506,6 @@ class SG_EndpointInterface(ScanGenInterface):
                 await self.unpause()
                 #self.task_queue.submit(self.unpause())
                 print("unpaused")
-                if (self.scan_mode == 3) | (self.scan_mode == 2):
-                    if self.logging:
-                        self._logger.info("created recv_packet task")
-                    #await self.recv_packet("*")
-                    self.task_queue.submit(self.recv_packet("*"))
         elif c == "sc":
             await self.set_scan_mode(val)
             #self.task_queue.submit(self.set_scan_mode(val))
@@ -521,12 +531,22 @@ class SG_EndpointInterface(ScanGenInterface):
         elif c == "ly":
             await self.set_y_lower_limit(val)
             #self.task_queue.submit(self.set_y_lower_limit(val))
+        elif c == "ba":
+            await self.set_boxcar_average(val)
+        elif c == "co":
+            await self.set_compress_output(val)
+        elif c == "vc":
+            await self.set_vector_commands(val)
+        elif c == "sr":
+            await self.set_serpentine(val)
         elif c == "8b":
             await self.set_8bit_output(val)
             #self.task_queue.submit(self.set_8bit_output(val))
         elif c == "cf":
             await self.set_config_flag(val)
             #self.task_queue.submit(self.set_config_flag(val))
+        else:
+            raise ValueError(f'unknown command {c!r}')
 
         #await self.task_queue.poll()
 
@@ -534,60 +554,40 @@ class SG_EndpointInterface(ScanGenInterface):
 class SG_LocalBufferInterface(ScanGenInterface):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.cwd = os.getcwd()
-        self.dimension, self.dimension_path = self.save_dimension(512)
-        self.buf, self.buf_path = self.create_buf_file()
-        self.last_pixel = 0
-    def save_dimension(self, dimension):
-        path = f'{self.cwd}/current_display_setting'
-        np.savetxt(path, [dimension])
-        return dimension, path
-    def create_buf_file(self):
-        path = f'{self.cwd}/current_frame'
-        buf = np.memmap(path, np.uint8, shape = (self.dimension*self.dimension), mode = "w+")
-        return buf, path
-    def stream_to_buf(self, raw_data):
-        # print("-----------")
-        data = raw_data.tolist()
-        d = np.array(data)
-        print(d)
-        # print(buf)
-        zero_index = np.nonzero(d < 1)[0]
-        # print("buffer length:", len(buf))
-        # print("last pixel:",current.last_pixel)
-        #print("d length:", len(d))
-        # print("d:",d)
-
-        if len(zero_index) > 0: #if a zero was found
-            # current.n += 1
-            # print("zero index:",zero_index)
-            zero_index = int(zero_index)
-
-            self.buf[:d[zero_index+1:].size] = d[zero_index+1:]
-            # print(buf[:d[zero_index+1:].size])
-            # print(d[:zero_index+1].size)
-            self.buf[self.dimension * self.dimension - zero_index:] = d[:zero_index]
-            # print(buf[dimension * dimension - zero_index:])
-            self.last_pixel = d[zero_index+1:].size
-
-        else:
-            if len(self.buf[self.last_pixel:self.last_pixel+len(d)]) < len(d):
-                pass
-            #     print("data too long to fit in end of frame, but no zero")
-            #     print(d[:dimension])
-            self.buf[self.last_pixel:self.last_pixel + d.size] = d
-            # print(buf[current.last_pixel:current.last_pixel + d.size])
-            self.last_pixel = self.last_pixel + d.size
+        self.dimension = 512
+        ## decoded frames are shared with local viewers through shared memory
+        self.frame_ring = FrameRing.create(FRAME_RING_NAME)
+        ## packets are decoded into the ring on a worker thread
+        self.decoder = FrameDecoder(self.frame_ring, self.frame_geometry, logger = self._logger)
+        self.decoder.start()
+    ## a frame must fit in a slot of the ring, or the decoder fails on it
+    async def set_x_resolution(self, val):
+        if val > self.frame_ring.max_width:
+            raise ValueError(f'{val} pixels wide does not fit in the '
+                             f'{self.frame_ring.max_width}-pixel wide frame ring')
+        await super().set_x_resolution(val)
+    async def set_y_resolution(self, val):
+        if val > self.frame_ring.max_height:
+            raise ValueError(f'{val} pixels high does not fit in the '
+                             f'{self.frame_ring.max_height}-pixel high frame ring')
+        await super().set_y_resolution(val)
+    def frame_geometry(self):
+        ## geometry and ROI go with the frame, so viewers follow resolution changes
+        width = self.x_width or self.dimension
+        height = self.y_height or self.dimension
+        roi = (getattr(self, "x_lower_limit", 0), getattr(self, "x_upper_limit", width),
+               getattr(self, "y_lower_limit", 0), getattr(self, "y_upper_limit", height))
+        return width, height, roi
     async def stream_video(self):
-        print("getting data")
         raw_data = await self.iface.read(16384)
-        print("got data")
-        threading.Thread(target=self.stream_to_buf(raw_data)).start()
+        if not self.decoder.submit(raw_data):
+            self._logger.debug(f'decode queue full, dropped packet ({self.decoder.stats})')
     def launch_gui(self):
         ## using sys.prefix instead of "python3" results in a PermissionError
         ## because pipx isn't supposed to be used that way
         ## would be nice to stay in the same environment though
-        subprocess.Popen(["python3", "software/glasgow/applet/video/scan_gen/output_formats/local_gui.py"],
+        subprocess.Popen(["python3", "software/glasgow/applet/video/scan_gen/gui/local_gui.py",
+                          self.frame_ring.name],
                         start_new_session = True)
 
 
@@ -640,32 +640,54 @@ class ScanGenApplet(GlasgowApplet):
         self.mux_interface = iface = target.multiplexer.claim_interface(self, args, throttle = "none")
 
         #==================Registers=================
-        scan_mode,             self.__addr_scan_mode  = target.registers.add_rw(2, reset=0)
-        x_full_resolution_b1,  self.__addr_x_full_resolution_b1  = target.registers.add_rw(8, reset=0)
-        x_full_resolution_b2,  self.__addr_x_full_resolution_b2  = target.registers.add_rw(8, reset=0)
-        y_full_resolution_b1,  self.__addr_y_full_resolution_b1  = target.registers.add_rw(8, reset=0)
-        y_full_resolution_b2,  self.__addr_y_full_resolution_b2  = target.registers.add_rw(8, reset=0)
-
-        x_upper_limit_b1,      self.__addr_x_upper_limit_b1  = target.registers.add_rw(8, reset=0)
-        x_upper_limit_b2,      self.__addr_x_upper_limit_b2  = target.registers.add_rw(8, reset=0)
-        x_lower_limit_b1,      self.__addr_x_lower_limit_b1  = target.registers.add_rw(8, reset=0)
-        x_lower_limit_b2,      self.__addr_x_lower_limit_b2  = target.registers.add_rw(8, reset=0)
-
-        y_upper_limit_b1,      self.__addr_y_upper_limit_b1  = target.registers.add_rw(8, reset=0)
-        y_upper_limit_b2,      self.__addr_y_upper_limit_b2  = target.registers.add_rw(8, reset=0)
-        y_lower_limit_b1,      self.__addr_y_lower_limit_b1  = target.registers.add_rw(8, reset=0)
-        y_lower_limit_b2,      self.__addr_y_lower_limit_b2  = target.registers.add_rw(8, reset=0)
-
-        eight_bit_output,      self.__addr_8_bit_output  = target.registers.add_rw(1, reset=0)
-        do_frame_sync,         self.__addr_do_frame_sync  = target.registers.add_rw(1, reset=0)
-        do_line_sync,          self.__addr_do_line_sync  = target.registers.add_rw(1, reset=0)
-
-        const_dwell_time,      self.__addr_const_dwell_time = target.registers.add_rw(8, reset=0)
-
-        configuration,         self.__addr_configuration = target.registers.add_rw(1, reset=0)
-
-        unpause,                 self.__addr_unpause = target.registers.add_rw(1, reset = 0)
-        step_size,              self.__addr_step_size = target.registers.add_rw(8, reset = 1)
+        ## 16-bit parameters are single registers, written in one control transfer;
+        ## IOBus still takes them as high (b1) and low (b2) bytes
+        scan_mode,             addr_scan_mode          = target.registers.add_rw(2, reset=0)
+        x_full_resolution,     addr_x_full_resolution  = target.registers.add_rw(16, reset=0)
+        y_full_resolution,     addr_y_full_resolution  = target.registers.add_rw(16, reset=0)
+
+        x_upper_limit,         addr_x_upper_limit      = target.registers.add_rw(16, reset=0)
+        x_lower_limit,         addr_x_lower_limit      = target.registers.add_rw(16, reset=0)
+
+        y_upper_limit,         addr_y_upper_limit      = target.registers.add_rw(16, reset=0)
+        y_lower_limit,         addr_y_lower_limit      = target.registers.add_rw(16, reset=0)
+
+        eight_bit_output,      addr_8_bit_output       = target.registers.add_rw(1, reset=0)
+        do_frame_sync,         addr_do_frame_sync      = target.registers.add_rw(1, reset=0)
+        do_line_sync,          addr_do_line_sync       = target.registers.add_rw(1, reset=0)
+
+        const_dwell_time,      addr_const_dwell_time   = target.registers.add_rw(8, reset=0)
+
+        configuration,         addr_configuration      = target.registers.add_rw(1, reset=0)
+
+        unpause,               addr_unpause            = target.registers.add_rw(1, reset = 0)
+        step_size,             addr_step_size          = target.registers.add_rw(8, reset = 1)
+        boxcar_average,        addr_boxcar_average     = target.registers.add_rw(1, reset = 0)
+        compress_output,       addr_compress_output    = target.registers.add_rw(1, reset = 0)
+        vector_commands,       addr_vector_commands    = target.registers.add_rw(1, reset = 0)
+        serpentine,            addr_serpentine         = target.registers.add_rw(1, reset = 0)
+
+        ## name -> (address, width in bytes), for ScanGenInterface.registers
+        self.__registers = {
+            "scan_mode":         (addr_scan_mode, 1),
+            "x_full_resolution": (addr_x_full_resolution, 2),
+            "y_full_resolution": (addr_y_full_resolution, 2),
+            "x_upper_limit":     (addr_x_upper_limit, 2),
+            "x_lower_limit":     (addr_x_lower_limit, 2),
+            "y_upper_limit":     (addr_y_upper_limit, 2),
+            "y_lower_limit":     (addr_y_lower_limit, 2),
+            "eight_bit_output":  (addr_8_bit_output, 1),
+            "do_frame_sync":     (addr_do_frame_sync, 1),
+            "do_line_sync":      (addr_do_line_sync, 1),
+            "const_dwell_time":  (addr_const_dwell_time, 1),
+            "configuration":     (addr_configuration, 1),
+            "unpause":           (addr_unpause, 1),
+            "step_size":         (addr_step_size, 1),
+            "boxcar_average":    (addr_boxcar_average, 1),
+            "compress_output":   (addr_compress_output, 1),
+            "vector_commands":   (addr_vector_commands, 1),
+            "serpentine":        (addr_serpentine, 1),
+        }
         #===============================================
 
         iface.add_subtarget(IOBusSubtarget(
@@ -674,20 +696,38 @@ class ScanGenApplet(GlasgowApplet):
             in_fifo = iface.get_in_fifo(auto_flush = False),
             out_fifo = iface.get_out_fifo(),
             scan_mode = scan_mode,
-            x_full_resolution_b1 = x_full_resolution_b1, x_full_resolution_b2 = x_full_resolution_b2,
-            y_full_resolution_b1 = y_full_resolution_b1, y_full_resolution_b2 = y_full_resolution_b2,
-            x_upper_limit_b1 = x_upper_limit_b1, x_upper_limit_b2 = x_upper_limit_b2,
-            x_lower_limit_b1 = x_lower_limit_b1, x_lower_limit_b2 = x_lower_limit_b2,
-            y_upper_limit_b1 = y_upper_limit_b1, y_upper_limit_b2 = y_upper_limit_b2,
-            y_lower_limit_b1 = y_lower_limit_b1, y_lower_limit_b2 = y_lower_limit_b2,
+            x_full_resolution_b1 = x_full_resolution[8:16], x_full_resolution_b2 = x_full_resolution[0:8],
+            y_full_resolution_b1 = y_full_resolution[8:16], y_full_resolution_b2 = y_full_resolution[0:8],
+            x_upper_limit_b1 = x_upper_limit[8:16], x_upper_limit_b2 = x_upper_limit[0:8],
+            x_lower_limit_b1 = x_lower_limit[8:16], x_lower_limit_b2 = x_lower_limit[0:8],
+            y_upper_limit_b1 = y_upper_limit[8:16], y_upper_limit_b2 = y_upper_limit[0:8],
+            y_lower_limit_b1 = y_lower_limit[8:16], y_lower_limit_b2 = y_lower_limit[0:8],
             eight_bit_output = eight_bit_output, do_frame_sync = do_frame_sync, do_line_sync = do_line_sync,
             const_dwell_time = const_dwell_time, configuration = configuration, unpause = unpause, step_size = step_size,
-            test_mode = args.test_mode, board_version = args.vers
+            test_mode = args.test_mode, board_version = args.vers,
+            boxcar_average = boxcar_average, compress_output = compress_output,
+            vector_commands = vector_commands, serpentine = serpentine
         ))
 
     @classmethod
     def add_run_arguments(cls, parser, access):
         super().add_run_arguments(parser, access)
+        parser.add_argument(
+        "--capture", type=str, metavar="FILE",
+        help="endpoint: also capture the raw data read from the device to FILE, with an index in "
+             "FILE.idx, for replay with interface/raw_capture.py", default = None)
+        parser.add_argument(
+        "--queue-depth", type=int, metavar="PACKETS",
+        help="endpoint: packets buffered for each consumer of the data read from the device",
+        default = 64)
+        parser.add_argument(
+        "--subscriber-policy", type=str, choices=POLICIES, default="block",
+        help="endpoint: what a data client's queue does when the client falls behind, until "
+             "the client sets its own; a client that loses raster packets sees its image "
+             "shift until the next config packet (default: %(default)s)")
+        parser.add_argument(
+        "--decimation", type=int, metavar="N", default=4,
+        help="endpoint: with the decimate policy, take every Nth packet while behind")
 
     async def run(self, device, args):
         iface = await device.demultiplexer.claim_interface(self, self.mux_interface, args)
@@ -695,41 +735,15 @@ class ScanGenApplet(GlasgowApplet):
                                     # write_buffer_size = 10*16384)
 
         if args.buf == "local":
-            scan_iface = SG_LocalBufferInterface(iface, self.logger, device, self.__addr_scan_mode,
-            self.__addr_x_full_resolution_b1, self.__addr_x_full_resolution_b2,
-            self.__addr_y_full_resolution_b1, self.__addr_y_full_resolution_b2,
-            self.__addr_x_upper_limit_b1, self.__addr_x_upper_limit_b2,
-            self.__addr_x_lower_limit_b1, self.__addr_x_lower_limit_b2,
-            self.__addr_y_upper_limit_b1, self.__addr_y_upper_limit_b2,
-            self.__addr_y_lower_limit_b1, self.__addr_y_lower_limit_b2,
-            self.__addr_8_bit_output, self.__addr_do_frame_sync, self.__addr_do_line_sync,
-            self.__addr_configuration, self.__addr_unpause, self.__addr_step_size,
-            self.__addr_const_dwell_time
-            )
-        if args.buf == "endpoint":
-            scan_iface = SG_EndpointInterface(iface, self.logger, device, self.__addr_scan_mode,
-            self.__addr_x_full_resolution_b1, self.__addr_x_full_resolution_b2,
-            self.__addr_y_full_resolution_b1, self.__addr_y_full_resolution_b2,
-            self.__addr_x_upper_limit_b1, self.__addr_x_upper_limit_b2,
-            self.__addr_x_lower_limit_b1, self.__addr_x_lower_limit_b2,
-            self.__addr_y_upper_limit_b1, self.__addr_y_upper_limit_b2,
-            self.__addr_y_lower_limit_b1, self.__addr_y_lower_limit_b2,
-            self.__addr_8_bit_output, self.__addr_do_frame_sync, self.__addr_do_line_sync,
-            self.__addr_configuration, self.__addr_unpause, self.__addr_step_size,
-            self.__addr_const_dwell_time
-            )
+            scan_iface = SG_LocalBufferInterface(iface, self.logger, device, self.__registers)
+        elif args.buf == "endpoint":
+            scan_iface = SG_EndpointInterface(iface, self.logger, device, self.__registers)
+            scan_iface.capture_path = args.capture
+            scan_iface.pipeline_depth = args.queue_depth
+            scan_iface.server_host.policy = args.subscriber_policy
+            scan_iface.server_host.decimation = args.decimation
         else:
-            scan_iface = ScanGenInterface(iface, self.logger, device, self.__addr_scan_mode,
-            self.__addr_x_full_resolution_b1, self.__addr_x_full_resolution_b2,
-            self.__addr_y_full_resolution_b1, self.__addr_y_full_resolution_b2,
-            self.__addr_x_upper_limit_b1, self.__addr_x_upper_limit_b2,
-            self.__addr_x_lower_limit_b1, self.__addr_x_lower_limit_b2,
-            self.__addr_y_upper_limit_b1, self.__addr_y_upper_limit_b2,
-            self.__addr_y_lower_limit_b1, self.__addr_y_lower_limit_b2,
-            self.__addr_8_bit_output, self.__addr_do_frame_sync, self.__addr_do_line_sync,
-            self.__addr_configuration, self.__addr_unpause, self.__addr_step_size,
-            self.__addr_const_dwell_time
-            )
+            scan_iface = ScanGenInterface(iface, self.logger, device, self.__registers)
 
         return scan_iface
 
@@ -748,6 +762,14 @@ class ScanGenApplet(GlasgowApplet):
             await scan_iface.set_frame_resolution(512,512)
             await scan_iface.set_raster_mode()
             scan_iface.launch_gui()
+            try:
+                while True:
+                    await scan_iface.stream_video()
+            finally:
+                try:
+                    scan_iface.decoder.stop()
+                finally:
+                    scan_iface.frame_ring.close()
 
         if args.buf == "test_raster":
             await scan_iface.pause()
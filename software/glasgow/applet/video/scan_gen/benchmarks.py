@@ -0,0 +1,447 @@
+"""
+Offline benchmarks of the host side of scan_gen, from the bytes the device sends to what the
+display draws, with synthetic streams instead of hardware.
+
+Run with ``python -m glasgow.applet.video.scan_gen.benchmarks``. Each benchmark runs in a fresh
+process, so that the peak RSS reported for it is its own, and reports throughput, per-item
+latency percentiles and peak RSS. The results, with the commit they were measured at, are
+written as JSON (see :func:`main` for where), and ``--compare`` checks them against an earlier
+run to show regressions.
+"""
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import functools
+import contextlib
+import subprocess
+import multiprocessing
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    ## not on Windows
+    resource = None
+
+if __package__:
+    from .interface.scan_stream import ScanStream
+    from .interface.ring_buffer import RingBuffer
+    from .interface.image_pyramid import ImagePyramid
+    from .interface.scan_server import ServerHost
+    from .interface.mock_output import raster_stream, vector_echo_stream, generate_raster_config
+    from .pattern_generators.patterngen_utils import PatternStream, packet_from_generator
+    from .pattern_generators.hilbert import hilbert_d2xy
+    from .stream_pipeline import StreamPipeline
+    from .gateware.pixel_compressor import PixelEncoder
+else:
+    from interface.scan_stream import ScanStream
+    from interface.ring_buffer import RingBuffer
+    from interface.image_pyramid import ImagePyramid
+    from interface.scan_server import ServerHost
+    from interface.mock_output import raster_stream, vector_echo_stream, generate_raster_config
+    from pattern_generators.patterngen_utils import PatternStream, packet_from_generator
+    from pattern_generators.hilbert import hilbert_d2xy
+    from stream_pipeline import StreamPipeline
+    from gateware.pixel_compressor import PixelEncoder
+
+
+__all__ = ["BENCHMARKS", "run_benchmark", "run_all", "compare", "main"]
+
+
+PACKET_SIZE = 16384
+## where results go by default, next to the older captures
+RESULTS_DIRECTORY = os.path.join("benchmark_archive", "Host Pipeline")
+
+
+def peak_rss():
+    """Peak resident set size of this process so far, in bytes, or ``None`` where unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak*1024
+
+
+def timed(items, process):
+    """Call ``process`` on each of ``items``; returns the total time and the time each call took."""
+    latencies = np.empty(len(items))
+    start = time.perf_counter()
+    for n, item in enumerate(items):
+        began = time.perf_counter()
+        process(item)
+        latencies[n] = time.perf_counter() - began
+    return time.perf_counter() - start, latencies
+
+
+def summarize(nbytes, elapsed, latencies, unit="packets"):
+    return {
+        "bytes":       nbytes,
+        "items":       len(latencies),
+        "unit":        unit,
+        "seconds":     elapsed,
+        "mb_per_s":    nbytes/elapsed/1e6,
+        "items_per_s": len(latencies)/elapsed,
+        "p50_us":      float(np.percentile(latencies, 50))*1e6,
+        "p99_us":      float(np.percentile(latencies, 99))*1e6,
+        "peak_rss_mb": None if peak_rss() is None else peak_rss()/1e6,
+    }
+
+
+def split_packets(stream):
+    return [stream[n:n + PACKET_SIZE] for n in range(0, len(stream), PACKET_SIZE)]
+
+
+def bench_generate(packets, eight_bit_output):
+    ## the config packet and the first packet of pixels of a frame, made afresh each time,
+    ## as a test makes the start of a stream
+    side = 2048
+    elapsed, latencies = timed(range(packets), lambda n:
+        raster_stream(side, side, eight_bit_output, PACKET_SIZE))
+    return summarize(packets*PACKET_SIZE, elapsed, latencies)
+
+
+def bench_decode(packets, eight_bit_output, roi={}, config_every=None, side=2048):
+    stream = raster_stream(side, side, eight_bit_output, packets*PACKET_SIZE, **roi)
+    chunks = split_packets(stream)
+    if config_every is not None:
+        ## alternate between two regions, as when the region of interest is being moved
+        other = dict(lx=side//4, ux=3*side//4, ly=side//4, uy=3*side//4)
+        configs = [bytes(generate_raster_config(side, side, eight_bit_output, **r)) for r in (roi, other)]
+        chunks = [configs[(n // config_every) % 2] + chunk if n % config_every == 0 else chunk
+                  for n, chunk in enumerate(chunks)]
+    scan_stream = ScanStream()
+    elapsed, latencies = timed(chunks, scan_stream.writeto)
+    return summarize(sum(map(len, chunks)), elapsed, latencies)
+
+
+def sem_like_image(side, noise, seed=0):
+    """
+    A 7-bit image with what SEM images have: a shading gradient, particles brighter at their
+    edges than in the middle, and detector noise of standard deviation ``noise`` levels.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:side, 0:side]/side
+    image = 30 + 25*x + 10*y
+    for n in range(40):
+        cy, cx, r = rng.random(), rng.random(), rng.uniform(0.02, 0.08)
+        distance = np.hypot(y - cy, x - cx)/r
+        image += np.where(distance < 1, 25 + 35*distance**4, 0)
+    image += rng.normal(0, noise, image.shape) if noise else 0
+    return np.clip(np.rint(image), 0, 127).astype(np.uint8)
+
+
+def bench_decode_compressed(packets, noise, side=1024, usb_rate=40e6):
+    """
+    Frames of :func:`sem_like_image`, as :class:`PixelCompressor` codes them, each after a
+    config packet, decoded by :class:`ScanStream`. Also reports the pixels per byte, and the
+    pixel rate with the stream at ``usb_rate`` bytes per second, or at the rate of decoding if
+    that is lower; uncompressed 8-bit pixels go at ``usb_rate``.
+    """
+    image = sem_like_image(side, noise)
+    encoder = PixelEncoder()
+    codes = encoder.encode(image.ravel()) + encoder.flush()
+    config = bytearray(generate_raster_config(side, side, True))
+    config[15] = 3 ## 8-bit, compressed
+    frame = bytes(config) + codes
+    stream = frame*(-(-packets*PACKET_SIZE//len(frame)))
+    chunks = split_packets(stream[:packets*PACKET_SIZE])
+    scan_stream = ScanStream()
+    scan_stream.parse_config_from_data(frame)
+    assert (scan_stream.buffer == image).all()
+    elapsed, latencies = timed(chunks, scan_stream.writeto)
+    result = summarize(sum(map(len, chunks)), elapsed, latencies)
+    pixels_per_byte = side*side/len(frame)
+    result["pixels_per_byte"] = pixels_per_byte
+    result["decode_mpixel_per_s"] = result["mb_per_s"]*pixels_per_byte
+    result["usb_mpixel_per_s"] = min(usb_rate/1e6*pixels_per_byte, result["decode_mpixel_per_s"])
+    ## fewer bytes for the same frame is better compression, not a slower decoder
+    result["compare_on"] = "decode_mpixel_per_s"
+    return result
+
+
+def bench_decode_vector(packets, side=2048):
+    pattern, stream = vector_echo_stream(side, side, packets*PACKET_SIZE//2)
+    scan_stream = ScanStream()
+    scan_stream.patterngen = pattern
+    scan_stream.writeto(stream[:18])
+    elapsed, latencies = timed(split_packets(stream[18:]), scan_stream.writeto)
+    return summarize(len(stream) - 18, elapsed, latencies)
+
+
+def bench_packetize(packets, side=2048):
+    y, x = np.divmod(np.arange(packets*PACKET_SIZE//6) % (side*side), side)
+    pattern = PatternStream.from_points(x, y, 1)
+    ## the packets are consumed as the USB writer would, by copying them out
+    packet_loop = packet_from_generator(pattern)
+    elapsed, latencies = timed(range(packets), lambda n: bytes(next(packet_loop)))
+    return summarize(packets*PACKET_SIZE, elapsed, latencies)
+
+
+def bench_commands(packets, path, side=2048, usb_rate=40e6):
+    """
+    The points of a ``"raster"`` or ``"hilbert"`` path, as many as :func:`bench_packetize`
+    sends, encoded as vector commands and packetized. Also reports the bytes per point, and the
+    point rate with the commands at ``usb_rate`` bytes per second, or at the rate of encoding if
+    that is lower; plain vector points are 6 bytes each.
+    """
+    index = np.arange(packets*PACKET_SIZE//6) % (side*side)
+    if path == "hilbert":
+        x, y = hilbert_d2xy(int(np.log2(side)), index)
+    else:
+        y, x = np.divmod(index, side)
+    pattern = PatternStream.from_points(x, y, 1)
+    chunks = []
+    elapsed, latencies = timed([pattern], lambda pattern: chunks.extend(
+        bytes(packet) for packet in packet_from_generator(pattern, vector_commands = True)))
+    result = summarize(sum(map(len, chunks)), elapsed, latencies, unit="patterns")
+    bytes_per_point = sum(map(len, chunks))/len(index)
+    result["bytes_per_point"] = bytes_per_point
+    result["encode_mpoint_per_s"] = len(index)/elapsed/1e6
+    result["usb_mpoint_per_s"] = min(usb_rate/1e6/bytes_per_point, result["encode_mpoint_per_s"])
+    ## fewer bytes for the same points is a better encoding, not a slower encoder
+    result["compare_on"] = "encode_mpoint_per_s"
+    return result
+
+
+def bench_socket(packets, port=41237, side=2048):
+    """
+    Packets read by a :class:`StreamPipeline`, forwarded through a local :class:`ServerHost`
+    as the endpoint interface does, and received and decoded as the GUI's connection does.
+    Latency is from the pipeline reading a packet to the client having received all of it.
+    """
+    chunks = split_packets(raster_stream(side, side, True, packets*PACKET_SIZE))
+    read_at = np.zeros(len(chunks))
+    received_at = np.zeros(len(chunks))
+
+    async def process_cmds(cmds):
+        pass
+
+    async def run():
+        server_host = ServerHost(process_cmds, None)
+        server_host.PORT = port
+        data_server_future = asyncio.get_running_loop().create_future()
+        server_host.start_servers(data_server_future)
+
+        source = iter(enumerate(chunks))
+        async def read_packet():
+            try:
+                n, chunk = next(source)
+            except StopIteration:
+                raise EOFError
+            read_at[n] = time.perf_counter()
+            return chunk
+
+        async def forward_to_socket(data):
+            await data_server_future
+            await server_host.publish(data)
+
+        async def serve():
+            pipeline = StreamPipeline(read_packet)
+            pipeline.add_sink("socket", forward_to_socket)
+            try:
+                await pipeline.run()
+            except EOFError:
+                pass
+            await server_host.close()
+
+        async def receive():
+            while True:
+                try:
+                    reader, writer = await asyncio.open_connection(server_host.HOST, port + 1)
+                    break
+                except ConnectionError:
+                    await asyncio.sleep(0.01)
+            stream_buffer = RingBuffer(chunk_size=PACKET_SIZE)
+            scan_stream = ScanStream(stream_buffer)
+            received = 0
+            while data := await reader.read(stream_buffer.writable()):
+                stream_buffer.write(data)
+                scan_stream.readfrom()
+                now = time.perf_counter()
+                for n in range(received // PACKET_SIZE, (received + len(data)) // PACKET_SIZE):
+                    received_at[n] = now
+                received += len(data)
+            writer.close()
+            return received
+
+        start = time.perf_counter()
+        received, _ = await asyncio.gather(receive(), serve())
+        elapsed = time.perf_counter() - start
+        return received, elapsed
+
+    ## ServerHost reports connections on stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        received, elapsed = asyncio.run(run())
+    assert received == len(chunks)*PACKET_SIZE, f"received {received} bytes"
+    return summarize(received, elapsed, received_at - read_at)
+
+
+def bench_display(packets, side=4096, max_fps=30, rate=100e6):
+    """
+    Decode, and each display refresh, fold the rows that changed into the image pyramid and
+    copy out the tiles that changed in a 1024-pixel view, as the streaming GUI does before
+    handing them to Qt. Refreshes come every ``rate/max_fps`` bytes, as they would at
+    ``rate`` bytes per second; latency is per refresh.
+    """
+    chunks = split_packets(raster_stream(side, side, True, packets*PACKET_SIZE))
+    scan_stream = ScanStream()
+    scan_stream.writeto(chunks[0])
+    pyramid = ImagePyramid(scan_stream.display_buffer)
+    level = pyramid.level_for_scale(side/1024)
+    per_refresh = max(1, int(rate/max_fps) // PACKET_SIZE)
+    refreshes = [chunks[n:n + per_refresh] for n in range(1, len(chunks), per_refresh)]
+
+    def refresh(batch):
+        for chunk in batch:
+            scan_stream.writeto(chunk)
+        dirty_rows = scan_stream.take_dirty_rows()
+        if dirty_rows is not None:
+            pyramid.update_rows(*dirty_rows)
+        for key in pyramid.take_dirty(level, *map(range, pyramid.tiles(level))):
+            np.ascontiguousarray(pyramid.tile(level, *key))
+
+    elapsed, latencies = timed(refreshes, refresh)
+    return summarize(sum(map(len, chunks[1:])), elapsed, latencies, unit="refreshes")
+
+
+BENCHMARKS = {
+    "generate/raster8":        functools.partial(bench_generate, eight_bit_output=True),
+    "generate/raster16":       functools.partial(bench_generate, eight_bit_output=False),
+    "decode/raster8":          functools.partial(bench_decode, eight_bit_output=True),
+    "decode/raster16":         functools.partial(bench_decode, eight_bit_output=False),
+    "decode/raster8_roi":      functools.partial(bench_decode, eight_bit_output=True,
+                                                 roi=dict(lx=100, ux=1900, ly=100, uy=1900)),
+    "decode/raster16_roi":     functools.partial(bench_decode, eight_bit_output=False,
+                                                 roi=dict(lx=100, ux=1900, ly=100, uy=1900)),
+    "decode/config_changes":   functools.partial(bench_decode, eight_bit_output=True,
+                                                 config_every=16),
+    "decode/compressed_clean": functools.partial(bench_decode_compressed, noise=0),
+    "decode/compressed_sem":   functools.partial(bench_decode_compressed, noise=1),
+    "decode/compressed_noisy": functools.partial(bench_decode_compressed, noise=3),
+    "decode/vector_echo":      bench_decode_vector,
+    "patterns/packetize":      bench_packetize,
+    "patterns/commands_raster":  functools.partial(bench_commands, path="raster"),
+    "patterns/commands_hilbert": functools.partial(bench_commands, path="hilbert"),
+    "socket/forward":          bench_socket,
+    "display/ingest":          bench_display,
+}
+
+
+def run_benchmark(name, packets):
+    return BENCHMARKS[name](packets)
+
+
+def run_all(names, packets, isolate=True):
+    """Run the named benchmarks, each in a fresh process if ``isolate``; returns their results by name."""
+    results = {}
+    for name in names:
+        if isolate:
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                results[name] = pool.apply(run_benchmark, (name, packets))
+        else:
+            results[name] = run_benchmark(name, packets)
+        result = results[name]
+        rss = "" if result["peak_rss_mb"] is None else f', {result["peak_rss_mb"]:.0f} MB peak RSS'
+        print(f'{name:24} {result["mb_per_s"]:8.1f} MB/s {result["items_per_s"]:9.0f} {result["unit"]}/s '
+              f'p50 {result["p50_us"]:8.1f} us p99 {result["p99_us"]:8.1f} us{rss}')
+        if "pixels_per_byte" in result:
+            print(f'{"":24} {result["pixels_per_byte"]:8.2f} pixels/byte, '
+                  f'{result["decode_mpixel_per_s"]:.0f} Mpixel/s decoded, '
+                  f'{result["usb_mpixel_per_s"]:.0f} Mpixel/s over USB')
+        if "bytes_per_point" in result:
+            print(f'{"":24} {result["bytes_per_point"]:8.3f} bytes/point, '
+                  f'{result["encode_mpoint_per_s"]:.0f} Mpoint/s encoded, '
+                  f'{result["usb_mpoint_per_s"]:.0f} Mpoint/s over USB')
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Names of the benchmarks more than ``tolerance`` slower than in ``baseline``, with the ratio.
+    A result is compared on its ``compare_on`` rate if it names one, otherwise on MB/s.
+    """
+    regressions = {}
+    for name, result in results.items():
+        if name in baseline:
+            rate = result.get("compare_on", "mb_per_s")
+            if rate not in baseline[name]:
+                ## a baseline from before the rate was recorded
+                continue
+            ratio = result[rate]/baseline[name][rate]
+            print(f'{name:24} {ratio:6.2f}x {baseline[name][rate]:8.1f} -> {result[rate]:8.1f} {rate}')
+            if ratio < 1 - tolerance:
+                regressions[name] = ratio
+    return regressions
+
+
+def _git(*args):
+    try:
+        return subprocess.run(["git", *args], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the scan_gen host pipeline offline")
+    parser.add_argument("names", nargs="*", metavar="NAME",
+                        help=f"benchmarks to run, or prefixes such as 'decode/' (default: all of "
+                             f"{', '.join(BENCHMARKS)})")
+    parser.add_argument("--packets", type=int, default=1024,
+                        help="16384-byte packets per benchmark (default: %(default)s)")
+    parser.add_argument("--output", metavar="FILE",
+                        help=f"JSON results file (default: {RESULTS_DIRECTORY}/<date>_<commit>.json "
+                             f"in the repository)")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="earlier JSON results to compare with; exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown that counts as a regression (default: %(default)s)")
+    parser.add_argument("--no-isolate", dest="isolate", action="store_false",
+                        help="run every benchmark in this process (peak RSS is then cumulative)")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS
+             if not args.names or any(name.startswith(prefix) for prefix in args.names)]
+    if not names:
+        parser.error(f"no benchmarks match {args.names}")
+
+    commit = _git("rev-parse", "--short", "HEAD")
+    report = {
+        "commit":   commit,
+        "dirty":    bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "date":     time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "packets":  args.packets,
+        "platform": platform.platform(),
+        "machine":  platform.machine(),
+        "python":   platform.python_version(),
+        "numpy":    np.__version__,
+        "results":  run_all(names, args.packets, args.isolate),
+    }
+
+    output = args.output
+    if output is None:
+        toplevel = _git("rev-parse", "--show-toplevel") or "."
+        output = os.path.join(toplevel, RESULTS_DIRECTORY,
+                              f'{time.strftime("%Y-%m-%d_%H-%M-%S")}_{commit or "unknown"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'compared with {baseline.get("commit")} ({baseline.get("date")}):')
+        regressions = compare(report["results"], baseline["results"], args.tolerance)
+        if regressions:
+            print(f'regressions: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import time
+import queue
+import logging
+import threading
+import numpy as np
+
+
+__all__ = ["FrameDecoder", "DecoderStats"]
+
+
+class DecoderStats:
+    """
+    Counters for a :class:`FrameDecoder`.
+
+    :attr packets:
+        Packets decoded.
+    :attr dropped:
+        Packets discarded because the decode queue was full.
+    :attr late:
+        Packets that waited in the queue longer than the decoder's ``late_after``.
+    :attr frames:
+        Complete frames published.
+    :attr resyncs:
+        Partial frames abandoned after a drop, waiting for the next frame marker.
+    """
+    def __init__(self):
+        self.packets = 0
+        self.dropped = 0
+        self.late    = 0
+        self.frames  = 0
+        self.resyncs = 0
+
+    def __str__(self):
+        return (f"{self.packets} packets decoded, {self.dropped} dropped, {self.late} late, "
+                f"{self.frames} frames, {self.resyncs} resyncs")
+
+
+class FrameDecoder:
+    """
+    Decode 8-bit raster packets into a :class:`FrameRing` on a worker thread.
+
+    A zero byte marks the start of a frame; each one publishes the frame before it, and there
+    may be any number of them in a packet. ``geometry`` is called at the start of each frame and
+    returns its ``(width, height, roi)``.
+
+    Packets are handed over with :meth:`submit`, which never blocks: if the bounded queue is
+    full, the packet is dropped and counted, and the decoder abandons the frame it was in the
+    middle of and waits for the next frame marker, so that pixels never land in the wrong place.
+    The decode itself is done with NumPy operations on whole packets, which release the GIL
+    for the copies, so the event loop keeps running while frames are decoded.
+
+    If decoding fails, the worker logs the exception and stops, and the exception is raised
+    again from the next :meth:`submit` or :meth:`stop`, so it is not mistaken for dropped packets.
+    """
+    def __init__(self, frame_ring, geometry, depth=64, late_after=0.1, logger=None):
+        self._ring       = frame_ring
+        self._geometry   = geometry
+        self._queue      = queue.Queue(depth)
+        self._late_after = late_after
+        self._logger     = logger or logging.getLogger(__name__)
+        self._thread     = None
+        self._frame      = None
+        self._last_pixel = 0
+        ## until the first frame marker there is no telling where pixels belong
+        self._synced     = False
+        self._seen_dropped = 0
+        self.error = None
+        self.stats = DecoderStats()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="scan_gen frame decoder",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Decode what is already queued, then stop the worker."""
+        if self._thread is not None:
+            ## a worker that has failed no longer empties the queue
+            while self._thread.is_alive():
+                try:
+                    self._queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            self._thread.join()
+            self._thread = None
+        self._logger.debug("frame decoder: %s", self.stats)
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, packet):
+        """Queue ``packet`` for decoding. Returns ``False`` if it was dropped."""
+        if self.error is not None:
+            raise self.error
+        try:
+            ## the drop count travels with the packet, so the worker knows exactly where gaps are
+            self._queue.put_nowait((packet, time.perf_counter(), self.stats.dropped))
+            return True
+        except queue.Full:
+            self.stats.dropped += 1
+            return False
+
+    def _run(self):
+        try:
+            self._decode_queued()
+        except Exception as error:
+            self._logger.exception("frame decoder failed")
+            self.error = error
+
+    def _decode_queued(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            packet, submitted_at, dropped = item
+            if time.perf_counter() - submitted_at > self._late_after:
+                self.stats.late += 1
+            if dropped != self._seen_dropped:
+                self._seen_dropped = dropped
+                self.resync()
+            self.decode(packet)
+
+    def resync(self):
+        """Abandon the frame being decoded; pixels are ignored until the next frame marker."""
+        if self._synced:
+            self.stats.resyncs += 1
+        self._synced = False
+        self._frame = None
+
+    def _begin_frame(self):
+        width, height, roi = self._geometry()
+        self._frame = self._ring.begin(width, height, roi).reshape(-1)
+        self._last_pixel = 0
+
+    def _fill_frame(self, pixels):
+        ## anything past the end of the frame is dropped
+        end = min(self._last_pixel + pixels.size, self._frame.size)
+        self._frame[self._last_pixel:end] = pixels[:end - self._last_pixel]
+        self._last_pixel = end
+
+    def decode(self, packet):
+        """Decode one packet; called by the worker thread, or directly when not using it."""
+        d = np.frombuffer(packet, dtype=np.uint8)
+        start = 0
+        ## a zero marks the start of a frame
+        for zero_index in np.flatnonzero(d == 0):
+            if self._synced:
+                if self._frame is None:
+                    self._begin_frame()
+                self._fill_frame(d[start:zero_index])
+                self._ring.commit()
+                self.stats.frames += 1
+            self._synced = True
+            self._begin_frame()
+            start = zero_index + 1
+        if self._synced:
+            if self._frame is None:
+                self._begin_frame()
+            self._fill_frame(d[start:])
+        self.stats.packets += 1
+
+
+if __name__ == "__main__":
+    import os
+
+    if __package__:
+        from .interface.frame_ring import FrameRing
+    else:
+        from interface.frame_ring import FrameRing
+
+    def test_frame_decoder():
+        with FrameRing.create(f"scan_gen_test_{os.getpid()}", max_width=8, max_height=8) as ring:
+            decoder = FrameDecoder(ring, lambda: (4, 4, None))
+            ## two frame markers in one packet, and a frame split across packets
+            decoder.decode(bytes([5, 5, 0, *range(1, 9)]))
+            decoder.decode(bytes([*range(9, 17), 9, 9, 0, 7]))
+            frame = ring.latest()
+            assert ring.frames == 1 and (frame.pixels.ravel() == np.arange(1, 17)).all()
+            ## after a drop nothing is published until the next marker
+            decoder.resync()
+            decoder.decode(bytes([3]*20))
+            assert ring.frames == 1
+            decoder.decode(bytes([0, *[4]*16, 0]))
+            frame = ring.latest()
+            assert ring.frames == 2 and (frame.pixels == 4).all()
+            assert decoder.stats.resyncs == 1
+
+            ## through the worker, with a queue too small to keep up with a burst
+            decoder = FrameDecoder(ring, lambda: (4, 4, None), depth=2)
+            for n in range(50):
+                decoder.submit(bytes([0, *[n % 200 + 1]*16]))
+            decoder.start()
+            decoder.stop()
+            assert decoder.stats.dropped == 48 and decoder.stats.packets == 2
+            assert (ring.latest().pixels == 1).all()
+
+            ## a frame too big for the ring fails the worker, which is reported, not hung on
+            failing = FrameDecoder(ring, lambda: (16, 16, None), depth=2,
+                                   logger=logging.getLogger("frame decoder test"))
+            failing._logger.disabled = True
+            failing.start()
+            failing.submit(bytes([0, 1]))
+            failing._thread.join(1)
+            try:
+                failing.submit(bytes([1]))
+                assert False, "submit after a failure"
+            except ValueError:
+                pass
+            try:
+                failing.stop()
+                assert False, "stop after a failure"
+            except ValueError:
+                pass
+        print(f"frame decoder: OK\n  {decoder.stats}")
+
+    def bench_frame_decoder(side=2048, packets=2048):
+        with FrameRing.create(f"scan_gen_bench_{os.getpid()}", max_width=side, max_height=side) as ring:
+            decoder = FrameDecoder(ring, lambda: (side, side, None), depth=packets)
+            data = np.random.randint(1, 256, side*side*2, dtype=np.uint8)
+            data[::side*side] = 0
+            chunks = [memoryview(data[n*16384:(n + 1)*16384]) for n in range(packets)]
+            start = time.perf_counter()
+            for chunk in chunks:
+                decoder.decode(chunk)
+            end = time.perf_counter()
+        print(f'{packets*16384/(end - start)/1e6:.0f} MB/s decoded, {decoder.stats}')
+
+    test_frame_decoder()
+    bench_frame_decoder()
@@ -35,6 +35,16 @@ class ConfigHandler(Elaboratable):
 
     Registers that are "locked in" by strobing configuration:
         eight_bit_output: Signal, in, 1
+        compress_output: Signal, in, 1
+            Only has an effect with eight_bit_output, so it is locked
+            in as compress_output_locked = eight_bit_output & compress_output.
+            It is bit 1 of the 8B byte of the config packet
+        serpentine: Signal, in, 1
+            Scan every other line right to left, see XY_Scan_Gen.
+            It is bit 2 of the 8B byte of the config packet
+        vector_commands: Signal, in, 1
+            Read vector mode data as commands, see VectorCommandDecoder.
+            Not part of the config packet
 
         x_full_frame_resolution_b1: Signal, in, 8
         x_full_frame_resolution_b2: Signal, in, 8
@@ -87,6 +97,12 @@ class ConfigHandler(Elaboratable):
 
         self.eight_bit_output = Signal()
         self.eight_bit_output_locked = Signal()
+        self.compress_output = Signal()
+        self.compress_output_locked = Signal()
+        self.serpentine = Signal()
+        self.serpentine_locked = Signal()
+        self.vector_commands = Signal()
+        self.vector_commands_locked = Signal()
 
         self.configuration_flag = Signal()
         self.outer_configuration_flag = Signal()
@@ -132,6 +148,9 @@ class ConfigHandler(Elaboratable):
                     m.d.sync += self.y_full_frame_resolution_locked.eq(Cat(self.y_full_frame_resolution_b2,
                                                                             self.y_full_frame_resolution_b1))                 
                     m.d.sync += self.eight_bit_output_locked.eq(self.eight_bit_output)
+                    m.d.sync += self.compress_output_locked.eq(self.eight_bit_output & self.compress_output)
+                    m.d.sync += self.serpentine_locked.eq(self.serpentine)
+                    m.d.sync += self.vector_commands_locked.eq(self.vector_commands)
                     m.d.sync += self.step_size_locked.eq(self.step_size)
 
                     #m.d.comb += self.writing_config.eq(1)
@@ -235,7 +254,9 @@ class ConfigHandler(Elaboratable):
                 m.d.comb += self.writing_config.eq(1)
                 m.d.comb += self.config_data_valid.eq(1)
                 with m.If(self.write_happened):
-                    m.d.comb += self.in_fifo_w_data.eq(self.eight_bit_output)
+                    m.d.comb += self.in_fifo_w_data.eq(Cat(self.eight_bit_output,
+                                                           self.eight_bit_output & self.compress_output,
+                                                           self.serpentine))
                     m.next = "Insert_End_B1"
             with m.State("Insert_End_B1"):
                 m.d.comb += self.writing_config.eq(1)
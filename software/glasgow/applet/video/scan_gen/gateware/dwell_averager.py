@@ -1,42 +1,111 @@
 import amaranth
 from amaranth import *
-from amaranth.sim import Simulator
+from amaranth.sim import Simulator, Settle
+
+
+def boxcar_reciprocals(max_samples, reciprocal_bits):
+    ## ceil(2**reciprocal_bits/n), so that n equal samples average to exactly that sample;
+    ## powers of two are shifted instead, and don't need an entry
+    return [0 if (n & (n - 1)) == 0 else -(-(1 << reciprocal_bits)//n)
+            for n in range(max_samples + 1)]
 
 
 class TrueDwellTimeAverager(Elaboratable):
     '''
-    Inputs:
-        pixel_in: Next value read from ADC
-        start_new_average: If high, running_average is set to pixel_in, and
-        prev_pixel is not used.
-
-    Outputs:
-        running_average: The current running average. Average of pixel_in and prev_pixel
-        prev_pixel: Running average or pixel value from the previous cycle
+    Boxcar average of all the ADC samples in a dwell, an alternative to
+    DwellTimeAverager, with the same inputs.
+
+    Each strobe adds pixel_in to sum and 1 to count, and running_average
+    is sum/count: a shift if count is a power of two, otherwise sum times
+    a reciprocal of count from a ROM, within 1 of sum//count and exact if
+    all the samples are the same. After max_samples samples, sum and count
+    are halved before the next is added, so a longer dwell still averages
+    max_samples/2 to max_samples samples, with the earlier ones weighted less.
+
+    The division is pipelined, so that neither the ROM nor the multiplier
+    is in the same cycle as the sum or as what uses the average:
+        strobe:           _-____
+        sum, count:       _XXXXX
+        reciprocal:       __XXXX   (block RAM read port)
+        running_average:  ___XXX
+    BusMultiplexer takes at least two cycles after an ADC sample to get to
+    the next point, so the average is ready by the end of the dwell.
+
+    pixel_in: Signal, in, 16
+        Next value read from ADC
+    start_new_average: Signal, in, 1
+        Strobed at end_of_dwell (when beam controller moves to the next position)
+    start_new_average_latched: Signal, internal, 1
+        If start_new_average is high and strobe is not, start_new_average_latched
+        goes high until the next strobe
+    strobe: Signal, in, 1
+        Strobed whenever a new ADC value is latched
+
+    sum: Signal, internal, 16 + log2(max_samples)
+    count: Signal, internal
+        Samples in sum
+    running_average: Signal, out, 16
+        sum/count, two cycles after the strobe, held until the one after the next
     '''
-    def __init__(self):
-        self.pixel_in = Signal(14)
-        self.running_average = Signal(14)
-        self.prev_pixel = Signal(14)
+    def __init__(self, max_samples = 256, reciprocal_bits = 24):
+        assert max_samples >= 2 and (max_samples & (max_samples - 1)) == 0, \
+            "max_samples must be a power of two"
+        self.max_samples = max_samples
+        self.shift_bits = max_samples.bit_length() - 1
+        self.reciprocal_bits = reciprocal_bits
+
+        self.pixel_in = Signal(16)
         self.start_new_average = Signal()
-        self.averaging = Signal()
+        self.start_new_average_latched = Signal()
         self.strobe = Signal()
-        self.dwell_time = Signal(16)
-        
+
+        self.sum = Signal(16 + self.shift_bits)
+        self.count = Signal(range(max_samples + 1))
+        self.running_average = Signal(16)
+
     def elaborate(self, platform):
         m = Module()
-        q = Signal(16)
 
-        m.d.comb += self.dwell_time.eq(200)
+        reciprocal = Memory(width=self.reciprocal_bits, depth=self.max_samples + 1,
+                            init=boxcar_reciprocals(self.max_samples, self.reciprocal_bits))
+        m.submodules.reciprocal = reciprocal_rd = reciprocal.read_port(transparent=False)
 
-        m.d.comb += q.eq(len(self.dwell_time))
+        next_sum = Signal.like(self.sum)
+        next_count = Signal.like(self.count)
+        product = Signal(len(self.sum) + self.reciprocal_bits)
+        ## the cycle after a strobe, when sum, count and the reciprocal are ready
+        divide = Signal()
 
+        with m.If((self.start_new_average) | (self.start_new_average_latched)):
+            m.d.comb += next_sum.eq(self.pixel_in)
+            m.d.comb += next_count.eq(1)
+        with m.Elif(self.count == self.max_samples):
+            m.d.comb += next_sum.eq((self.sum >> 1) + self.pixel_in)
+            m.d.comb += next_count.eq(self.max_samples//2 + 1)
+        with m.Else():
+            m.d.comb += next_sum.eq(self.sum + self.pixel_in)
+            m.d.comb += next_count.eq(self.count + 1)
+
+        m.d.comb += reciprocal_rd.addr.eq(next_count)
+        m.d.comb += reciprocal_rd.en.eq(self.strobe)
+        m.d.comb += product.eq(self.sum * reciprocal_rd.data)
+
+        with m.If((self.start_new_average) & (~(self.strobe))):
+            m.d.sync += self.start_new_average_latched.eq(1)
+
+        m.d.sync += divide.eq(self.strobe)
         with m.If(self.strobe):
-            m.d.sync += self.prev_pixel.eq(self.running_average)
-            m.d.comb += self.running_average.eq((self.pixel_in+self.prev_pixel)//2)
-        with m.If((self.strobe) & (self.start_new_average)):
-            m.d.sync += self.prev_pixel.eq(self.pixel_in)
-            m.d.comb += self.running_average.eq((self.pixel_in))
+            m.d.sync += self.start_new_average_latched.eq(0)
+            m.d.sync += self.sum.eq(next_sum)
+            m.d.sync += self.count.eq(next_count)
+
+        with m.If(divide):
+            with m.Switch(self.count):
+                for n in range(self.shift_bits + 1):
+                    with m.Case(1 << n):
+                        m.d.sync += self.running_average.eq(self.sum >> n)
+                with m.Default():
+                    m.d.sync += self.running_average.eq(product >> self.reciprocal_bits)
 
         return m
 
@@ -113,27 +182,92 @@ if __name__ == "__main__":
         1600
     ]
 
+    def boxcar_reference(samples, starts, max_samples = 256, reciprocal_bits = 24):
+        '''
+        TrueDwellTimeAverager in NumPy: the running average after each of
+        samples, where starts is true for the first sample of each dwell.
+        Also returns sum//count, which it should be within 1 of.
+        '''
+        import numpy as np
+        sums = np.empty(len(samples), dtype=np.int64)
+        counts = np.empty(len(samples), dtype=np.int64)
+        total = count = 0
+        for n, (sample, start) in enumerate(zip(samples, starts)):
+            if start:
+                total, count = 0, 0
+            elif count == max_samples:
+                total, count = total >> 1, max_samples//2
+            total += int(sample)
+            count += 1
+            sums[n], counts[n] = total, count
+        reciprocals = np.array(boxcar_reciprocals(max_samples, reciprocal_bits), dtype=np.int64)
+        power_of_two = (counts & (counts - 1)) == 0
+        shifts = np.log2(counts).astype(np.int64)
+        average = np.where(power_of_two, sums >> shifts, (sums*reciprocals[counts]) >> reciprocal_bits)
+        return average, sums//counts
+
     def test_truedwelltimeaverager():
+        import numpy as np
+        rng = np.random.default_rng(1)
+        ## dwells of every length up to 300 samples, then one of 1000,
+        ## to go past max_samples; noisy, constant, and full scale samples
+        lengths = list(rng.permutation(np.arange(1, 301))) + [1000]
+        samples = []
+        for length in lengths:
+            kind = rng.integers(3)
+            if kind == 0:
+                samples += list(np.clip(rng.normal(8000, 1500, length), 0, 16383).astype(int))
+            elif kind == 1:
+                samples += [int(rng.integers(0, 16384))]*length
+            else:
+                samples += list(rng.integers(65000, 65536, length))
+        starts = np.zeros(len(samples), dtype=bool)
+        starts[np.cumsum([0] + lengths[:-1])] = True
+        expected, floor = boxcar_reference(samples, starts)
+        assert (np.abs(expected - floor) <= 1).all()
+
         dut = TrueDwellTimeAverager()
+        averages = []
         def bench():
-            yield dut.start_new_average.eq(1)
-            yield
-            yield dut.strobe.eq(1)
-            yield dut.pixel_in.eq(Const(test_pixel_stream[0],shape=14))
-            print("Pixel in:", test_pixel_stream[0])
-            yield
-            print("-")
-            assert(yield dut.running_average == Const(test_pixel_stream[0],shape=14))
-            print("Running average:", test_pixel_stream[0])
-            running_average = test_pixel_stream[0]
-            
-            yield dut.start_new_average.eq(0)
+            for n, sample in enumerate(samples):
+                ## the start of a dwell comes either with its first strobe or before it
+                if starts[n] and n % 2:
+                    yield dut.start_new_average.eq(1)
+                    yield
+                    yield dut.start_new_average.eq(0)
+                    yield
+                else:
+                    yield dut.start_new_average.eq(int(starts[n]))
+                yield dut.pixel_in.eq(int(sample))
+                yield dut.strobe.eq(1)
+                yield
+                yield dut.start_new_average.eq(0)
+                yield dut.strobe.eq(0)
+                yield
+                ## two cycles after the strobe
+                yield Settle()
+                averages.append((yield dut.running_average))
+                ## and it holds until the next strobe
+                yield
+                yield Settle()
+                assert (yield dut.running_average) == averages[-1]
 
         sim = Simulator(dut)
         sim.add_clock(1e-6) # 1 MHz
         sim.add_sync_process(bench)
-        with sim.write_vcd("running_avg_sim.vcd"):
-            sim.run()
+        sim.run()
+        assert (np.array(averages) == expected).all()
+
+        ## the same noise through both averagers, read at the end of each 64-sample dwell
+        noise = np.clip(rng.normal(8000, 1000, 64*200), 0, 16383).astype(int)
+        boxcar = boxcar_reference(noise, np.arange(len(noise)) % 64 == 0)[0][63::64]
+        exponential = []
+        for n, sample in enumerate(noise):
+            running_average = sample if n % 64 == 0 else (sample + running_average)//2
+            if n % 64 == 63:
+                exponential.append(running_average)
+        print(f'true dwell time averager: OK, noise after 64 samples {np.std(boxcar):.0f}, '
+              f'{np.std(exponential):.0f} with DwellTimeAverager, {np.std(noise):.0f} before')
 
 
     def test_dwelltimeaverager():
@@ -193,4 +327,5 @@ if __name__ == "__main__":
         with sim.write_vcd("running_avg_sim.vcd"):
             sim.run()
 
-    test_dwelltimeaverager()
\ No newline at end of file
+    test_dwelltimeaverager()
+    test_truedwelltimeaverager()
\ No newline at end of file
@@ -0,0 +1,485 @@
+import numpy as np
+
+if "glasgow" in __name__: ## running as applet
+    from ..gateware.structs import ScanMode
+    from ..gateware.pixel_compressor import PixelEncoder
+    from ..gateware.vector_command_decoder import CommandExpander
+else:
+    from structs import ScanMode
+    from pixel_compressor import PixelEncoder
+    from vector_command_decoder import CommandExpander
+
+
+## ByteSwapper keeps bits 6 to 12 of the running average
+PIXEL_SHIFT = 6
+PIXEL_BITS = 7
+## and the values it replaces, see byte_swapper.replace_16 and replace_8
+REPLACE_16 = (16383, 16382)
+REPLACE_8 = (255, 254)
+
+DEMARCATOR = 255
+## bytes per point written to the OUT FIFO, see StreamReader
+PATTERN_POINT = 2  ## D1 D2
+VECTOR_POINT = 6   ## X1 X2 Y1 Y2 D1 D2
+
+
+class IOBusModel:
+    '''
+    Transaction-level model of IOBus: the bytes it puts in the IN FIFO
+    for the registers it is given and the bytes written to the OUT FIFO,
+    without its timing. Whole frames are computed at once with NumPy,
+    so it makes streams for host testing at tens of MB/s, where the
+    simulation in simulation.py makes a few hundred bytes a second.
+
+    adc: None, or function(x_position, y_position) -> ADC codes
+        With None, the "data loopback" build is modeled: the sample is
+        the X DAC code in raster mode, and dwell time * 64 in raster
+        pattern and vector modes. Otherwise the default build is modeled,
+        with an ideal detector: the function is called with arrays of
+        DAC codes and returns the 14-bit ADC code at each.
+
+    Use it as the applet does:
+        configure(...)  strobe configuration with the registers given;
+                        the config packet is queued, and the scan starts over
+        write(data)     bytes from the host, points in raster pattern and
+                        vector modes, or vector commands if vector_commands
+                        was configured, ignored in raster mode
+        read(length)    the bytes the host would read. In raster mode they
+                        are made as they are asked for; otherwise there are
+                        only as many as the points written
+
+    It is checked byte for byte against IOBus in the Amaranth simulator
+    (run this file). It reproduces what the gateware does, including:
+        - the first raster point after a config is sampled at (0, 0), where
+          the config left the beam, and then the scan carries on at the
+          second point of the region
+        - in raster pattern mode, the first dwell time goes with the second
+          point of the region, since the point that ends the config consumes
+          the first with no dwell time
+        - in 16-bit mode the second byte of each point is 0, and the
+          marker substitutions can never happen, as the pixel is 7 bits
+        - with compress_output, PixelCompressor holds pixels back until the
+          next one, so there may be fewer bytes to read than points written
+        - with serpentine, every other line of the region is scanned right
+          to left, counting from the first line, and each frame starts at
+          the left again
+    It does not model what depends on timing: points written while the
+    config packet is still being sent are lost on the device, so write
+    after reading it, and on reconfiguring while scanning, the device
+    finishes the point it is on, which here is wherever read stopped.
+    When compressing, that is where read stopped making pixels, which can
+    be past where it stopped reading codes, so the codes flushed before
+    the next config packet only match the device's if read stopped at a
+    point that ended a code.
+    '''
+    def __init__(self, adc = None):
+        self.adc = adc
+        self.scan_mode = None
+        self.eight_bit_output = 0
+        self.compress_output = 0
+        self.vector_commands = 0
+        self._encoder = PixelEncoder()
+        self._expander = CommandExpander()
+        self._pending = bytearray()
+        self._partial = bytearray()
+
+    def configure(self, scan_mode, x_full_resolution, y_full_resolution,
+                  x_lower_limit = 0, x_upper_limit = 0, y_lower_limit = 0, y_upper_limit = 0,
+                  eight_bit_output = 0, step_size = 1, const_dwell_time = 0, boxcar_average = 0,
+                  compress_output = 0, vector_commands = 0, serpentine = 0):
+        '''
+        Register values as written by ScanGenInterface, e.g. a resolution of
+        one less than the number of pixels. Returns the config packet.
+        The dwell time only changes how long the points take, and both
+        averagers give the sample itself when it is the same all dwell.
+        vector_commands is not part of the config, but the commands start
+        over with it, as VectorCommandDecoder does.
+        '''
+        ## ConfigHandler: an upper limit at or below the lower one means the full frame
+        if x_upper_limit <= x_lower_limit:
+            x_upper_limit = x_full_resolution
+        if y_upper_limit <= y_lower_limit:
+            y_upper_limit = y_full_resolution
+        ## the pixels held back go before the config packet, and the next config starts over
+        if self.compress_output:
+            self._pending += self._encoder.flush()
+        self._encoder.reset()
+        self._expander.reset()
+        self.vector_commands = vector_commands & 1
+        self.scan_mode = ScanMode(scan_mode)
+        self.eight_bit_output = eight_bit_output & 1
+        self.compress_output = self.eight_bit_output & compress_output
+        self.step_size = step_size & 0xFF
+        self.serpentine = serpentine & 1
+        self.x_lower = x_lower_limit
+        self.y_lower = y_lower_limit
+        self.x_count = max(x_upper_limit - x_lower_limit + 1, 1)
+        self.y_count = max(y_upper_limit - y_lower_limit + 1, 1)
+        self._partial.clear()
+
+        packet = bytes([DEMARCATOR, DEMARCATOR,
+                        x_full_resolution >> 8, x_full_resolution & 0xFF,
+                        y_full_resolution >> 8, y_full_resolution & 0xFF,
+                        x_upper_limit >> 8, x_upper_limit & 0xFF,
+                        x_lower_limit >> 8, x_lower_limit & 0xFF,
+                        y_upper_limit >> 8, y_upper_limit & 0xFF,
+                        y_lower_limit >> 8, y_lower_limit & 0xFF,
+                        scan_mode, self.eight_bit_output | self.compress_output << 1 | self.serpentine << 2,
+                        DEMARCATOR, DEMARCATOR])
+        self._pending += packet
+
+        if self.scan_mode == ScanMode.Raster:
+            ## the first point is sampled where the config left the beam
+            self._pending += self._output(self._sample(np.zeros(1, dtype=np.int64),
+                                                       np.zeros(1, dtype=np.int64),
+                                                       np.zeros(1, dtype=np.int64)))
+        ## the point that ends the config takes the first of the region
+        self._index = 1
+        return packet
+
+    @property
+    def point_size(self):
+        return 1 if self.eight_bit_output else 2
+
+    def _dac(self, counts):
+        ## PixelRatioInterpolator output, 16 bits, into the 14-bit BeamController position
+        return (counts*self.step_size) & 0x3FFF
+
+    def _positions(self, count):
+        ## the next count points of the region, in the order XY_Scan_Gen steps through them
+        index = np.arange(self._index, self._index + count, dtype=np.int64) % (self.x_count*self.y_count)
+        self._index = (self._index + count) % (self.x_count*self.y_count)
+        y, x = np.divmod(index, self.x_count)
+        if self.serpentine:
+            x = np.where(y & 1, self.x_count - 1 - x, x)
+        return self._dac(self.x_lower + x), self._dac(self.y_lower + y)
+
+    def _sample(self, x_position, y_position, dwell):
+        ## what DwellTimeAverager sees; it averages the same value over the whole dwell
+        if self.adc is not None:
+            return np.asarray(self.adc(x_position, y_position), dtype=np.int64) & 0x3FFF
+        if self.scan_mode == ScanMode.Raster:
+            return x_position
+        return ((dwell & 0x3FFF)*64) & 0xFFFF
+
+    def _output(self, samples):
+        ## ByteSwapper, then StreamWriter or PixelCompressor
+        pixels = (samples >> PIXEL_SHIFT) & ((1 << PIXEL_BITS) - 1)
+        pixels = np.where(pixels == REPLACE_16[0], REPLACE_16[1], pixels)
+        if self.compress_output:
+            return self._encoder.encode(pixels)
+        if self.eight_bit_output:
+            low = pixels & 0xFF
+            return np.where(low == REPLACE_8[0], REPLACE_8[1], low).astype(np.uint8).tobytes()
+        out = np.zeros((len(pixels), 2), dtype=np.uint8)
+        out[:, 0] = pixels & 0xFF
+        return out.tobytes()
+
+    def write(self, data):
+        if self.scan_mode in (None, ScanMode.Raster):
+            return
+        if self.scan_mode == ScanMode.Vector and self.vector_commands:
+            x, y, dwell = self._expander.expand(data)
+            self._pending += self._output(self._sample(self._dac(x), self._dac(y), dwell))
+            return
+        size = PATTERN_POINT if self.scan_mode == ScanMode.RasterPattern else VECTOR_POINT
+        self._partial += data
+        complete = len(self._partial) - len(self._partial) % size
+        if complete == 0:
+            return
+        points = np.frombuffer(bytes(self._partial[:complete]), dtype="<u2").astype(np.int64)
+        del self._partial[:complete]
+        if self.scan_mode == ScanMode.RasterPattern:
+            dwell = points
+            x_position, y_position = self._positions(len(dwell))
+        else:
+            points = points.reshape(-1, 3)
+            x_position, y_position, dwell = self._dac(points[:, 0]), self._dac(points[:, 1]), points[:, 2]
+        self._pending += self._output(self._sample(x_position, y_position, dwell))
+
+    def read(self, length):
+        while self.scan_mode == ScanMode.Raster and len(self._pending) < length:
+            ## a point is at least a byte, unless it is compressed
+            count = -(-(length - len(self._pending))//self.point_size)
+            x_position, y_position = self._positions(count)
+            self._pending += self._output(self._sample(x_position, y_position, None))
+        data = bytes(self._pending[:length])
+        del self._pending[:length]
+        return data
+
+
+def simulate(steps, test_mode = "data loopback", adc = None, max_cycles = 200000):
+    '''
+    Runs IOBus in the Amaranth simulator, with the applet's register sequence,
+    and returns the bytes it writes to the IN FIFO.
+
+    steps: list of
+        ("configure", registers)  strobe configuration with the registers given
+                                  (keywords of IOBusModel.configure), paused on
+                                  the first, and wait for the config packet
+        ("write", data)           queue data for the OUT FIFO
+        ("read", length)          wait for length more bytes
+    '''
+    from amaranth import Signal
+    from amaranth.sim import Simulator
+    from amaranth.lib.fifo import SyncFIFO
+    if "glasgow" in __name__: ## running as applet
+        from ..gateware.main_iobus import IOBus
+    else:
+        from main_iobus import IOBus
+
+    in_fifo = SyncFIFO(width=8, depth=16)
+    out_fifo = SyncFIFO(width=8, depth=16)
+    names = ["x_full_resolution", "y_full_resolution", "x_upper_limit", "x_lower_limit",
+             "y_upper_limit", "y_lower_limit"]
+    registers = {name: Signal(16, name=name) for name in names}
+    scan_mode = Signal(2)
+    eight_bit_output = Signal()
+    const_dwell_time = Signal(8)
+    boxcar_average = Signal()
+    compress_output = Signal()
+    vector_commands = Signal()
+    serpentine = Signal()
+    configuration = Signal()
+    unpause = Signal()
+    step_size = Signal(8)
+    byte_registers = []
+    for name in names:
+        byte_registers += [registers[name][8:16], registers[name][0:8]]
+    dut = IOBus(in_fifo, out_fifo, scan_mode, *byte_registers,
+                eight_bit_output, Signal(), Signal(), const_dwell_time, configuration, unpause, step_size,
+                is_simulation = True, test_mode = test_mode, boxcar_average = boxcar_average,
+                compress_output = compress_output, vector_commands = vector_commands,
+                serpentine = serpentine)
+
+    received = bytearray()
+    outgoing = bytearray()
+
+    def cycle():
+        ## the host side: drain the IN FIFO, feed the OUT FIFO a little at a time
+        yield in_fifo.r_en.eq(1)
+        if (yield in_fifo.r_rdy):
+            received.append((yield in_fifo.r_data))
+        if outgoing and (yield out_fifo.level) < 8:
+            yield out_fifo.w_data.eq(outgoing.pop(0))
+            yield out_fifo.w_en.eq(1)
+        else:
+            yield out_fifo.w_en.eq(0)
+        if adc is not None:
+            yield dut.pins_i.eq(int(adc((yield dut.beam_controller.x_position),
+                                        (yield dut.beam_controller.y_position))) & 0x3FFF)
+        yield
+
+    def wait(condition):
+        for n in range(max_cycles):
+            if condition():
+                return
+            yield from cycle()
+        raise TimeoutError(f'IOBus simulation stalled, {len(received)} bytes received')
+
+    def bench():
+        first = True
+        for step, value in steps:
+            if step == "configure":
+                packet = IOBusModel().configure(**value)
+                value = dict(value)
+                yield scan_mode.eq(value.pop("scan_mode"))
+                yield eight_bit_output.eq(value.pop("eight_bit_output", 0))
+                yield step_size.eq(value.pop("step_size", 1))
+                yield const_dwell_time.eq(value.pop("const_dwell_time", 0))
+                yield boxcar_average.eq(value.pop("boxcar_average", 0))
+                yield compress_output.eq(value.pop("compress_output", 0))
+                yield vector_commands.eq(value.pop("vector_commands", 0))
+                yield serpentine.eq(value.pop("serpentine", 0))
+                for name in names:
+                    yield registers[name].eq(value.get(name, 0))
+                yield from cycle()
+                yield configuration.eq(1)
+                yield from cycle()
+                yield configuration.eq(0)
+                if first:
+                    yield unpause.eq(1)
+                    first = False
+                start = len(received)
+                yield from wait(lambda: packet in received[start:])
+            elif step == "write":
+                outgoing.extend(value)
+            elif step == "read":
+                target = len(received) + value
+                yield from wait(lambda: len(received) >= target)
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(bench)
+    sim.run()
+    return bytes(received)
+
+
+def differential(steps, adc = None):
+    '''
+    Runs steps in the simulation and in IOBusModel, and checks they give
+    the same bytes. Where a config packet lands in the simulated stream
+    depends on timing, so after each, the model is read as far as the
+    simulation got before the next.
+    '''
+    received = simulate(steps, test_mode = None if adc else "data loopback", adc = adc)
+    ## the steps between one configure and the next
+    segments = []
+    for step, value in steps:
+        if step == "configure":
+            segments.append((value, []))
+        elif step == "write":
+            segments[-1][1].append(value)
+    model = IOBusModel(adc)
+    expected = bytearray()
+    position = 0
+    for n, (registers, writes) in enumerate(segments):
+        packet = model.configure(**registers)
+        start = received.find(packet, position)
+        assert start == position, f'config packet {list(packet)} not at byte {position}'
+        if n + 1 < len(segments):
+            end = received.find(IOBusModel().configure(**segments[n + 1][0]), start + len(packet))
+        else:
+            end = len(received)
+        for data in writes:
+            model.write(data)
+        expected += model.read(end - start)
+        position = end
+    if expected != received:
+        mismatch = next((n for n, (a, b) in enumerate(zip(expected, received)) if a != b),
+                        min(len(expected), len(received)))
+        raise AssertionError(f'model and simulation differ at byte {mismatch} of {len(received)}:\n'
+                             f'simulation {list(received[mismatch:mismatch + 24])}\n'
+                             f'model      {list(expected[mismatch:mismatch + 24])}')
+    return received
+
+
+if __name__ == "__main__":
+    import time
+    import struct
+
+    def registers(scan_mode, x, y, eight_bit_output, **limits):
+        ## as ScanGenInterface sets them for an x by y frame
+        return dict(scan_mode = scan_mode, x_full_resolution = x - 1, y_full_resolution = y - 1,
+                    eight_bit_output = eight_bit_output, step_size = 16384//max(x, y), **limits)
+
+    def adc(x_position, y_position):
+        return (x_position*3 + y_position*5) & 0x3FFF
+
+    def test_raster():
+        for eight_bit_output in (1, 0):
+            for limits in ({}, dict(x_lower_limit = 10, x_upper_limit = 30, y_lower_limit = 1, y_upper_limit = 2)):
+                for dwell in (0, 2):
+                    config = registers(1, 100, 4, eight_bit_output, const_dwell_time = dwell, **limits)
+                    differential([("configure", config), ("read", 150)])
+                differential([("configure", config), ("read", 120)], adc = adc)
+                config = registers(1, 100, 4, eight_bit_output, const_dwell_time = 4, boxcar_average = 1, **limits)
+                differential([("configure", config), ("read", 60)], adc = adc)
+        ## reconfiguring while scanning
+        differential([("configure", registers(1, 100, 4, 1)), ("read", 50),
+                      ("configure", registers(1, 80, 3, 0, x_lower_limit = 5, x_upper_limit = 20)), ("read", 60),
+                      ("configure", registers(1, 100, 6, 1)), ("read", 40)])
+        print("raster: OK")
+
+    def test_raster_pattern():
+        dwells = [3, 5, 7, 9, 11, 13, 2, 4, 6, 8, 10, 12, 1, 1, 200, 201, 202, 0x4081]
+        pattern = b"".join(struct.pack("<H", d) for d in dwells)
+        for eight_bit_output in (1, 0):
+            config = registers(2, 100, 4, eight_bit_output, x_lower_limit = 10, x_upper_limit = 20)
+            size = 1 if eight_bit_output else 2
+            differential([("configure", config), ("write", pattern), ("read", len(dwells)*size)])
+            differential([("configure", config), ("write", pattern), ("read", len(dwells)*size)], adc = adc)
+            config = dict(config, boxcar_average = 1)
+            differential([("configure", config), ("write", pattern), ("read", len(dwells)*size)])
+        print("raster pattern: OK")
+
+    def test_vector():
+        points = [(10, 20, 3), (30, 40, 5), (50, 60, 7), (1, 2, 1), (3, 4, 2), (99, 6, 130), (0, 99, 0)]
+        vectors = b"".join(struct.pack("<HHH", *point) for point in points)
+        for eight_bit_output in (1, 0):
+            config = registers(3, 100, 100, eight_bit_output)
+            size = 1 if eight_bit_output else 2
+            differential([("configure", config), ("write", vectors), ("read", len(points)*size)])
+            differential([("configure", config), ("write", vectors), ("read", len(points)*size)], adc = adc)
+        print("vector: OK")
+
+    def test_compressed():
+        ## runs of 8 pixels, pairs of steps of 2 or 3, and steps too big for a pair
+        for x, y, limits in ((2048, 4, dict(x_lower_limit = 100, x_upper_limit = 1000)), (100, 4, {})):
+            config = registers(1, x, y, 1, compress_output = 1, **limits)
+            assert differential([("configure", config), ("read", 120)])[15] == 3
+            differential([("configure", config), ("read", 80)], adc = adc)
+        ## only 8-bit output is compressed
+        config = registers(1, 100, 4, 0, compress_output = 1)
+        assert differential([("configure", config), ("read", 60)])[15] == 0
+        dwells = [1, 2, 3, 4, 5, 6, 64, 65, 66, 67, 68, 68, 68, 68, 30, 0x4081]
+        pattern = b"".join(struct.pack("<H", d) for d in dwells)
+        config = registers(2, 100, 4, 1, compress_output = 1)
+        ## the last pixels are held back
+        model = IOBusModel()
+        model.configure(**config)
+        model.write(pattern)
+        length = len(model.read(len(dwells))) - 18
+        differential([("configure", config), ("write", pattern), ("read", length)])
+        print("compressed: OK")
+
+    def test_vector_commands():
+        from vector_command_decoder import header, POINTS, XY, MOVES, LINE, DWELL
+        commands = (struct.pack("<7H", header(POINTS, 2), 10, 20, 3, 30, 40, 5)
+                    + struct.pack("<Hbb", header(LINE, 5), 1, 0)
+                    + struct.pack("<2H", header(DWELL), 9)
+                    + struct.pack("<H6b", header(MOVES, 3), -1, 2, 0, -3, 5, 1)
+                    + struct.pack("<3H", header(XY, 1), 99, 6)
+                    + struct.pack("<Hbb", header(LINE, 3), -2, -1)
+                    + struct.pack("<4H", header(POINTS, 1), 0, 99, 130))
+        points = 2 + 5 + 3 + 1 + 3 + 1
+        for eight_bit_output in (1, 0):
+            config = registers(3, 100, 100, eight_bit_output, vector_commands = 1)
+            size = 1 if eight_bit_output else 2
+            differential([("configure", config), ("write", commands), ("read", points*size)])
+            differential([("configure", config), ("write", commands), ("read", points*size)], adc = adc)
+        print("vector commands: OK")
+
+    def test_serpentine():
+        ## in data loopback, each pixel is its X DAC code
+        for x, y, limits in ((100, 4, {}), (100, 5, dict(x_lower_limit = 10, x_upper_limit = 30,
+                                                          y_lower_limit = 1, y_upper_limit = 3))):
+            for eight_bit_output in (1, 0):
+                config = registers(1, x, y, eight_bit_output, serpentine = 1, **limits)
+                ## two frames and a bit, across the flyback at the end of the first
+                length = (2*x*y + 30)*(1 if eight_bit_output else 2)
+                received = differential([("configure", config), ("read", length)])
+                assert received[15] == 4 | eight_bit_output
+            differential([("configure", config), ("read", 120)], adc = adc)
+        ## the lines of the region as the beam goes along them; each pixel is twice its x
+        model = IOBusModel()
+        model.configure(**registers(1, 128, 3, 1, serpentine = 1, x_lower_limit = 10, x_upper_limit = 13))
+        pixels = np.frombuffer(model.read(18 + 4*3 + 1)[18:], dtype=np.uint8)
+        assert (pixels//2).tolist() == [0, 11, 12, 13, 13, 12, 11, 10, 10, 11, 12, 13, 10]
+        print("serpentine: OK")
+
+    def bench_model(length = 64 << 20):
+        for eight_bit_output in (1, 0):
+            for name, model in (("data loopback", IOBusModel()), ("adc", IOBusModel(adc))):
+                model.configure(**registers(1, 2048, 2048, eight_bit_output,
+                                            x_lower_limit = 100, x_upper_limit = 1900))
+                start = time.perf_counter()
+                for n in range(length >> 14):
+                    model.read(16384)
+                elapsed = time.perf_counter() - start
+                print(f'raster {8 if eight_bit_output else 16}-bit, {name}: {length/elapsed/1e6:.0f} MB/s')
+        model = IOBusModel()
+        model.configure(**registers(3, 2048, 2048, 1))
+        points = np.random.default_rng(0).integers(0, 2048, (1 << 20, 3), dtype=np.uint16).tobytes()
+        start = time.perf_counter()
+        model.write(points)
+        data = model.read(1 << 20)
+        print(f'vector: {len(points)/(time.perf_counter() - start)/1e6:.0f} MB/s written')
+
+    test_raster()
+    test_raster_pattern()
+    test_vector()
+    test_compressed()
+    test_vector_commands()
+    test_serpentine()
+    bench_model()
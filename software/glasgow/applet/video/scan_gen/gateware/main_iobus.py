@@ -11,11 +11,13 @@ if "glasgow" in __name__: ## running as applet
     from ..gateware.board_sim import OBI_Board
     from ..gateware.beam_controller import BeamController
     from ..gateware.pixel_ratio_interpolator import PixelRatioInterpolator
-    from ..gateware.dwell_averager import DwellTimeAverager
+    from ..gateware.dwell_averager import DwellTimeAverager, TrueDwellTimeAverager
     from ..gateware.stream_reader import StreamReader
     from ..gateware.stream_writer import StreamWriter
     from ..gateware.xy_scan_gen import XY_Scan_Gen
     from ..gateware.byte_swapper import ByteSwapper
+    from ..gateware.pixel_compressor import PixelCompressor
+    from ..gateware.vector_command_decoder import VectorCommandDecoder
 else:
     from board_sim import OBI_Board
     from data_latch_bus import BusMultiplexer
@@ -23,11 +25,13 @@ else:
     from structs import *
     from beam_controller import BeamController
     from pixel_ratio_interpolator import PixelRatioInterpolator
-    from dwell_averager import DwellTimeAverager
+    from dwell_averager import DwellTimeAverager, TrueDwellTimeAverager
     from stream_reader import StreamReader
     from stream_writer import StreamWriter
     from xy_scan_gen import XY_Scan_Gen
     from byte_swapper import ByteSwapper
+    from pixel_compressor import PixelCompressor
+    from vector_command_decoder import VectorCommandDecoder
 
 class IOBus(Elaboratable):
     def __init__(self, in_fifo, out_fifo, scan_mode, 
@@ -39,7 +43,8 @@ class IOBus(Elaboratable):
                 y_lower_limit_b1, y_lower_limit_b2,
                 eight_bit_output, do_frame_sync, do_line_sync,
                 const_dwell_time, configuration, unpause, step_size,
-                is_simulation = True, test_mode = None):
+                is_simulation = True, test_mode = None, boxcar_average = None, compress_output = None,
+                vector_commands = None, serpentine = None):
         ### Build arguments
         self.is_simulation = is_simulation
         self.test_mode = test_mode
@@ -52,8 +57,12 @@ class IOBus(Elaboratable):
 
         self.writer = StreamWriter(scan_dwell_8)
         self.onebyte_writer = StreamWriter(scan_dwell_8_onebyte)
+        ## takes the place of onebyte_writer if compress_output was locked in
+        self.compressor = PixelCompressor()
         self.raster_reader = StreamReader(scan_dwell_8)
         self.vector_reader = StreamReader(scan_point_8)
+        ## takes the place of vector_reader if vector_commands was locked in
+        self.vector_decoder = VectorCommandDecoder()
         
         self.xy_scan_gen = XY_Scan_Gen()
         self.beam_controller = BeamController()
@@ -61,6 +70,8 @@ class IOBus(Elaboratable):
         self.y_interpolator = PixelRatioInterpolator()
         self.byte_replacer = ByteSwapper(test_mode=self.test_mode)
         self.dwell_avgr = DwellTimeAverager()
+        ## driven the same as dwell_avgr; boxcar_average chooses which is output
+        self.boxcar_avgr = TrueDwellTimeAverager()
         #### FIFOs
         self.out_fifo = out_fifo
         self.in_fifo = in_fifo
@@ -68,10 +79,15 @@ class IOBus(Elaboratable):
         ## Top level control of fifo data flow
         self.write_strobe = Signal(reset=0)
         self.read_strobe = Signal()
+        ## in_fifo.w_rdy, and room in the compressor's queue if it is in use
+        self.output_ready = Signal()
 
         self.write_this_point = Signal()
         self.load_next_point = Signal()
         self.reader_data_fresh = Signal()
+        ## the point from vector_reader or vector_decoder
+        self.vector_data = Signal(scan_point_8)
+        self.vector_data_complete = Signal()
 
         #### Registers
         self.scan_mode = scan_mode
@@ -82,6 +98,18 @@ class IOBus(Elaboratable):
         self.unpause = unpause
 
         self.step_size = step_size
+        if boxcar_average is None:
+            boxcar_average = Signal()
+        self.boxcar_average = boxcar_average
+        if compress_output is None:
+            compress_output = Signal()
+        self.compress_output = compress_output
+        if vector_commands is None:
+            vector_commands = Signal()
+        self.vector_commands = vector_commands
+        if serpentine is None:
+            serpentine = Signal()
+        self.serpentine = serpentine
         
         self.x_full_resolution_b1 = x_full_resolution_b1
         self.x_full_resolution_b2 = x_full_resolution_b2
@@ -144,14 +172,17 @@ class IOBus(Elaboratable):
 
         m.submodules["BeamController"] = self.beam_controller
         m.submodules["1byteWriter"] = self.onebyte_writer
+        m.submodules["Compressor"] = self.compressor
         m.submodules["Writer"] = self.writer
         m.submodules["RasterReader"] = self.raster_reader   
         m.submodules["VectorReader"] = self.vector_reader         
+        m.submodules["VectorDecoder"] = self.vector_decoder
         m.submodules["XYScanGen"] = self.xy_scan_gen
         m.submodules["XInt"] = self.x_interpolator
         m.submodules["YInt"] = self.y_interpolator
 
         m.submodules["DwellAvgr"] = self.dwell_avgr
+        m.submodules["BoxcarAvgr"] = self.boxcar_avgr
         m.submodules["ByteReplace"] = self.byte_replacer
         if self.is_simulation:
             m.submodules["OBI_Board"] = self.board
@@ -248,11 +279,17 @@ class IOBus(Elaboratable):
         with m.Else():
             with m.If(self.configuration_flag):
                 m.d.sync += config_flag_latched.eq(1)
-            with m.If(self.config_handler.eight_bit_output_locked):
+            with m.If(self.config_handler.compress_output_locked):
+                ## code the pixels held back, so they go before the config packet
+                m.d.comb += self.compressor.flush.eq(config_flag_latched)
+                with m.If((config_flag_latched) & (self.compressor.data_complete)):
+                    m.d.comb += self.config_handler.configuration_flag.eq(1)
+                    m.d.sync += config_flag_latched.eq(0)
+            with m.Elif(self.config_handler.eight_bit_output_locked):
                 with m.If((config_flag_latched) & (self.onebyte_writer.data_complete)):
                     m.d.comb += self.config_handler.configuration_flag.eq(1)
                     m.d.sync += config_flag_latched.eq(0)
-            with m.If(~(self.config_handler.eight_bit_output_locked)):
+            with m.Else():
                 with m.If((config_flag_latched) & (self.writer.data_complete)):
                     m.d.comb += self.config_handler.configuration_flag.eq(1)
                     m.d.sync += config_flag_latched.eq(0)
@@ -277,12 +314,18 @@ class IOBus(Elaboratable):
             m.d.comb += self.xy_scan_gen.increment.eq(1)
 
         m.d.comb += self.xy_scan_gen.reset.eq(self.handling_config)
+        m.d.comb += self.compressor.reset.eq(self.handling_config)
+        m.d.comb += self.vector_decoder.reset.eq(self.handling_config)
         m.d.comb += self.beam_controller.reset.eq(self.handling_config)
 
         #m.d.comb += self.beam_controller_end_of_dwell.eq(self.mode_ctrl.beam_controller.end_of_dwell)
         #m.d.comb += self.mode_ctrl.const_dwell_time.eq(self.const_dwell_time)
 
         m.d.comb += self.config_handler.eight_bit_output.eq(self.eight_bit_output)
+        m.d.comb += self.config_handler.compress_output.eq(self.compress_output)
+        m.d.comb += self.config_handler.serpentine.eq(self.serpentine)
+        m.d.comb += self.config_handler.vector_commands.eq(self.vector_commands)
+        m.d.comb += self.xy_scan_gen.serpentine.eq(self.config_handler.serpentine_locked)
         #m.d.comb += self.mode_ctrl.eight_bit_output.eq(self.config_handler.eight_bit_output_locked)
 
         m.d.comb += self.config_handler.x_full_frame_resolution_b1.eq(self.x_full_resolution_b1)
@@ -309,7 +352,13 @@ class IOBus(Elaboratable):
 
         #### ===========================MODE CONTROL=================================================
 
-        m.d.comb += self.byte_replacer.point_data.eq(self.dwell_avgr.running_average)
+        m.d.comb += self.boxcar_avgr.pixel_in.eq(self.dwell_avgr.pixel_in)
+        m.d.comb += self.boxcar_avgr.strobe.eq(self.dwell_avgr.strobe)
+        m.d.comb += self.boxcar_avgr.start_new_average.eq(self.dwell_avgr.start_new_average)
+        with m.If(self.boxcar_average):
+            m.d.comb += self.byte_replacer.point_data.eq(self.boxcar_avgr.running_average)
+        with m.Else():
+            m.d.comb += self.byte_replacer.point_data.eq(self.dwell_avgr.running_average)
         m.d.comb += self.byte_replacer.eight_bit_output.eq(self.config_handler.eight_bit_output_locked)
 
         m.d.comb += self.beam_controller.next_x_position.eq(self.x_interpolator.output)
@@ -317,16 +366,24 @@ class IOBus(Elaboratable):
 
         m.d.comb += self.beam_controller.lock_new_point.eq(self.load_next_point)
 
-        with m.If(self.config_handler.eight_bit_output_locked):
+        with m.If(self.config_handler.compress_output_locked):
+            m.d.comb += self.compressor.data_c.eq(self.byte_replacer.processed_point_data.D1)
+            m.d.comb += self.in_fifo.w_data.eq(self.compressor.in_fifo_w_data)
+            m.d.comb += self.compressor.write_happened.eq((self.write_strobe)&(self.unpause))
+            m.d.comb += self.compressor.strobe_in.eq(self.write_this_point)
+            m.d.comb += self.output_ready.eq((self.in_fifo.w_rdy) & (self.compressor.ready))
+        with m.Elif(self.config_handler.eight_bit_output_locked):
             m.d.comb += self.onebyte_writer.data_c.eq(self.byte_replacer.processed_point_data)
             m.d.comb += self.in_fifo.w_data.eq(self.onebyte_writer.in_fifo_w_data)
             m.d.comb += self.onebyte_writer.write_happened.eq((self.write_strobe)&(self.unpause))
             m.d.comb += self.onebyte_writer.strobe_in.eq(self.write_this_point)
+            m.d.comb += self.output_ready.eq(self.in_fifo.w_rdy)
         with m.Else():
             m.d.comb += self.writer.data_c.eq(self.byte_replacer.processed_point_data.D1)
             m.d.comb += self.in_fifo.w_data.eq(self.writer.in_fifo_w_data)
             m.d.comb += self.writer.write_happened.eq((self.write_strobe)&(self.unpause))
             m.d.comb += self.writer.strobe_in.eq(self.write_this_point)
+            m.d.comb += self.output_ready.eq(self.in_fifo.w_rdy)
 
         data_stale = Signal()
 
@@ -348,18 +405,18 @@ class IOBus(Elaboratable):
                 with m.State("Wait for first USB"):
                     with m.If(self.scan_mode == ScanMode.RasterPattern):
                         with m.If(self.raster_reader.data_complete):
-                            m.d.comb += self.beam_controller.dwelling.eq((self.in_fifo.w_rdy) & (self.unpause) & (~(self.handling_config)))
+                            m.d.comb += self.beam_controller.dwelling.eq((self.output_ready) & (self.unpause) & (~(self.handling_config)))
                             m.d.comb += self.load_next_point.eq(1)
                             m.d.comb += self.dwell_avgr.start_new_average.eq(1)
                             m.next = "Patterning"
                     with m.If(self.scan_mode == ScanMode.Vector):
-                        with m.If(self.vector_reader.data_complete):
-                            m.d.comb += self.beam_controller.dwelling.eq((self.in_fifo.w_rdy) & (self.unpause) & (~(self.handling_config)))
+                        with m.If(self.vector_data_complete):
+                            m.d.comb += self.beam_controller.dwelling.eq((self.output_ready) & (self.unpause) & (~(self.handling_config)))
                             m.d.comb += self.load_next_point.eq(1)
                             m.d.comb += self.dwell_avgr.start_new_average.eq(1)
                             m.next = "Patterning"
                 with m.State("Patterning"):
-                    m.d.comb += self.beam_controller.dwelling.eq((self.in_fifo.w_rdy) & (self.unpause) & (~(self.handling_config)))
+                    m.d.comb += self.beam_controller.dwelling.eq((self.output_ready) & (self.unpause) & (~(self.handling_config)))
 
         with m.If((self.scan_mode == ScanMode.Raster)|(self.scan_mode == ScanMode.RasterPattern)):
             #### Interpolation 
@@ -378,7 +435,7 @@ class IOBus(Elaboratable):
 
         with m.If(self.scan_mode == ScanMode.Raster):
             m.d.comb += self.dwell_avgr.start_new_average.eq(self.beam_controller.at_dwell)
-            m.d.comb += self.beam_controller.dwelling.eq((self.in_fifo.w_rdy) & (self.unpause) & ((~self.handling_config))) 
+            m.d.comb += self.beam_controller.dwelling.eq((self.output_ready) & (self.unpause) & ((~self.handling_config))) 
             m.d.comb += self.load_next_point.eq(self.beam_controller.end_of_dwell)
             m.d.comb += self.write_this_point.eq(self.beam_controller.end_of_dwell)
             m.d.comb += self.beam_controller.next_dwell.eq(self.const_dwell_time)
@@ -391,17 +448,30 @@ class IOBus(Elaboratable):
 
             
         with m.If(self.scan_mode == ScanMode.Vector):
-            m.d.comb += self.reader_data_fresh.eq(self.vector_reader.data_fresh)
+            with m.If(self.config_handler.vector_commands_locked):
+                m.d.comb += self.reader_data_fresh.eq(self.vector_decoder.data_fresh)
+                m.d.comb += self.vector_data_complete.eq(self.vector_decoder.data_complete)
+                m.d.comb += self.vector_data.eq(self.vector_decoder.data)
 
-            m.d.comb += self.vector_reader.read_happened.eq(self.read_strobe)
-            m.d.comb += self.vector_reader.out_fifo_r_data.eq(self.out_fifo.r_data)
+                m.d.comb += self.vector_decoder.read_happened.eq(self.read_strobe)
+                m.d.comb += self.vector_decoder.out_fifo_r_data.eq(self.out_fifo.r_data)
 
-            m.d.comb += self.x_interpolator.input.eq(Cat(self.vector_reader.data.X1, self.vector_reader.data.X2))
-            m.d.comb += self.y_interpolator.input.eq(Cat(self.vector_reader.data.Y1, self.vector_reader.data.Y2))
-            m.d.comb += self.beam_controller.next_dwell.eq(Cat(self.vector_reader.data.D1, self.vector_reader.data.D2))
+                with m.If(self.load_next_point):
+                    m.d.comb += self.vector_decoder.data_used.eq(1)
+            with m.Else():
+                m.d.comb += self.reader_data_fresh.eq(self.vector_reader.data_fresh)
+                m.d.comb += self.vector_data_complete.eq(self.vector_reader.data_complete)
+                m.d.comb += self.vector_data.eq(self.vector_reader.data)
 
-            with m.If(self.load_next_point):
-                m.d.comb += self.vector_reader.data_used.eq(1)
+                m.d.comb += self.vector_reader.read_happened.eq(self.read_strobe)
+                m.d.comb += self.vector_reader.out_fifo_r_data.eq(self.out_fifo.r_data)
+
+                with m.If(self.load_next_point):
+                    m.d.comb += self.vector_reader.data_used.eq(1)
+
+            m.d.comb += self.x_interpolator.input.eq(Cat(self.vector_data.X1, self.vector_data.X2))
+            m.d.comb += self.y_interpolator.input.eq(Cat(self.vector_data.Y1, self.vector_data.Y2))
+            m.d.comb += self.beam_controller.next_dwell.eq(Cat(self.vector_data.D1, self.vector_data.D2))
 
         #### =============================================================================
 
@@ -413,6 +483,7 @@ class IOBus(Elaboratable):
             This signal is high when:
                 - the out fifo is ready to be read from, AND
                 - the "reader" module has NOT recieved a complete data point
+                  (or, with vector_commands, vector_decoder asks for a byte)
         read_happened: Signal, 1, out
             This signal is driven by read_strobe
             out_fifo.r_en is also driven by read_strobe
@@ -429,7 +500,10 @@ class IOBus(Elaboratable):
         with m.If(self.scan_mode == ScanMode.RasterPattern):
             m.d.comb += self.read_strobe.eq((~(self.raster_reader.data_complete))&(self.out_fifo.r_rdy))
         with m.Elif(self.scan_mode == ScanMode.Vector): 
-            m.d.comb += self.read_strobe.eq((~(self.vector_reader.data_complete))&(self.out_fifo.r_rdy))
+            with m.If(self.config_handler.vector_commands_locked):
+                m.d.comb += self.read_strobe.eq((self.vector_decoder.read_ready)&(self.out_fifo.r_rdy))
+            with m.Else():
+                m.d.comb += self.read_strobe.eq((~(self.vector_reader.data_complete))&(self.out_fifo.r_rdy))
         with m.Else():
             m.d.comb += self.read_strobe.eq(self.out_fifo.r_rdy)
 
@@ -437,7 +511,10 @@ class IOBus(Elaboratable):
             m.d.comb += self.write_strobe.eq((self.in_fifo.w_rdy) & (self.config_handler.config_data_valid))
             m.d.comb += self.config_handler.write_happened.eq((self.write_strobe) & (self.unpause))
         with m.Else():
-            with m.If(self.config_handler.eight_bit_output_locked):
+            with m.If(self.config_handler.compress_output_locked):
+                m.d.comb += self.write_strobe.eq((self.in_fifo.w_rdy) & (self.compressor.data_valid))
+                m.d.comb += self.compressor.write_happened.eq((self.write_strobe) & (self.unpause))
+            with m.Elif(self.config_handler.eight_bit_output_locked):
                 m.d.comb += self.write_strobe.eq((self.in_fifo.w_rdy) & (self.onebyte_writer.data_valid))
                 m.d.comb += self.onebyte_writer.write_happened.eq((self.write_strobe) & (self.unpause))
             with m.Else():
@@ -466,7 +543,9 @@ class IOBus(Elaboratable):
                 with m.If(self.handling_config):
                     m.d.comb += self.in_fifo.w_data.eq(self.config_handler.in_fifo_w_data)
                 with m.Else():
-                    with m.If(self.config_handler.eight_bit_output_locked):
+                    with m.If(self.config_handler.compress_output_locked):
+                        m.d.comb += self.in_fifo.w_data.eq(self.compressor.in_fifo_w_data)
+                    with m.Elif(self.config_handler.eight_bit_output_locked):
                         m.d.comb += self.in_fifo.w_data.eq(self.onebyte_writer.in_fifo_w_data)
                     with m.Else():
                         m.d.comb += self.in_fifo.w_data.eq(self.writer.in_fifo_w_data)
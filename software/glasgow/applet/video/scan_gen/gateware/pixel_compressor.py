@@ -0,0 +1,324 @@
+import amaranth
+from amaranth import *
+from amaranth.sim import Simulator, Settle
+
+
+## Codes, one byte each. ByteSwapper leaves 7-bit pixels, so a step to any pixel
+## fits in 7 bits, and 0xFF is never a code, so ConfigScanner still finds config
+## packets by their FF FF demarcators. Every code is relative to the previous
+## pixel, so the host decodes with a running sum (see PixelDecoder)
+STEP = 0x00     ## 0ddddddd: one pixel, the previous one + d (7-bit, wrapping)
+PAIR = 0x80     ## 10aaabbb: two pixels, the previous one + a, then + b (-4 to 3 each)
+RUN = 0xC0      ## 11nnnnnn: the previous pixel n + 1 more times, n at most 62
+MAX_RUN = 63
+
+
+def small_delta(pixel, previous):
+    ## the 3-bit two's complement difference, or None if it doesn't fit
+    delta = (pixel - previous) & 0x7F
+    if (delta < 4) | (delta >= 0x7C):
+        return delta & 0x7
+    return None
+
+
+class PixelEncoder:
+    '''
+    PixelCompressor in Python, byte for byte, for the host side tests.
+    encode() takes the pixels as ByteSwapper gives them, and returns the
+    codes for all but the ones held back, which flush() gives up.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.previous = 0
+        self.run = 0
+        self.held = None
+
+    def encode(self, pixels):
+        out = bytearray()
+        for pixel in pixels:
+            pixel = int(pixel) & 0x7F
+            delta = small_delta(pixel, self.previous)
+            if self.held is not None:
+                if delta is not None:
+                    out.append(PAIR | self.held << 3 | delta)
+                else:
+                    out += bytes([STEP | (self.held ^ 4) - 4 & 0x7F,
+                                  STEP | (pixel - self.previous) & 0x7F])
+                self.held = None
+                self.previous = pixel
+            elif self.run:
+                if pixel == self.previous:
+                    self.run += 1
+                    if self.run == MAX_RUN:
+                        out.append(RUN | (self.run - 1))
+                        self.run = 0
+                    continue
+                out.append(RUN | (self.run - 1))
+                self.run = 0
+                if delta is not None:
+                    self.held = delta
+                else:
+                    out.append(STEP | (pixel - self.previous) & 0x7F)
+                self.previous = pixel
+            elif pixel == self.previous:
+                self.run = 1
+            elif delta is not None:
+                self.held = delta
+                self.previous = pixel
+            else:
+                out.append(STEP | (pixel - self.previous) & 0x7F)
+                self.previous = pixel
+        return bytes(out)
+
+    def flush(self):
+        out = b""
+        if self.held is not None:
+            out = bytes([STEP | (self.held ^ 4) - 4 & 0x7F])
+        elif self.run:
+            out = bytes([RUN | (self.run - 1)])
+        self.held = None
+        self.run = 0
+        return out
+
+
+class PixelCompressor(Elaboratable):
+    '''
+    Compresses the 8-bit pixel stream, in place of the one byte StreamWriter,
+    with the same ports. Each pixel is either a step from the one before,
+    half of a pair of small steps, or part of a run of repeats (see the
+    codes above). SEM images are smooth at the scale of a pixel, so unless
+    the noise is more than a few levels, most pixels go as pairs and runs.
+
+    A pixel that could start a pair or a run is held back until the next
+    one shows how to code it, so a pixel makes up to two bytes, or none.
+    They wait in a queue of four bytes for the IN FIFO.
+
+    data_c: Signal, in, 7
+        The pixel from ByteSwapper
+    strobe_in: Signal, in, 1
+        Asserted when valid data is present at data_c
+    in_fifo_w_data: Signal, out, 8
+        The byte at the head of the queue. This signal combinatorially
+        drives the top level in_fifo.w_data
+    data_valid: Signal, out, 1
+        Asserted when the queue is not empty
+    write_happened: Signal, in, 1
+        Asserted when in_fifo_w_data was written to the in_fifo
+    ready: Signal, out, 1
+        Asserted when there is room in the queue for the codes of another
+        pixel. IOBus holds the beam until there is
+    flush: Signal, in, 1
+        Code the pixels held back, without waiting for the next one
+    data_complete: Signal, out, 1
+        Asserted when nothing is held back or queued, and a config packet
+        can be written
+    reset: Signal, in, 1
+        Start over from a previous pixel of 0, dropping what is left, as
+        the host does after each config packet
+
+    previous: Signal, internal, 7
+        The last pixel coded
+    held: Signal, internal, 1
+        previous is held back for a pair, held_delta from the one before
+    run: Signal, internal, 6
+        Repeats of previous held back
+    '''
+    def __init__(self, depth = 4):
+        self.depth = depth
+
+        self.data_c = Signal(7)
+        self.strobe_in = Signal()
+        self.in_fifo_w_data = Signal(8)
+        self.data_valid = Signal()
+        self.write_happened = Signal()
+        self.ready = Signal()
+        self.flush = Signal()
+        self.data_complete = Signal()
+        self.reset = Signal()
+
+        self.previous = Signal(7)
+        self.held = Signal()
+        self.held_delta = Signal(3)
+        self.run = Signal(range(MAX_RUN))
+
+        self.queue = Array(Signal(8, name=f"queue_{n}") for n in range(depth))
+        self.level = Signal(range(depth + 1))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        delta = Signal(7)
+        small = Signal()
+        repeat = Signal()
+        m.d.comb += delta.eq(self.data_c - self.previous)
+        m.d.comb += small.eq((delta < 4) | (delta >= 0x7C))
+        m.d.comb += repeat.eq(self.data_c == self.previous)
+
+        step_held = Signal(8)
+        step_in = Signal(8)
+        run_code = Signal(8)
+        pair_code = Signal(8)
+        m.d.comb += step_held.eq(Cat(self.held_delta, self.held_delta[2].replicate(4)))
+        m.d.comb += step_in.eq(delta)
+        m.d.comb += run_code.eq(RUN | (self.run - 1))
+        m.d.comb += pair_code.eq(Cat(delta[0:3], self.held_delta, Const(PAIR >> 6, 2)))
+
+        ## the codes for this cycle, in order
+        pushes = Signal(2)
+        first = Signal(8)
+        second = Signal(8)
+
+        with m.If(self.strobe_in):
+            with m.If(self.held):
+                m.d.sync += self.held.eq(0)
+                m.d.sync += self.previous.eq(self.data_c)
+                with m.If(small):
+                    m.d.comb += pushes.eq(1)
+                    m.d.comb += first.eq(pair_code)
+                with m.Else():
+                    m.d.comb += pushes.eq(2)
+                    m.d.comb += first.eq(step_held)
+                    m.d.comb += second.eq(step_in)
+            with m.Elif(self.run != 0):
+                with m.If(repeat):
+                    with m.If(self.run == MAX_RUN - 1):
+                        m.d.comb += pushes.eq(1)
+                        m.d.comb += first.eq(RUN | (MAX_RUN - 1))
+                        m.d.sync += self.run.eq(0)
+                    with m.Else():
+                        m.d.sync += self.run.eq(self.run + 1)
+                with m.Else():
+                    m.d.comb += first.eq(run_code)
+                    m.d.sync += self.run.eq(0)
+                    m.d.sync += self.previous.eq(self.data_c)
+                    with m.If(small):
+                        m.d.comb += pushes.eq(1)
+                        m.d.sync += self.held.eq(1)
+                        m.d.sync += self.held_delta.eq(delta[0:3])
+                    with m.Else():
+                        m.d.comb += pushes.eq(2)
+                        m.d.comb += second.eq(step_in)
+            with m.Elif(repeat):
+                m.d.sync += self.run.eq(1)
+            with m.Elif(small):
+                m.d.sync += self.held.eq(1)
+                m.d.sync += self.held_delta.eq(delta[0:3])
+                m.d.sync += self.previous.eq(self.data_c)
+            with m.Else():
+                m.d.comb += pushes.eq(1)
+                m.d.comb += first.eq(step_in)
+                m.d.sync += self.previous.eq(self.data_c)
+        with m.Elif(self.flush):
+            with m.If(self.held):
+                m.d.comb += pushes.eq(1)
+                m.d.comb += first.eq(step_held)
+                m.d.sync += self.held.eq(0)
+            with m.Elif(self.run != 0):
+                m.d.comb += pushes.eq(1)
+                m.d.comb += first.eq(run_code)
+                m.d.sync += self.run.eq(0)
+
+        #### Queue
+        pop = Signal()
+        base = Signal(range(self.depth + 1))
+        m.d.comb += self.data_valid.eq(self.level != 0)
+        m.d.comb += self.in_fifo_w_data.eq(self.queue[0])
+        m.d.comb += pop.eq(self.write_happened & self.data_valid)
+        m.d.comb += base.eq(self.level - pop)
+        m.d.comb += self.ready.eq(self.level <= self.depth - 2)
+        m.d.comb += self.data_complete.eq((self.level == 0) & ~self.held & (self.run == 0) & ~self.strobe_in)
+
+        with m.If(pop):
+            for n in range(self.depth - 1):
+                m.d.sync += self.queue[n].eq(self.queue[n + 1])
+        with m.If(pushes != 0):
+            m.d.sync += self.queue[base].eq(first)
+        with m.If(pushes == 2):
+            m.d.sync += self.queue[base + 1].eq(second)
+        m.d.sync += self.level.eq(base + pushes)
+
+        with m.If(self.reset):
+            m.d.sync += self.previous.eq(0)
+            m.d.sync += self.held.eq(0)
+            m.d.sync += self.run.eq(0)
+            m.d.sync += self.level.eq(0)
+
+        return m
+
+
+if __name__ == "__main__":
+    import numpy as np
+
+    def sem_like_line(rng, length):
+        ## smooth, with noise, flat stretches and the odd edge
+        steps = rng.choice([0, 0, 0, 1, -1, 2, -2, 3, -4, 40], length)
+        steps[rng.random(length) < 0.3] = 0
+        return np.cumsum(steps) & 0x7F
+
+    def test_pixel_compressor():
+        rng = np.random.default_rng(2)
+        pixels = np.concatenate([sem_like_line(rng, 3000), np.full(200, 5),
+                                 rng.integers(0, 128, 300), [0, 0, 1, 127, 127, 0]])
+        dut = PixelCompressor()
+        received = bytearray()
+
+        def bench():
+            def cycle():
+                ## the IN FIFO is not always ready
+                ready = rng.random() < 0.8
+                yield Settle()
+                valid = yield dut.data_valid
+                yield dut.write_happened.eq(ready & valid)
+                if ready & valid:
+                    received.append((yield dut.in_fifo_w_data))
+                yield
+
+            for pixel in pixels:
+                ## as IOBus does, wait for room before the pixel, which ends a dwell
+                yield Settle()
+                while not (yield dut.ready):
+                    yield from cycle()
+                    yield Settle()
+                yield dut.data_c.eq(int(pixel))
+                yield dut.strobe_in.eq(1)
+                yield from cycle()
+                yield dut.strobe_in.eq(0)
+                for n in range(rng.integers(1, 4)):
+                    yield from cycle()
+            yield dut.flush.eq(1)
+            yield Settle()
+            while not (yield dut.data_complete):
+                yield from cycle()
+                yield Settle()
+            yield dut.flush.eq(0)
+            yield from cycle()
+            ## a reset starts over from 0
+            yield dut.reset.eq(1)
+            yield
+            yield dut.reset.eq(0)
+            yield dut.data_c.eq(127)
+            yield dut.strobe_in.eq(1)
+            yield
+            yield dut.strobe_in.eq(0)
+            yield dut.flush.eq(1)
+            for n in range(8):
+                yield from cycle()
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6) # 1 MHz
+        sim.add_sync_process(bench)
+        sim.run()
+
+        encoder = PixelEncoder()
+        expected = encoder.encode(pixels) + encoder.flush()
+        encoder.reset()
+        expected += encoder.encode([127]) + encoder.flush()
+        assert bytes(received) == expected, \
+            f'{len(received)} bytes, expected {len(expected)}, ' \
+            f'first difference at {next(n for n, (a, b) in enumerate(zip(received, expected)) if a != b)}'
+        assert 0xFF not in received
+        print(f'pixel compressor: OK, {len(pixels)} pixels in {len(received)} bytes')
+
+    test_pixel_compressor()
@@ -4,7 +4,8 @@ from amaranth.sim import Simulator
 
 class RampGenerator(Elaboratable):
     """
-    A n-bit up counter with a fixed limit.
+    A n-bit up counter with a fixed limit, that can turn around at its
+    limits instead, and count back down.
 
     Parameters
     ----------
@@ -22,6 +23,14 @@ class RampGenerator(Elaboratable):
         ``ovf`` is asserted when the counter reaches its limit.
     current_count: Signal, out
         The current number that the counter is at
+    bounce : Signal, in
+        If asserted when the counter is incremented at its limit, the
+        counter keeps its value and turns around, rather than starting
+        over at lower_limit
+    down : Signal, out
+        Asserted while the counter is counting down from upper_limit to
+        lower_limit, after turning around. ``ovf`` is then asserted at
+        lower_limit, and ``unf`` above upper_limit
     """
     def __init__(self):
         ## Number of unique steps to count up to
@@ -36,6 +45,9 @@ class RampGenerator(Elaboratable):
         self.current_count = Signal(16)
         self.next_count = Signal(16)
 
+        self.bounce = Signal()
+        self.down = Signal()
+
         self.reset = Signal()
         # # State
         # if isinstance(self.lower_limit, int):
@@ -46,23 +58,32 @@ class RampGenerator(Elaboratable):
     def elaborate(self, platform):
         m = Module()
         ## evaluate whether counter is at its limit
-        m.d.comb += self.ovf.eq(self.current_count >= self.upper_limit)
-        m.d.comb += self.unf.eq(self.current_count < self.lower_limit)
+        with m.If(self.down):
+            m.d.comb += self.ovf.eq(self.current_count <= self.lower_limit)
+            m.d.comb += self.unf.eq(self.current_count > self.upper_limit)
+        with m.Else():
+            m.d.comb += self.ovf.eq(self.current_count >= self.upper_limit)
+            m.d.comb += self.unf.eq(self.current_count < self.lower_limit)
 
         ## incrementing the counter
         with m.If(self.reset):
             m.d.sync += self.current_count.eq(self.lower_limit)
+            m.d.sync += self.down.eq(0)
         with m.Else():
             with m.If(self.increment):
                 with m.If(self.unf):
-                    ## if the counter is at overflow, set it to lower limit
-                    m.d.sync += self.current_count.eq(self.lower_limit)
+                    ## if the counter is outside its limits, start from the one it counts from
+                    m.d.sync += self.current_count.eq(Mux(self.down, self.upper_limit, self.lower_limit))
+                with m.Elif(self.ovf & self.bounce):
+                    ## if the counter is at overflow, turn around
+                    m.d.sync += self.down.eq(~self.down)
                 with m.Elif(self.ovf):
                     ## if the counter is at overflow, set it to lower limit
                     m.d.sync += self.current_count.eq(self.lower_limit)
+                    m.d.sync += self.down.eq(0)
                 with m.Else():
-                    ## else, increment the counter by 1
-                    m.d.comb += self.next_count.eq(self.current_count + 1)
+                    ## else, increment the counter by 1, or decrement it counting down
+                    m.d.comb += self.next_count.eq(Mux(self.down, self.current_count - 1, self.current_count + 1))
                     m.d.sync += self.current_count.eq(self.next_count)
 
 
@@ -21,42 +21,7 @@ from glasgow.support.bits import bits
 
 from test_streams import *
 
-from hilbertcurve.hilbertcurve import HilbertCurve
-
-
-def hilbert(dwell_time = 0):
-    N = 2 # number of dimensions
-
-    #text_file = open("hilbert.txt", "w")
-    points = []
-
-    pmax = 10
-    side = 2**pmax
-    min_coord = 0
-    max_coord = side - 1
-    cmin = min_coord - 0.5
-    cmax = max_coord + 0.5
-
-    offset = 0
-    dx = 0.5
-
-    for p in range(pmax, 0, -1):
-        hc = HilbertCurve(p, N)
-        sidep = 2**p
-
-        npts = 2**(N*p)
-        pts = []
-        for i in range(npts):
-            pt = hc.point_from_distance(i)
-            x = pt[0]*side/sidep + offset
-            y = pt[1]*side/sidep + offset
-            yield int(x)
-            yield int(y)
-            yield dwell_time
-
-        offset += dx
-        dx *= 2
-
+from glasgow.applet.video.scan_gen.pattern_generators.hilbert import hilbert
 
 
 sim_iface = SimulationMultiplexerInterface(ScanGenApplet)
@@ -65,8 +30,9 @@ sim_iface.out_fifo = sim_iface.get_out_fifo(depth = 8)
 # print(vars(ScanGenApplet))
 # print(vars(GlasgowSimulationTarget))
 sim_app_iface = SimulationDemultiplexerInterface(GlasgowHardwareDevice, ScanGenApplet, sim_iface)
+## the simulations below drive the IOBus registers directly, so there are none to write
 sim_scangen_iface = ScanGenInterface(sim_app_iface,sim_app_iface.logger, sim_app_iface.device, 
-                    2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, is_simulation = True)
+                    {}, is_simulation = True)
 
 def vector_pattern_sim(dut):
     for n in range(4): 
@@ -67,7 +67,7 @@ class StreamReader(Elaboratable):
 
         s = Signal()
         fields = list(self.dtype._fields)
-        field_strs = list(fields.keys())
+        field_strs = fields
         first_field = field_strs[0]
         last_field = field_strs[-1]
 
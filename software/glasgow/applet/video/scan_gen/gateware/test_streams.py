@@ -121,17 +121,6 @@ def _fifo_write_vector_point(n, fifo):
     yield from _fifo_write(fifo, d[8:16])
 
 
-def hilbert():
-    stream = open("hilbert.txt")
-    nstream = []
-    for n in stream:
-        data = eval(n.strip(",\n"))
-        #print(data)
-        nstream.append(data)
-
-    print(nstream)
-
-
 if __name__ == "__main__":
     test_raster_pattern_checkerboard(6, 7)
 
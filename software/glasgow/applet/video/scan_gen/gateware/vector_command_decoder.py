@@ -0,0 +1,342 @@
+import amaranth
+from amaranth import *
+from amaranth.sim import Simulator, Settle
+import numpy as np
+
+if "glasgow" in __name__: ## running as applet
+    from ..gateware.structs import *
+else:
+    from structs import *
+
+
+## Commands, in little-endian 16-bit words like vector points. Each starts with
+## a header word: the command in the top 3 bits and a count n in the other 13
+POINTS = 0      ## n x (x, y, dwell): points, as plain vector points are
+XY = 1          ## n x (x, y): points with the dwell time of the last DWELL or POINTS
+MOVES = 2       ## n x (dx, dy): points each a step from the one before, dx and dy
+                ## signed bytes, dx in the low byte
+LINE = 3        ## (dx, dy), once: n points each that step from the one before
+DWELL = 4       ## dwell: the dwell time for XY, MOVES and LINE. n is ignored
+                ## 5 to 7 are reserved, and skipped with no words after them
+MAX_COUNT = 0x1FFF
+
+
+def header(command, count = 0):
+    return command << 13 | count
+
+
+class CommandExpander:
+    '''
+    VectorCommandDecoder in Python, point for point, for the host side
+    tests and IOBusModel. expand() takes the bytes as they are written to
+    the OUT FIFO, and returns the x, y and dwell of each point they make,
+    keeping any part of a command that is not complete yet.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.x = 0
+        self.y = 0
+        self.dwell = 0
+        self._command = None
+        self._count = 0
+        self._partial = bytearray()
+
+    def expand(self, data):
+        self._partial += data
+        buf = self._partial
+        position = 0
+        points = []
+        while True:
+            if self._count == 0:
+                if len(buf) - position < 2:
+                    break
+                word = buf[position] | buf[position + 1] << 8
+                command, count = word >> 13, word & MAX_COUNT
+                if command in (LINE, DWELL):
+                    if len(buf) - position < 4:
+                        break
+                    operand = bytes(buf[position + 2:position + 4])
+                    position += 4
+                    if command == DWELL:
+                        self.dwell = int.from_bytes(operand, "little")
+                    elif count:
+                        dx, dy = np.frombuffer(operand, dtype=np.int8).astype(np.int64)
+                        steps = np.arange(1, count + 1, dtype=np.int64)
+                        points.append(((self.x + steps*dx) & 0xFFFF, (self.y + steps*dy) & 0xFFFF,
+                                       np.full(count, self.dwell, dtype=np.int64)))
+                        self.x, self.y = int(points[-1][0][-1]), int(points[-1][1][-1])
+                    continue
+                position += 2
+                if command < LINE:
+                    self._command, self._count = command, count
+                continue
+            size = {POINTS: 6, XY: 4, MOVES: 2}[self._command]
+            count = min(self._count, (len(buf) - position)//size)
+            if count == 0:
+                break
+            operands = bytes(buf[position:position + count*size])
+            position += count*size
+            self._count -= count
+            if self._command == MOVES:
+                steps = np.frombuffer(operands, dtype=np.int8).reshape(-1, 2).astype(np.int64)
+                x = (self.x + np.cumsum(steps[:, 0])) & 0xFFFF
+                y = (self.y + np.cumsum(steps[:, 1])) & 0xFFFF
+                dwell = np.full(count, self.dwell, dtype=np.int64)
+            else:
+                words = np.frombuffer(operands, dtype="<u2").reshape(-1, size//2).astype(np.int64)
+                x, y = words[:, 0], words[:, 1]
+                if self._command == POINTS:
+                    dwell = words[:, 2]
+                    self.dwell = int(dwell[-1])
+                else:
+                    dwell = np.full(count, self.dwell, dtype=np.int64)
+            self.x, self.y = int(x[-1]), int(y[-1])
+            points.append((x, y, dwell))
+        del buf[:position]
+        if not points:
+            return tuple(np.zeros(0, dtype=np.int64) for n in range(3))
+        return tuple(np.concatenate(column) for column in zip(*points))
+
+
+class VectorCommandDecoder(Elaboratable):
+    '''
+    Expands the vector commands above into points, in place of the
+    scan_point_8 StreamReader, for IOBus in vector mode. Each point is a
+    byte or less of the OUT FIFO in a line or a repeated step, two in a
+    run of small moves, and four with the dwell time left as it was, where
+    a plain vector point is six. The commands are made from points by
+    pattern_generators.vector_commands.
+
+    Points come out as StreamReader's do, with the same handshake, except
+    that IOBus reads the OUT FIFO when read_ready is asserted: the bytes
+    of a command are not always followed by a point.
+
+    out_fifo_r_data: Signal, in, 8
+        This signal is combinatorially driven by the top level out_fifo.r_data
+    read_ready: Signal, out, 1
+        Asserted when the next byte of a command is needed
+    read_happened: Signal, in, 1
+        Asserted when out_fifo_r_data was read from the out_fifo
+    data: Signal, out, scan_point_8
+        The point, with the current position and dwell time
+    data_complete: Signal, out, 1
+        Asserted when data holds a point that has not been used
+    data_fresh: Signal, out, 1
+        The same as data_complete, as for StreamReader
+    data_used: Signal, in, 1
+        Asserted when the point in data is used. The next point of a line
+        is in data on the next cycle
+    reset: Signal, in, 1
+        Drop what is left of the command, and start over at (0, 0) with
+        a dwell time of 0, as after each config packet
+
+    command: Signal, internal, 3
+    count: Signal, internal, 13
+        Points of the command still to come, including the one in data
+    operand: Signal, internal, 48
+        The words of a point, or of a LINE or DWELL, as they are read
+    step_x, step_y: Signal, internal, 8
+        The step of a LINE
+
+    State Machine:
+        Header 1 -> Header 2 -> Operand -> Apply -> Hold
+           ↑-----------↲----------------------↲-------↲
+                                  ↑---------------------↲
+    '''
+    def __init__(self):
+        self.out_fifo_r_data = Signal(8)
+        self.read_ready = Signal()
+        self.read_happened = Signal()
+        self.data = Signal(scan_point_8)
+        self.data_complete = Signal()
+        self.data_fresh = Signal()
+        self.data_used = Signal()
+        self.reset = Signal()
+
+        self.x = Signal(16)
+        self.y = Signal(16)
+        self.dwell = Signal(16)
+
+        self.command = Signal(3)
+        self.count = Signal(13)
+        self.header_lo = Signal(8)
+        self.operand = Signal(48)
+        self.index = Signal(range(6))
+        self.step_x = Signal(8)
+        self.step_y = Signal(8)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.d.comb += self.data.eq(Cat(self.x, self.y, self.dwell))
+
+        ## bytes in the operand of each command
+        length = Signal(range(7))
+        with m.Switch(self.command):
+            with m.Case(POINTS):
+                m.d.comb += length.eq(6)
+            with m.Case(XY):
+                m.d.comb += length.eq(4)
+            with m.Default():
+                m.d.comb += length.eq(2)
+
+        new_command = Signal(3)
+        new_count = Signal(13)
+        m.d.comb += new_command.eq(self.out_fifo_r_data[5:8])
+        m.d.comb += new_count.eq(Cat(self.header_lo, self.out_fifo_r_data[0:5]))
+
+        move_x = Signal(16)
+        move_y = Signal(16)
+
+        with m.FSM() as fsm:
+            with m.State("Header 1"):
+                m.d.comb += self.read_ready.eq(1)
+                with m.If(self.read_happened):
+                    m.d.sync += self.header_lo.eq(self.out_fifo_r_data)
+                    m.next = "Header 2"
+            with m.State("Header 2"):
+                m.d.comb += self.read_ready.eq(1)
+                with m.If(self.read_happened):
+                    m.d.sync += self.command.eq(new_command)
+                    m.d.sync += self.count.eq(new_count)
+                    m.d.sync += self.index.eq(0)
+                    with m.If((new_command == LINE) | (new_command == DWELL)):
+                        m.next = "Operand"
+                    with m.Elif((new_command < LINE) & (new_count != 0)):
+                        m.next = "Operand"
+                    with m.Else():
+                        m.next = "Header 1"
+            with m.State("Operand"):
+                m.d.comb += self.read_ready.eq(1)
+                with m.If(self.read_happened):
+                    m.d.sync += self.operand.word_select(self.index, 8).eq(self.out_fifo_r_data)
+                    m.d.sync += self.index.eq(self.index + 1)
+                    with m.If(self.index == length - 1):
+                        m.next = "Apply"
+            with m.State("Apply"):
+                m.d.comb += move_x.eq(self.x + self.operand[0:8].as_signed())
+                m.d.comb += move_y.eq(self.y + self.operand[8:16].as_signed())
+                m.next = "Hold"
+                with m.Switch(self.command):
+                    with m.Case(POINTS):
+                        m.d.sync += self.x.eq(self.operand[0:16])
+                        m.d.sync += self.y.eq(self.operand[16:32])
+                        m.d.sync += self.dwell.eq(self.operand[32:48])
+                    with m.Case(XY):
+                        m.d.sync += self.x.eq(self.operand[0:16])
+                        m.d.sync += self.y.eq(self.operand[16:32])
+                    with m.Case(MOVES):
+                        m.d.sync += self.x.eq(move_x)
+                        m.d.sync += self.y.eq(move_y)
+                    with m.Case(LINE):
+                        m.d.sync += self.step_x.eq(self.operand[0:8])
+                        m.d.sync += self.step_y.eq(self.operand[8:16])
+                        with m.If(self.count != 0):
+                            m.d.sync += self.x.eq(move_x)
+                            m.d.sync += self.y.eq(move_y)
+                        with m.Else():
+                            m.next = "Header 1"
+                    with m.Case(DWELL):
+                        m.d.sync += self.dwell.eq(self.operand[0:16])
+                        m.next = "Header 1"
+            with m.State("Hold"):
+                m.d.comb += self.data_complete.eq(1)
+                m.d.comb += self.data_fresh.eq(1)
+                with m.If(self.data_used):
+                    m.d.sync += self.count.eq(self.count - 1)
+                    m.d.sync += self.index.eq(0)
+                    with m.If(self.count == 1):
+                        m.next = "Header 1"
+                    with m.Elif(self.command == LINE):
+                        m.d.sync += self.x.eq(self.x + self.step_x.as_signed())
+                        m.d.sync += self.y.eq(self.y + self.step_y.as_signed())
+                    with m.Else():
+                        m.next = "Operand"
+
+        ## back to the reset value of everything, FSM included
+        return ResetInserter(self.reset)(m)
+
+
+if __name__ == "__main__":
+    import struct
+
+    def words(*values):
+        return struct.pack(f"<{len(values)}H", *values)
+
+    def moves(*steps):
+        return b"".join(struct.pack("<bb", *step) for step in steps)
+
+    commands = (words(header(POINTS, 2), 10, 20, 3, 30, 40, 5)
+                + words(header(LINE, 4)) + moves((1, 0))
+                + words(header(DWELL), 7)
+                + words(header(MOVES, 3)) + moves((-1, 2), (0, -128), (127, 1))
+                + words(header(XY, 1), 1000, 0xFFFF)
+                + words(header(LINE, 2)) + moves((2, 1))
+                + words(header(7, 5), header(XY), header(LINE)) + moves((3, 3))
+                + words(header(POINTS, 1), 5, 6, 0x4081))
+
+    def test_command_expander():
+        expected = [(10, 20, 3), (30, 40, 5), (31, 40, 5), (32, 40, 5), (33, 40, 5), (34, 40, 5),
+                    (33, 42, 7), (33, 0xFFFF - 85, 7), (160, 0xFFFF - 84, 7), (1000, 0xFFFF, 7),
+                    (1002, 0, 7), (1004, 1, 7), (5, 6, 0x4081)]
+        x, y, dwell = CommandExpander().expand(commands)
+        assert list(zip(x.tolist(), y.tolist(), dwell.tolist())) == expected
+        ## the same points, however the commands are split
+        expander = CommandExpander()
+        parts = [expander.expand(commands[n:n + 3]) for n in range(0, len(commands), 3)]
+        assert np.concatenate([part[0] for part in parts]).tolist() == x.tolist()
+        assert np.concatenate([part[2] for part in parts]).tolist() == dwell.tolist()
+        print("command expander: OK")
+
+    def test_vector_command_decoder():
+        rng = np.random.default_rng(5)
+        stream = commands*3
+        dut = VectorCommandDecoder()
+        received = []
+
+        def bench():
+            position = 0
+            while position < len(stream) or len(received) < 3*13:
+                ## the OUT FIFO is not always ready, nor is the beam
+                yield Settle()
+                ready = (position < len(stream)) & (rng.random() < 0.7)
+                read = ready & (yield dut.read_ready)
+                yield dut.out_fifo_r_data.eq(stream[position] if read else 0)
+                yield dut.read_happened.eq(read)
+                position += read
+                used = (yield dut.data_fresh) & (rng.random() < 0.5)
+                if used:
+                    received.append(((yield dut.data.X1) | (yield dut.data.X2) << 8,
+                                     (yield dut.data.Y1) | (yield dut.data.Y2) << 8,
+                                     (yield dut.data.D1) | (yield dut.data.D2) << 8))
+                yield dut.data_used.eq(used)
+                yield
+            yield dut.data_used.eq(0)
+            yield dut.read_happened.eq(0)
+            ## a reset starts over at (0, 0)
+            yield dut.reset.eq(1)
+            yield
+            yield dut.reset.eq(0)
+            for byte in words(header(LINE, 1)) + moves((1, 2)):
+                yield dut.out_fifo_r_data.eq(byte)
+                yield dut.read_happened.eq(1)
+                yield
+            yield dut.read_happened.eq(0)
+            for n in range(3):
+                yield
+            assert (yield dut.data_fresh)
+            received.append(((yield dut.data.X1), (yield dut.data.Y1), (yield dut.data.D1)))
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6) # 1 MHz
+        sim.add_sync_process(bench)
+        sim.run()
+
+        x, y, dwell = CommandExpander().expand(stream)
+        assert received == list(zip(x.tolist(), y.tolist(), dwell.tolist())) + [(1, 2, 0)]
+        print(f'vector command decoder: OK, {len(x)} points from {len(stream)} bytes')
+
+    test_command_expander()
+    test_vector_command_decoder()
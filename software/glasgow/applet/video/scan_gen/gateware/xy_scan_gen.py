@@ -1,6 +1,6 @@
 import amaranth
 from amaranth import *
-from amaranth.sim import Simulator
+from amaranth.sim import Simulator, Settle
 
 if "glasgow" in __name__: ## running as applet
     from ..gateware.ramp_generator import RampGenerator
@@ -14,6 +14,16 @@ class XY_Scan_Gen(Elaboratable):
 
     increment: Signal, in, 1
         If high, the x_counter will be incremented
+    serpentine: Signal, in, 1
+        If high, the x counter turns around at the end of each line rather
+        than flying back, so every other line is scanned right to left.
+        Each frame still starts at the top left, scanning right
+    reversed: Signal, out, 1
+        High while a line is scanned right to left
+
+        serpentine, 3 lines:    0 1 2 3
+                                7 6 5 4
+                                8 9 ...
     line_sync: Signal, out, 1
         Asserted if the x counter is in overflow
     frame_sync: Signal, out, 1
@@ -63,6 +73,8 @@ class XY_Scan_Gen(Elaboratable):
         self.y_counter = RampGenerator()
 
         self.increment = Signal()
+        self.serpentine = Signal()
+        self.reversed = Signal()
         self.frame_sync = Signal()
         self.line_sync = Signal()
 
@@ -98,6 +110,10 @@ class XY_Scan_Gen(Elaboratable):
             m.d.comb += self.x_counter.reset.eq(1)
             m.d.comb += self.y_counter.reset.eq(1)
 
+        ## the last line of a frame flies back, so the next frame starts at the left
+        m.d.comb += self.x_counter.bounce.eq((self.serpentine) & ~(self.y_counter.ovf))
+        m.d.comb += self.reversed.eq(self.x_counter.down)
+
         with m.If(self.x_full_frame_resolution >= self.y_full_frame_resolution):
             #m.d.comb += self.full_frame_size.eq(self.x_full_frame_resolution)
             m.d.comb += self.x_bigger.eq(1)
@@ -290,10 +306,10 @@ def sim_scangenerator():
         test_y_lower = 2
         test_y_upper = 5
 
-        yield dut.x_lower_limit.eq(test_x_lower)
-        yield dut.y_lower_limit.eq(test_y_lower)
-        yield dut.x_upper_limit.eq(test_x_upper)
-        yield dut.y_upper_limit.eq(test_y_upper)
+        yield dut.x_counter.lower_limit.eq(test_x_lower)
+        yield dut.y_counter.lower_limit.eq(test_y_lower)
+        yield dut.x_counter.upper_limit.eq(test_x_upper)
+        yield dut.y_counter.upper_limit.eq(test_y_upper)
         #yield
 
         for n in range(10*10):
@@ -309,6 +325,50 @@ def sim_scangenerator():
     with sim.write_vcd("xy_scan_gen_sim.vcd"):
         sim.run()
 
+def test_serpentine():
+    dut = XY_Scan_Gen()
+    ## lines of the region, then of the full frame
+    regions = [(3, 7, 2, 5), (0, 4, 0, 3)]
+    visited = []
+
+    def bench():
+        yield dut.serpentine.eq(1)
+        for x_lower, x_upper, y_lower, y_upper in regions:
+            yield dut.x_counter.lower_limit.eq(x_lower)
+            yield dut.x_counter.upper_limit.eq(x_upper)
+            yield dut.y_counter.lower_limit.eq(y_lower)
+            yield dut.y_counter.upper_limit.eq(y_upper)
+            yield dut.reset.eq(1)
+            yield
+            yield dut.reset.eq(0)
+            ## two frames, one point a cycle
+            yield dut.increment.eq(1)
+            for n in range(2*(x_upper - x_lower + 1)*(y_upper - y_lower + 1)):
+                yield
+                yield Settle()
+                visited.append(((yield dut.current_x), (yield dut.current_y), (yield dut.reversed)))
+            yield dut.increment.eq(0)
+            yield
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6) # 1 MHz
+    sim.add_sync_process(bench)
+    sim.run()
+
+    expected = []
+    for x_lower, x_upper, y_lower, y_upper in regions:
+        frame = []
+        for y in range(y_lower, y_upper + 1):
+            line = list(range(x_lower, x_upper + 1))
+            reversed_line = (y - y_lower) % 2
+            frame += [(x, y, reversed_line) for x in (line[::-1] if reversed_line else line)]
+        ## the reset leaves the counters at the first point, and the first increment moves on
+        expected += (frame*3)[1:1 + 2*len(frame)]
+    ## reversed changes with the increment that starts the line, as y does
+    assert visited == expected, next((n, a, b) for n, (a, b) in enumerate(zip(visited, expected)) if a != b)
+    print("serpentine: OK")
+
 if __name__ == "__main__":
     #test_scangenerator_new()
-    sim_scangenerator()
\ No newline at end of file
+    sim_scangenerator()
+    test_serpentine()
\ No newline at end of file
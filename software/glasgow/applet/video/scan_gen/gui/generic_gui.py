@@ -62,6 +62,21 @@ class ScanMainWindow(QWidget):
         self.save_btn = QPushButton("Save")
         self.save_btn.clicked.connect(self.image_display.saveImage_PIL)
 
+        ## host-side frame integration, see FrameIntegrator
+        self.integration_dropdown = QComboBox()
+        self.integration_dropdown.addItem("No Integration")
+        self.integration_dropdown.addItem("Frame Average")
+        self.integration_dropdown.addItem("Running Average")
+        self.integration_dropdown.addItem("Line Average")
+        self.integration_dropdown.addItem("Maximum")
+        self.integration_frames = QSpinBox()
+        self.integration_frames.setRange(1, 256)
+        self.integration_frames.setValue(4)
+
+        ## append each completed frame to an OME-TIFF file while checked
+        self.record_btn = QPushButton("Record")
+        self.record_btn.setCheckable(True)
+
 
         mode_options = QGridLayout()
         mode_options.addWidget(self.conn_btn,0,0)
@@ -71,6 +86,9 @@ class ScanMainWindow(QWidget):
         mode_options.addWidget(self.roi_btn,0,4)
         mode_options.addWidget(self.upload_pattern_btn, 0, 5)
         mode_options.addWidget(self.save_btn, 0, 6)
+        mode_options.addWidget(self.integration_dropdown, 0, 7)
+        mode_options.addWidget(self.integration_frames, 0, 8)
+        mode_options.addWidget(self.record_btn, 0, 9)
 
         self.layout.addLayout(mode_options,0,0)
 
@@ -9,22 +9,27 @@ from PyQt6.QtWidgets import (QMainWindow, QPushButton,
                             QGridLayout, QWidget, QComboBox, 
                             QLabel, QSpinBox, QFileDialog)
 
+if __name__ == "__main__":
+    path = os.path.split(sys.path[0])[0]
+    sys.path.append(path)
+
 from modules import ImageDisplay
+from interface.frame_ring import FrameRing, DEFAULT_NAME
 
 
 class MainWindow(QWidget):
-    def __init__(self, path):
+    def __init__(self, ring_name):
         super().__init__()
-        self.path = path
+        self.ring_name = ring_name
+        self.ring = None
+        self.frame_number = None
         self.layout = QGridLayout()
         self.setLayout(self.layout)
 
         l = QLabel(sys.prefix)
         self.layout.addWidget(l)
         
-        self.dimension = self.get_dimensions()
-        self.FrameBufDirectory = self.get_buffer()
-        self.image_display = ImageDisplay(self.dimension, self.dimension)
+        self.image_display = ImageDisplay(512, 512)
         self.layout.addWidget(self.image_display, 1, 0)
 
         elapsed = 0
@@ -34,23 +39,28 @@ class MainWindow(QWidget):
         # not using QTimer.singleShot() because of persistence on PyQt. see PR #1605
         self.startUpdating()
     
-    def get_dimensions(self):
-        settings = np.loadtxt(os.path.join(self.path, "current_display_setting"))
-        dimension = int(settings)
-        return dimension
-    def get_buffer(self):
-        FrameBufDirectory = os.path.join(self.path, "current_frame")
-        return FrameBufDirectory
+    def attach(self):
+        ## the applet may not have created the ring yet, or may have replaced it
+        if self.ring is not None and self.ring.closed:
+            self.ring.close()
+            self.ring = None
+        if self.ring is None:
+            try:
+                self.ring = FrameRing.attach(self.ring_name)
+            except FileNotFoundError:
+                return None
+            self.frame_number = None
+        return self.ring
 
     def updateData(self):
-        d = np.memmap(self.FrameBufDirectory, shape = (self.dimension*self.dimension),mode = "r+")
-        data = np.reshape(d,(self.dimension,self.dimension))
-        #data = np.random.rand(dimension,dimension)
+        ring = self.attach()
+        frame = ring.latest() if ring is not None else None
+        if frame is not None and frame.number != self.frame_number:
+            ## the frame is displayed straight from shared memory
+            self.image_display.live_img.setImage(frame.pixels) #this is the correct orientation to display the image
+            if frame.valid():
+                self.frame_number = frame.number
 
-        print(data)
-        print(data.shape)
-        self.image_display.live_img.setImage(data) #this is the correct orientation to display the image
-        
         self.timer.start(1)
 
     def startUpdating(self):
@@ -58,13 +68,32 @@ class MainWindow(QWidget):
         self.updateData()
 
 
-def run_gui(path):
+def run_gui(ring_name):
     app = pg.mkQApp("Scan Live View")
-    w = MainWindow(path)
+    w = MainWindow(ring_name)
     w.show()
     pg.exec()
 
 
 if __name__ == '__main__':
-    run_gui(os.getcwd())
+    def test_local_gui():
+        name = f"scan_gen_gui_test_{os.getpid()}"
+        app = pg.mkQApp("Scan Live View")
+        w = MainWindow(name)
+        w.timer.stop()
+        ## no ring yet: the view keeps polling
+        assert w.ring is None and w.frame_number is None
+        with FrameRing.create(name, max_width=64, max_height=32) as writer:
+            writer.publish(np.full((32, 64), 7, np.uint8))
+            w.updateData()
+            w.timer.stop()
+            assert w.ring is not None and w.frame_number == 0
+            assert (w.image_display.live_img.image == 7).all()
+            w.ring.close()
+        print("local gui: OK")
+
+    if sys.argv[1:] == ["--test"]:
+        test_local_gui()
+    else:
+        run_gui(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_NAME)
 
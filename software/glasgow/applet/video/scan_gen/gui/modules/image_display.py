@@ -11,9 +11,15 @@ from PyQt6.QtWidgets import (QHBoxLayout, QMainWindow,
                              QSpinBox)
 
 from PIL import Image
-import tifffile
+from interface.image_pyramid import ImagePyramid
+from interface.ome_tiff_export import OmeTiffWriter
 
 
+## pixels per side of each ImageItem in ImageDisplay.updateRows
+TILE_SIZE = 256
+## hidden tile items kept around for reuse while panning and zooming
+TILE_POOL_SIZE = 64
+
 class MicroScaleBar(pg.ScaleBar):
     def __init__(self, pixel_size, **kwargs):
         scale_bar_pixels = 200
@@ -64,6 +70,16 @@ class ImageDisplay(pg.GraphicsLayoutWidget):
 
         self.hist.setLevels(min=0,max=255)
 
+        ## for updateRows: the image shown as tiles of an image pyramid, so that only
+        ## the tiles in view, at the level of detail the zoom calls for, are drawn
+        self.pyramid = None
+        self.tiled = False
+        self.tiles = {}
+        self.tile_pool = []
+        self.hist.sigLevelsChanged.connect(self.syncTiles)
+        self.hist.sigLookupTableChanged.connect(self.syncTiles)
+        self.image_view.sigRangeChanged.connect(self.updateTiles)
+
         self.roi = None
 
         ### reverse the default LUT
@@ -119,8 +135,91 @@ class ImageDisplay(pg.GraphicsLayoutWidget):
         self.live_img.setImage(image, rect = (0,0, x_width, y_height), autoLevels=False)
         if not self.roi == None:
             self.roi.maxBounds = QtCore.QRectF(0, 0, x_width, y_height)
+        resized = self.data is None or self.data.shape != image.shape
         self.data = image
-        self.image_view.autoRange()
+        self.pyramid = None
+        if self.tiled:
+            self.clearTiles()
+            self.pyramid = ImagePyramid(image, TILE_SIZE)
+        if resized and self.tiled:
+            ## live_img is hidden, so autoRange would not see the image
+            self.setRange(y_height, x_width)
+        elif resized:
+            self.image_view.autoRange()
+        self.updateTiles()
+
+    def updateRows(self, image, start, stop):
+        '''
+        Redraw rows [start, stop) of image. The rows are folded into the image
+        pyramid, and of the tiles that depend on them only those in view are
+        converted and uploaded again, so the cost follows the number of changed
+        rows and the size of the view rather than the size of the frame. A new
+        or resized image is shown with setImage.
+        '''
+        if not self.tiled:
+            ## the tiles are drawn instead; live_img still holds the whole image,
+            ## for the histogram and for saving
+            self.tiled = True
+            self.live_img.hide()
+            self.data = None
+        if image is not self.data:
+            self.setImage(*image.shape, image)
+        else:
+            self.pyramid.update_rows(start, stop)
+            self.updateTiles()
+
+    def setTileImage(self, item, key):
+        item.setImage(self.pyramid.tile(*key), rect = self.pyramid.tile_rect(*key),
+                      autoLevels=False, levels=self.live_img.levels, lut=self.live_img.lut)
+
+    def updateTiles(self):
+        if self.pyramid is None:
+            return
+        (x0, x1), (y0, y1) = self.image_view.viewRange()
+        level = self.pyramid.level_for_scale((x1 - x0)/max(self.image_view.width(), 1))
+        tile_rows, tile_columns = self.pyramid.visible_tiles(level, x0, x1, y0, y1)
+        ## tiles that were already shown are only redrawn if they changed
+        dirty = set(self.pyramid.take_dirty(level, tile_rows, tile_columns))
+        visible = set()
+        for ty in tile_rows:
+            for tx in tile_columns:
+                key = (level, ty, tx)
+                visible.add(key)
+                if key not in self.tiles:
+                    if self.tile_pool:
+                        item = self.tile_pool.pop()
+                    else:
+                        item = pg.ImageItem(axisOrder="row-major")
+                        self.image_view.addItem(item)
+                    self.setTileImage(item, key)
+                    item.show()
+                    self.tiles[key] = item
+                elif (ty, tx) in dirty:
+                    self.tiles[key].setImage(self.pyramid.tile(*key), autoLevels=False)
+        for key in list(self.tiles):
+            if key not in visible:
+                self.hideTile(self.tiles.pop(key))
+
+    def hideTile(self, item):
+        item.hide()
+        if len(self.tile_pool) < TILE_POOL_SIZE:
+            self.tile_pool.append(item)
+        else:
+            self.image_view.removeItem(item)
+
+    def clearTiles(self):
+        for item in self.tiles.values():
+            self.hideTile(item)
+        self.tiles = {}
+
+    def syncTiles(self):
+        for item in [*self.tiles.values(), *self.tile_pool]:
+            item.setLevels(self.live_img.levels)
+            item.setLookupTable(self.live_img.lut)
+
+    def updateHistogram(self):
+        ## the histogram follows live_img, which updateRows does not touch
+        self.live_img.setImage(self.data, autoLevels=False)
 
 
     def setRange(self, y_height, x_width):
@@ -148,11 +247,11 @@ class ImageDisplay(pg.GraphicsLayoutWidget):
         image.save(img_name)
         print(img_name)
 
-    def saveImage_tifffile(self):
-        image = self.live_img.image
-        metadata = [(3, 1, 1, 100)]
-        img_name = "saved" + datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + ".tif"
-        tifffile.imwrite(img_name, image, shape = (self.x_width, self.y_height), dtype = np.uint8, extratags = metadata)
+    def saveImage_tifffile(self, parameters = {}):
+        img_name = "saved" + datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + ".ome.tif"
+        with OmeTiffWriter(img_name) as writer:
+            writer.write_frame(self.live_img.image, parameters)
+        print(img_name)
 
 
 
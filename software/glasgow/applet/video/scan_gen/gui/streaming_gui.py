@@ -11,6 +11,7 @@ import sys
 from PIL import Image
 
 import os, datetime
+import time
 
 import numpy as np
 
@@ -33,6 +34,7 @@ if __name__ == "__main__":
     sys.path.append(path)
 
     from interface.scan_socket import ScanInterface
+    from interface.ome_tiff_export import OmeTiffWriter
     from modules.image_display import ImageDisplay
     from modules.frame_settings import FrameSettings, RegisterUpdateBox
     from generic_gui import ScanMainWindow
@@ -56,16 +58,14 @@ class StreamFrameSettings(FrameSettings):
     @asyncSlot()
     async def set_x(self):
         xval = self.rx.getval()
-        await self.con.set_x_resolution(xval)
-        await self.con.set_ROI(0,0,0,0)
-        await self.con.strobe_config()
+        ctrl = self.con.scan_ctrl
+        await self.con.send(ctrl.set_x_resolution(xval), ctrl.set_ROI(0,0,0,0), ctrl.strobe_config())
 
     @asyncSlot()
     async def set_y(self):
         yval = self.ry.getval()
-        await self.con.set_y_resolution(yval)
-        await self.con.set_ROI(0,0,0,0)
-        await self.con.strobe_config()
+        ctrl = self.con.scan_ctrl
+        await self.con.send(ctrl.set_y_resolution(yval), ctrl.set_ROI(0,0,0,0), ctrl.strobe_config())
 
     @asyncSlot()
     async def set_dwell(self):
@@ -75,10 +75,17 @@ class StreamFrameSettings(FrameSettings):
 
 class MainWindow(ScanMainWindow):
 
-    def __init__(self, con):
+    def __init__(self, con, max_fps = 30):
         self.con = con
         frame_settings = StreamFrameSettings(con)
         super().__init__(frame_settings)
+
+        ## redraw what changed at most max_fps times a second, from the Qt event
+        ## loop, instead of as often as the asyncio loop comes around
+        self.update_timer = QtCore.QTimer()
+        self.update_timer.setInterval(round(1000/max_fps))
+        self.update_timer.timeout.connect(self.updateData)
+        self.last_histogram_update = 0
         self.conn_btn.clicked.connect(self.connect)
 
         self.frame_settings.pattern_settings.dropdown.currentIndexChanged.connect(self.set_pattern)
@@ -88,6 +95,12 @@ class MainWindow(ScanMainWindow):
         self.start_btn.clicked.connect(self.toggle_scan)
 
         self.reset_btn.clicked.connect(self.reset_display)
+
+        self.integration_dropdown.currentIndexChanged.connect(self.set_integration)
+        self.integration_frames.valueChanged.connect(self.set_integration)
+
+        self.recorder = None
+        self.record_btn.clicked.connect(self.toggle_recording)
         
         self.setState("disconnected")
 
@@ -102,17 +115,52 @@ class MainWindow(ScanMainWindow):
         self.con.set_patterngen(gen1)
         self.con.scan_stream.patterngen = gen2
 
-    @asyncSlot()
-    async def reset_display(self):
+    def set_integration(self):
+        mode = [None, "average", "ema", "line", "max"][self.integration_dropdown.currentIndex()]
+        self.con.scan_stream.set_integration(mode, self.integration_frames.value())
+        self.updateData()
+
+    def toggle_recording(self):
+        scan_stream = self.con.scan_stream
+        if self.record_btn.isChecked():
+            path = "scan" + datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + ".ome.tif"
+            self.recorder = OmeTiffWriter(path)
+            self.recorder.start()
+            scan_stream.frame_listeners.append(self.record_frame)
+            print(f'recording to {path}')
+        else:
+            self.stop_recording()
+
+    def record_frame(self, frame, parameters):
+        ## the dwell time is not in the config packet, so it is taken from the settings
+        parameters = {**parameters, "dwell_time": self.frame_settings.dwell.getval()}
+        try:
+            self.recorder.submit(frame, parameters)
+        except Exception:
+            ## not while the stream is going through its frame listeners
+            self.record_btn.setChecked(False)
+            QtCore.QTimer.singleShot(0, self.stop_recording)
+
+    def stop_recording(self):
+        if self.recorder is None:
+            return
+        self.con.scan_stream.frame_listeners.remove(self.record_frame)
+        recorder, self.recorder = self.recorder, None
+        try:
+            recorder.close()
+        except Exception as error:
+            print(f'recording to {recorder.path} failed: {error}')
+
+    def reset_display(self):
         self.con.scan_stream.clear_buffer()
-        await self.updateData()
+        self.updateData()
     
 
     @asyncSlot()
     async def set_ROI(self):
         x_upper, x_lower, y_upper, y_lower = self.image_display.get_ROI()
-        await self.con.set_ROI(x_lower, x_upper, y_lower, y_upper)
-        await self.con.strobe_config()
+        ctrl = self.con.scan_ctrl
+        await self.con.send(ctrl.set_ROI(x_lower, x_upper, y_lower, y_upper), ctrl.strobe_config())
 
     @asyncSlot()
     async def connect(self):
@@ -133,13 +181,15 @@ class MainWindow(ScanMainWindow):
     @asyncSlot()
     async def set_scan_mode(self):
         mode = self.mode_select_dropdown.currentIndex() + 1
-        await self.con.set_scan_mode(mode)
+        self.con.scan_mode = mode
+        ctrl = self.con.scan_ctrl
+        cmds = [ctrl.set_scan_mode(mode)]
         if mode == 1:
-            await self.con.set_8bit_output()
+            cmds.append(ctrl.set_8bit_output())
         if mode == 3:
             self.set_pattern()
-            await self.con.set_16bit_output()
-        await self.con.strobe_config()
+            cmds.append(ctrl.set_16bit_output())
+        await self.con.send(*cmds, ctrl.strobe_config())
         
 
         
@@ -153,7 +203,7 @@ class MainWindow(ScanMainWindow):
             if (mode == 3) | (mode == 2):
                 self.con.stream_pattern = True
                 await self.con.write_points("*")
-            self.update_continously = asyncio.ensure_future(self.keepUpdating())
+            self.update_timer.start()
             self.setState("scanning")
             self.start_btn.setText('⏸️')
 
@@ -162,21 +212,20 @@ class MainWindow(ScanMainWindow):
             self.start_btn.setText('🔄')
             self.con.stream_pattern = False
             await self.con.pause()
-            self.update_continously.cancel()
+            self.update_timer.stop()
+            self.updateData()
             self.setState("scan_paused")
             self.start_btn.setText('▶️')
 
-    async def keepUpdating(self):
-        while True:   
-            await asyncio.sleep(0)
-            try:
-                await self.updateData()
-            except RuntimeError:
-                print("error")
-                break
-
-    async def updateData(self):
-        self.image_display.setImage(self.con.scan_stream.y_height, self.con.scan_stream.x_width, self.con.scan_stream.buffer)
+    def updateData(self):
+        scan_stream = self.con.scan_stream
+        dirty_rows = scan_stream.take_dirty_rows()
+        if dirty_rows is not None:
+            self.image_display.updateRows(scan_stream.display_buffer, *dirty_rows)
+        now = time.perf_counter()
+        if now - self.last_histogram_update > 1:
+            self.image_display.updateHistogram()
+            self.last_histogram_update = now
         
         
 
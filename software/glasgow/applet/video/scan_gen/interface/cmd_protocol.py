@@ -0,0 +1,60 @@
+import struct
+
+
+## The command channel carries binary messages over one persistent connection.
+## A request is a header followed by its commands:
+##   header   <HH   request_id, number of commands
+##   command  <2sH  two-letter code (see scan_ctrl.frame_vars, data_format), value
+## The server applies all commands in a request in order, then answers with:
+##   ack      <HB   request_id, status
+HEADER = struct.Struct("<HH")
+COMMAND = struct.Struct("<2sH")
+ACK = struct.Struct("<HB")
+
+ACK_OK = 0
+ACK_ERROR = 1
+
+
+class CommandError(Exception):
+    pass
+
+
+def encode_request(request_id, commands):
+    message = bytearray(HEADER.pack(request_id, len(commands)))
+    for code, value in commands:
+        message.extend(COMMAND.pack(code.encode(), value))
+    return bytes(message)
+
+def decode_commands(body):
+    return [(code.decode(), value) for code, value in COMMAND.iter_unpack(body)]
+
+async def read_request(reader):
+    request_id, count = HEADER.unpack(await reader.readexactly(HEADER.size))
+    body = await reader.readexactly(count*COMMAND.size)
+    return request_id, decode_commands(body)
+
+def encode_ack(request_id, status):
+    return ACK.pack(request_id, status)
+
+async def read_ack(reader):
+    return ACK.unpack(await reader.readexactly(ACK.size))
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    def test_cmd_protocol():
+        commands = [("rx", 16384), ("ry", 512), ("sc", 1), ("cf", 1), ("cf", 0)]
+        message = encode_request(7, commands)
+        assert len(message) == HEADER.size + 5*COMMAND.size
+        assert message[4:8] == b"rx\x00\x40"
+
+        async def round_trip():
+            reader = asyncio.StreamReader()
+            reader.feed_data(message + encode_ack(7, ACK_OK))
+            assert await read_request(reader) == (7, commands)
+            assert await read_ack(reader) == (7, ACK_OK)
+        asyncio.run(round_trip())
+        print("cmd protocol: OK")
+
+    test_cmd_protocol()
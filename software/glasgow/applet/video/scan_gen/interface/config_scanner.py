@@ -0,0 +1,141 @@
+import numpy as np
+
+
+CONFIG_MARKER = 0xFF
+CONFIG_LENGTH = 18 ## FF FF + 14 bytes of parameters + FF FF
+
+
+class ConfigScanner:
+    '''
+    Splits a scan data stream into data segments and config packets.
+
+    A config packet is demarcated by two 0xFF bytes on each side:
+        [FF FF X1 X2 Y1 Y2 UX1 UX2 LX1 LX2 UY1 UY2 LY1 LY2 SC 8B FF FF]
+    ByteSwapper keeps 0xFF out of 8-bit data and caps 16-bit samples below
+    0x3FFF, and 0xFF is never a PixelCompressor code, so FF FF only occurs
+    at the start of a config packet.
+
+    Config packets are rare, so each packet is first searched for 0xFF
+    bytes with one vectorized comparison. Only the (usually zero) hits are
+    looked at in Python.
+
+    A config packet can be cut in two by a packet boundary. If a possible
+    config packet starts in the last 17 bytes of a packet, those bytes are
+    held back and scanned again at the front of the next packet.
+    '''
+    def __init__(self):
+        self._carry = b""
+
+    def reset(self):
+        self._carry = b""
+
+    def scan(self, d):
+        '''
+        Returns a list of (config, data) pairs in stream order, where config
+        is the 14 parameter bytes of the config packet that precedes data, or
+        None for data that continues with the existing config.
+        '''
+        if self._carry:
+            ## rare: copy the whole packet behind the held-back bytes
+            d = self._carry + bytes(d)
+            self._carry = b""
+        m = memoryview(d).cast('B')
+        a = np.frombuffer(m, dtype=np.uint8)
+        length = len(a)
+
+        markers = np.flatnonzero(a == CONFIG_MARKER)
+        if len(markers) == 0:
+            return [(None, m)]
+
+        ## a config packet can start at FF FF, or at a lone FF that ends the packet
+        following = markers + 1
+        starts = markers[(following == length) |
+                         (a[np.minimum(following, length - 1)] == CONFIG_MARKER)]
+
+        segments = []
+        config = None
+        position = 0
+        for start in starts.tolist():
+            if start < position:
+                ## inside a config packet that was already taken
+                continue
+            if start + CONFIG_LENGTH > length:
+                ## the rest of this packet may be the start of a config packet
+                self._carry = bytes(m[start:])
+                segments.append((config, m[position:start]))
+                return segments
+            if ((a[start + CONFIG_LENGTH - 2] == CONFIG_MARKER) &
+                    (a[start + CONFIG_LENGTH - 1] == CONFIG_MARKER)):
+                segments.append((config, m[position:start]))
+                config = m[start + 2:start + CONFIG_LENGTH - 2]
+                position = start + CONFIG_LENGTH
+        segments.append((config, m[position:]))
+        return segments
+
+
+if __name__ == "__main__":
+    import re
+    import time
+    from mock_output import generate_raster_packet_with_config, generate_raster_config
+
+    def synthetic_stream(n_packets, eight_bit_output, config_every=None):
+        packet_generator = generate_raster_packet_with_config(2048, 2048, eight_bit_output)
+        stream = bytearray()
+        for n in range(n_packets):
+            stream.extend(bytes(next(packet_generator)))
+            if config_every and (n % config_every == config_every - 1):
+                stream.extend(bytes(generate_raster_config(2048, 2048, eight_bit_output)))
+        return stream
+
+    def chunked(stream, chunk_size=16384):
+        return [bytes(stream[n:n + chunk_size]) for n in range(0, len(stream) - chunk_size + 1, chunk_size)]
+
+    def count_configs(segments):
+        return sum(1 for config, data in segments if config is not None)
+
+    def test_config_scanner():
+        ## a config packet at every offset across a packet boundary
+        config = bytes(generate_raster_config(300, 200, True, lx=1, ux=299, ly=2, uy=199))
+        for offset in range(1, CONFIG_LENGTH):
+            stream = bytes(64 - offset) + config + bytes(64 + offset - CONFIG_LENGTH)
+            scanner = ConfigScanner()
+            found = []
+            data = bytearray()
+            for chunk in chunked(stream, 64):
+                for c, d in scanner.scan(chunk):
+                    if c is not None:
+                        found.append(bytes(c))
+                    data.extend(d)
+            assert found == [config[2:16]], f'config split at {offset} missed'
+            assert data == bytes(len(stream) - CONFIG_LENGTH)
+        ## FF FF that is not followed by FF FF 16 bytes later is data
+        scanner = ConfigScanner()
+        stream = bytes([255, 255]) + bytes(62)
+        assert count_configs(scanner.scan(stream)) == 0
+        print("config scanner: OK")
+
+    def bench_config_scanner(eight_bit_output, config_every=None):
+        stream = synthetic_stream(64, eight_bit_output, config_every)
+        chunks = chunked(stream)
+        config_match = re.compile(b'\xff{2}.{14}\xff{2}', flags=re.DOTALL)
+
+        start = time.perf_counter()
+        for n in range(8):
+            regex_found = sum(len(list(re.finditer(config_match, chunk))) for chunk in chunks)
+        regex_time = time.perf_counter() - start
+
+        scanner = ConfigScanner()
+        start = time.perf_counter()
+        for n in range(8):
+            scanner_found = sum(count_configs(scanner.scan(chunk)) for chunk in chunks)
+        scanner_time = time.perf_counter() - start
+
+        total = 8*len(chunks)*16384/1e6
+        print(f'{"8" if eight_bit_output else "16"}-bit, config every {config_every} packets: '
+              f'regex {total/regex_time:.0f} MB/s ({regex_found} found), '
+              f'scanner {total/scanner_time:.0f} MB/s ({scanner_found} found)')
+
+    test_config_scanner()
+    for eight_bit_output in (True, False):
+        bench_config_scanner(eight_bit_output)
+        bench_config_scanner(eight_bit_output, config_every=4)
@@ -0,0 +1,179 @@
+import numpy as np
+
+
+class FrameIntegrator:
+    """
+    Integrates the pixels of successive frames as they are decoded, for low-dose imaging.
+
+    Modes, each over ``n`` samples:
+
+    ``"average"``
+        Average of ``n`` frames. Each pixel shows the running average of the frames so far
+        until ``n`` have been taken, then holds that average while the next ``n`` are taken.
+    ``"ema"``
+        Exponential running average, with a weight of ``1/n`` for each new frame.
+    ``"line"``
+        Average of each pixel with the same column of the ``n - 1`` lines scanned before it,
+        in the same frame (and below :attr:`first_row`, the top of the region being scanned).
+    ``"max"``
+        Brightest value seen at each pixel since the last :meth:`reset`.
+
+    Sums are kept in 32-bit accumulators (the exponential average in fixed point), and the
+    result is kept up to date in :attr:`frame`, an 8-bit array of the frame's shape, as each
+    run of pixels is added, so it can be displayed or saved as is.
+    """
+    MODES = ("average", "ema", "line", "max")
+
+    ## fractional bits of the exponential average
+    EMA_SHIFT = 8
+
+    def __init__(self, mode="average", n=4, shape=(512, 512)):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown integration mode {mode!r}, expected one of {self.MODES}")
+        if n < 1:
+            raise ValueError(f"cannot integrate over {n} samples")
+        self.mode = mode
+        self.n = n
+        self.first_row = 0
+        self.resize(shape)
+
+    def resize(self, shape):
+        """Start over with frames of ``shape``."""
+        self.shape = shape
+        size = shape[0]*shape[1]
+        self.frame = np.zeros(shape, dtype=np.uint8)
+        self._frame = self.frame.reshape(-1)
+        self._count = np.zeros(size, dtype=np.uint16) if self.mode == "average" else None
+        self._started = np.zeros(size, dtype=bool) if self.mode == "ema" else None
+        self._sum = np.zeros(size, dtype=np.uint32) if self.mode == "average" else None
+        self._held = np.zeros(size, dtype=bool) if self.mode == "average" else None
+        self._ema = np.zeros(size, dtype=np.int32) if self.mode == "ema" else None
+
+    def reset(self):
+        self.resize(self.shape)
+
+    def add(self, index, pixels, buffer):
+        """
+        Integrate ``pixels``, which were just written to ``buffer`` (the frame being decoded)
+        at ``index``, a slice or an array of indices into the flattened frame.
+        """
+        if self.mode == "average":
+            self._add_average(index, pixels)
+        elif self.mode == "ema":
+            self._add_ema(index, pixels)
+        elif self.mode == "line":
+            self._add_line(index, buffer)
+        elif self.mode == "max":
+            self._frame[index] = np.maximum(self._frame[index], pixels)
+
+    def _add_average(self, index, pixels):
+        count = self._count[index]
+        total = self._sum[index]
+        ## a pixel that has had its n frames starts a new average
+        restart = count == self.n
+        count[restart] = 0
+        total[restart] = 0
+        count += 1
+        total += pixels
+        held = self._held[index]
+        done = count == self.n
+        held |= done
+        ## the current average until the first n frames are in, the last complete one after
+        show = done | ~held
+        self._frame[index] = np.where(show, (total + count//2)//count, self._frame[index])
+        if not isinstance(index, slice):
+            ## fancy indexing gave copies, write them back
+            self._count[index] = count
+            self._sum[index] = total
+            self._held[index] = held
+
+    def _add_ema(self, index, pixels):
+        ema = self._ema[index]
+        value = pixels.astype(np.int32) << self.EMA_SHIFT
+        ## the first frame is taken as is, later ones are weighted by 1/n
+        ema += np.where(self._started[index], (value - ema)//self.n, value - ema)
+        self._started[index] = True
+        self._frame[index] = (ema + (1 << (self.EMA_SHIFT - 1))) >> self.EMA_SHIFT
+        if not isinstance(index, slice):
+            ## fancy indexing gave a copy, write it back
+            self._ema[index] = ema
+
+    def _add_line(self, index, buffer):
+        ## recompute the rows the new pixels are in, from the buffer
+        width = self.shape[1]
+        if isinstance(index, slice):
+            start, stop = index.start // width, (index.stop - 1) // width + 1
+        else:
+            start, stop = int(index.min()) // width, int(index.max()) // width + 1
+        window = max(start - (self.n - 1), self.first_row, 0)
+        rows = buffer[window:stop].astype(np.uint32)
+        total = np.cumsum(rows, axis=0)
+        ## sum of each row with up to n - 1 rows before it
+        lines = np.arange(window, stop)
+        count = np.minimum(lines - window + 1, self.n)[:, None]
+        upper = total[start - window:]
+        lower = np.zeros_like(upper)
+        below = (lines[start - window:] - window) - self.n
+        lower[below >= 0] = total[below[below >= 0]]
+        count = count[start - window:]
+        self.frame[start:stop] = (upper - lower + count//2)//count
+
+
+if __name__ == "__main__":
+    import time
+
+    def test_frame_integrator(height=20, width=30):
+        rng = np.random.default_rng(1)
+        frames = rng.integers(0, 256, (9, height, width), dtype=np.uint8)
+
+        def integrate(integrator, as_indices):
+            ## each frame arrives in runs that do not line up with its rows
+            for frame in frames:
+                flat = frame.reshape(-1)
+                buffer = frame
+                for start in range(0, flat.size, 77):
+                    stop = min(start + 77, flat.size)
+                    index = np.arange(start, stop) if as_indices else slice(start, stop)
+                    integrator.add(index, flat[start:stop], buffer)
+
+        for as_indices in (False, True):
+            integrator = FrameIntegrator("average", 4, (height, width))
+            integrate(integrator, as_indices)
+            ## frames 0-3 and 4-7 complete, frame 8 starts a new average: 4-7 is held
+            expected = (frames[4:8].astype(np.uint32).sum(axis=0) + 2)//4
+            assert (integrator.frame == expected).all()
+
+            integrator = FrameIntegrator("ema", 4, (height, width))
+            integrate(integrator, as_indices)
+            ema = frames[0].astype(np.float64)
+            for frame in frames[1:]:
+                ema += (frame - ema)/4
+            assert np.abs(integrator.frame - ema).max() <= 1
+
+            integrator = FrameIntegrator("max", shape=(height, width))
+            integrate(integrator, as_indices)
+            assert (integrator.frame == frames.max(axis=0)).all()
+
+            integrator = FrameIntegrator("line", 3, (height, width))
+            integrator.first_row = 2
+            integrate(integrator, as_indices)
+            last = frames[-1].astype(np.uint32)
+            for y in range(2, height):
+                lines = last[max(y - 2, 2):y + 1]
+                assert (integrator.frame[y] == (lines.sum(axis=0) + len(lines)//2)//len(lines)).all(), y
+        print("frame integrator: OK")
+
+    def bench_frame_integrator(side=2048, packets=1024):
+        pixels = np.random.default_rng(2).integers(0, 256, 16384, dtype=np.uint8)
+        buffer = np.zeros((side, side), dtype=np.uint8)
+        for mode in FrameIntegrator.MODES:
+            integrator = FrameIntegrator(mode, 4, (side, side))
+            start = time.perf_counter()
+            for n in range(packets):
+                offset = n*16384 % (side*side)
+                integrator.add(slice(offset, offset + 16384), pixels, buffer)
+            end = time.perf_counter()
+            print(f'{mode}: {packets*16384/(end - start)/1e6:.0f} MB/s')
+
+    test_frame_integrator()
+    bench_frame_integrator()
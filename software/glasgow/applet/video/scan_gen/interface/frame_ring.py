@@ -0,0 +1,266 @@
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+
+## Layout of the shared memory segment, all header fields little-endian uint64:
+##   ring header   magic, version, slots, max width, max height, latest slot + 1,
+##                 frames published, closed
+##   slot headers  one per slot: sequence, frame number, width, height,
+##                 x lower, x upper, y lower, y upper
+##   slot data     one per slot: max width * max height uint8 pixels, row-major
+## Each slot is guarded by a seqlock: the writer makes the slot's sequence odd
+## before touching the slot and even again when done, and a reader only trusts
+## what it read if the sequence was the same even number before and after.
+MAGIC = 0x474e4952_4e474353 ## "SCGNRING"
+VERSION = 1
+
+RING_FIELDS = 8
+SLOT_FIELDS = 8
+(R_MAGIC, R_VERSION, R_SLOTS, R_MAX_WIDTH, R_MAX_HEIGHT,
+ R_LATEST, R_FRAMES, R_CLOSED) = range(RING_FIELDS)
+(S_SEQUENCE, S_FRAME, S_WIDTH, S_HEIGHT,
+ S_X_LOWER, S_X_UPPER, S_Y_LOWER, S_Y_UPPER) = range(SLOT_FIELDS)
+
+DEFAULT_NAME = "scan_gen_frames"
+
+
+class FrameView:
+    """
+    A published frame, as a read-only array over its slot in the ring; nothing is copied.
+
+    The writer may reuse the slot once ``slots - 1`` newer frames have been published. Check
+    :meth:`valid` after using :attr:`pixels` (e.g. after handing them to the display) to know
+    whether they were overwritten meanwhile.
+    """
+    def __init__(self, ring, slot, sequence, number, pixels, roi):
+        self._ring    = ring
+        self.slot     = slot
+        self.sequence = sequence
+        self.number   = number
+        self.pixels   = pixels
+        self.roi      = roi
+
+    def valid(self):
+        return self._ring._slot_headers[self.slot, S_SEQUENCE] == self.sequence
+
+
+class FrameRing:
+    """
+    A ring of decoded frames in shared memory, written by one process and read, without
+    copying, by any number of others (e.g. local viewers and recorders).
+
+    The writer creates the ring with :meth:`create`, decodes each frame straight into the
+    array returned by :meth:`begin`, and publishes it with :meth:`commit`. Readers open the
+    ring with :meth:`attach` and look at the newest complete frame with :meth:`latest` or
+    :meth:`copy_latest`. See the layout comment above for the synchronization.
+    """
+    def __init__(self, shm, owner):
+        self._shm   = shm
+        self._owner = owner
+        self._header = np.ndarray((RING_FIELDS,), dtype='<u8', buffer=shm.buf)
+        if self._header[R_MAGIC] != MAGIC or self._header[R_VERSION] != VERSION:
+            raise ValueError(f"{shm.name} is not a version {VERSION} frame ring")
+        self.slots      = int(self._header[R_SLOTS])
+        self.max_width  = int(self._header[R_MAX_WIDTH])
+        self.max_height = int(self._header[R_MAX_HEIGHT])
+        self._slot_headers = np.ndarray((self.slots, SLOT_FIELDS), dtype='<u8', buffer=shm.buf,
+                                        offset=self._header.nbytes)
+        self._data = np.ndarray((self.slots, self.max_height*self.max_width), dtype=np.uint8,
+                                buffer=shm.buf, offset=self.header_size(self.slots))
+        if not owner:
+            self._data.setflags(write=False)
+        self._writing = None
+
+    @staticmethod
+    def header_size(slots):
+        ## keep the pixel data 64-byte aligned
+        size = 8*(RING_FIELDS + slots*SLOT_FIELDS)
+        return (size + 63) & ~63
+
+    @classmethod
+    def create(cls, name=DEFAULT_NAME, slots=3, max_width=2048, max_height=2048):
+        """Create a ring, replacing a stale ring of the same name left behind by a crash."""
+        size = cls.header_size(slots) + slots*max_width*max_height
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        header = np.ndarray((RING_FIELDS,), dtype='<u8', buffer=shm.buf)
+        header[:] = 0
+        header[R_SLOTS] = slots
+        header[R_MAX_WIDTH] = max_width
+        header[R_MAX_HEIGHT] = max_height
+        header[R_VERSION] = VERSION
+        ## written last, so a reader never sees a half-initialized ring as valid
+        header[R_MAGIC] = MAGIC
+        del header
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name=DEFAULT_NAME):
+        """Open an existing ring for reading. Raises ``FileNotFoundError`` if there is none."""
+        try:
+            shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            ## before Python 3.13 there is no track=False, and the resource tracker would
+            ## unlink the ring when this process exits, from under the writer
+            register = resource_tracker.register
+            resource_tracker.register = lambda name, rtype: None
+            try:
+                shm = shared_memory.SharedMemory(name)
+            finally:
+                resource_tracker.register = register
+        return cls(shm, owner=False)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def frames(self):
+        """Number of frames published so far."""
+        return int(self._header[R_FRAMES])
+
+    @property
+    def closed(self):
+        """Whether the writer has closed the ring; readers should attach again to follow it."""
+        return bool(self._header[R_CLOSED])
+
+    def begin(self, width, height, roi=None):
+        """
+        Start writing a frame of ``width`` by ``height`` pixels into the oldest slot, and
+        return the slot as a writable ``(height, width)`` array. ``roi`` is the
+        ``(x_lower, x_upper, y_lower, y_upper)`` region that was scanned, if not the whole frame.
+        """
+        assert self._owner, "only the process that created the ring can write to it"
+        if not (0 < width <= self.max_width and 0 < height <= self.max_height):
+            raise ValueError(f"{width}x{height} frame does not fit in "
+                             f"{self.max_width}x{self.max_height} ring")
+        latest = int(self._header[R_LATEST])
+        if self._writing is not None:
+            slot = self._writing
+        else:
+            ## the slot after the latest one, i.e. the oldest
+            slot = latest % self.slots
+            self._slot_headers[slot, S_SEQUENCE] += 1
+            self._writing = slot
+        header = self._slot_headers[slot]
+        header[S_WIDTH] = width
+        header[S_HEIGHT] = height
+        header[S_X_LOWER:S_Y_UPPER + 1] = roi if roi is not None else (0, width, 0, height)
+        return self._data[slot, :width*height].reshape(height, width)
+
+    def commit(self):
+        """Publish the frame started with :meth:`begin` as the latest frame."""
+        slot, self._writing = self._writing, None
+        assert slot is not None, "commit() without begin()"
+        header = self._slot_headers[slot]
+        header[S_FRAME] = self._header[R_FRAMES]
+        header[S_SEQUENCE] += 1
+        self._header[R_LATEST] = slot + 1
+        self._header[R_FRAMES] += 1
+
+    def publish(self, frame, roi=None):
+        """Copy a ``(height, width)`` array into the ring as the latest frame."""
+        height, width = frame.shape
+        self.begin(width, height, roi)[:] = frame
+        self.commit()
+
+    def latest(self):
+        """The latest complete frame as a :class:`FrameView`, or ``None`` if there is none yet."""
+        for attempt in range(self.slots):
+            latest = int(self._header[R_LATEST])
+            if latest == 0:
+                return None
+            slot = latest - 1
+            header = self._slot_headers[slot].copy()
+            sequence = header[S_SEQUENCE]
+            if sequence % 2 == 1 or self._slot_headers[slot, S_SEQUENCE] != sequence:
+                ## the writer lapped us and is rewriting this slot; look again
+                continue
+            width, height = int(header[S_WIDTH]), int(header[S_HEIGHT])
+            pixels = self._data[slot, :width*height].reshape(height, width)
+            roi = tuple(int(v) for v in header[S_X_LOWER:S_Y_UPPER + 1])
+            return FrameView(self, slot, sequence, int(header[S_FRAME]), pixels, roi)
+        return None
+
+    def copy_latest(self):
+        """A consistent copy of the latest complete frame as a :class:`FrameView`, or ``None``."""
+        for attempt in range(self.slots):
+            frame = self.latest()
+            if frame is None:
+                return None
+            pixels = frame.pixels.copy()
+            if frame.valid():
+                frame.pixels = pixels
+                return frame
+        return None
+
+    def close(self):
+        """Detach from the ring; the process that created it also removes it."""
+        if self._owner:
+            self._header[R_CLOSED] = 1
+        ## views into the segment must be gone before it can be closed
+        del self._header, self._slot_headers, self._data
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import os
+    import time
+
+    def test_frame_ring():
+        name = f"scan_gen_test_{os.getpid()}"
+        with FrameRing.create(name, slots=3, max_width=64, max_height=32) as writer:
+            reader = FrameRing.attach(name)
+            assert reader.latest() is None
+            for n in range(5):
+                frame = writer.begin(48, 16, roi=(8, 40, 0, 16))
+                frame[:] = n
+                ## an unfinished frame is not visible
+                assert reader.frames == n
+                writer.commit()
+                latest = reader.latest()
+                assert latest.number == n and latest.pixels.shape == (16, 48)
+                assert (latest.pixels == n).all() and latest.roi == (8, 40, 0, 16)
+                assert not latest.pixels.flags.writeable
+            ## a view stays valid until the writer comes back around to its slot
+            held = reader.latest()
+            writer.publish(np.full((16, 48), 5, np.uint8))
+            writer.publish(np.full((16, 48), 6, np.uint8))
+            assert held.valid()
+            writer.begin(48, 16)
+            assert not held.valid()
+            writer.commit()
+            copied = reader.copy_latest()
+            assert copied.number == 7 and copied.pixels.flags.writeable
+            reader.close()
+            assert not writer.closed
+        print("frame ring: OK")
+
+    def bench_frame_ring(side=2048, frames=200):
+        name = f"scan_gen_bench_{os.getpid()}"
+        with FrameRing.create(name, max_width=side, max_height=side) as writer:
+            reader = FrameRing.attach(name)
+            source = np.arange(side*side, dtype=np.uint8).reshape(side, side)
+            start = time.perf_counter()
+            for n in range(frames):
+                writer.publish(source)
+                reader.latest()
+            end = time.perf_counter()
+            reader.close()
+        print(f'{side}x{side}: {frames/(end - start):.0f} frames/s published and viewed')
+
+    test_frame_ring()
+    bench_frame_ring()
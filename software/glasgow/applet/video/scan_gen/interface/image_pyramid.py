@@ -0,0 +1,146 @@
+import numpy as np
+
+
+class ImagePyramid:
+    """
+    A frame and successively 2x downsampled copies of it, cut into square tiles, for displaying
+    frames far larger than the screen.
+
+    Level 0 is the frame itself (not copied); each further level is the 2x2 box average of the
+    one before, down to a level that fits in one tile. Together the downsampled levels take a
+    third of the memory of the frame.
+
+    As rows of the frame change, :meth:`update_rows` recomputes only the rows of each level that
+    depend on them, and marks the tiles they are in as dirty. A viewer draws the tiles of one
+    level that are in view, and redraws those that :meth:`take_dirty` reports.
+    """
+    def __init__(self, base, tile_size=256):
+        self.tile_size = tile_size
+        self.levels = [base]
+        while max(self.levels[-1].shape) > tile_size:
+            height, width = self.levels[-1].shape
+            self.levels.append(np.zeros(((height + 1)//2, (width + 1)//2), dtype=np.uint8))
+        self._dirty = [np.ones(self.tiles(level), dtype=bool) for level in range(len(self.levels))]
+        self.update_rows(0, base.shape[0])
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def tiles(self, level):
+        """Number of tile rows and columns at ``level``."""
+        height, width = self.levels[level].shape
+        return -(-height // self.tile_size), -(-width // self.tile_size)
+
+    def tile(self, level, ty, tx):
+        """The pixels of a tile, as a view into its level."""
+        size = self.tile_size
+        return self.levels[level][ty*size:(ty + 1)*size, tx*size:(tx + 1)*size]
+
+    def tile_rect(self, level, ty, tx):
+        """Where a tile lands in the frame, as ``(x, y, width, height)`` in frame pixels."""
+        height, width = self.tile(level, ty, tx).shape
+        scale = self.tile_size << level
+        return tx*scale, ty*scale, width << level, height << level
+
+    def level_for_scale(self, scale):
+        """The coarsest level with at least one pixel per screen pixel, for ``scale`` frame pixels per screen pixel."""
+        level = int(np.log2(scale)) if scale >= 2 else 0
+        return min(level, len(self.levels) - 1)
+
+    def visible_tiles(self, level, x0, x1, y0, y1):
+        """Ranges of tile rows and columns at ``level`` that overlap the frame area given in frame pixels."""
+        scale = self.tile_size << level
+        tiles_y, tiles_x = self.tiles(level)
+        ty0 = min(max(int(y0 // scale), 0), tiles_y)
+        ty1 = min(max(int(-(-y1 // scale)), 0), tiles_y)
+        tx0 = min(max(int(x0 // scale), 0), tiles_x)
+        tx1 = min(max(int(-(-x1 // scale)), 0), tiles_x)
+        return range(ty0, ty1), range(tx0, tx1)
+
+    def take_dirty(self, level, tile_rows, tile_columns):
+        """The ``(ty, tx)`` of dirty tiles within the given ranges; they are no longer dirty afterwards."""
+        area = self._dirty[level][tile_rows.start:tile_rows.stop, tile_columns.start:tile_columns.stop]
+        dirty = [(tile_rows.start + ty, tile_columns.start + tx) for ty, tx in np.argwhere(area)]
+        area[:] = False
+        return dirty
+
+    def _downsample(self, level, start, stop):
+        ## rows [start, stop) of level from rows [2*start, 2*stop) of the level before;
+        ## an odd last row or column is averaged with itself
+        source = self.levels[level - 1]
+        height, width = source.shape
+        rows = source[2*start:min(2*stop, height)]
+        if rows.shape[0] % 2:
+            rows = np.concatenate((rows, rows[-1:]))
+        pairs = rows[0::2].astype(np.uint16)
+        pairs += rows[1::2]
+        if width % 2:
+            pairs = np.concatenate((pairs, pairs[:, -1:]), axis=1)
+        total = pairs[:, 0::2]
+        total += pairs[:, 1::2]
+        total += 2
+        total >>= 2
+        self.levels[level][start:stop] = total
+
+    def update_rows(self, start, stop, band=256):
+        """Bring every level up to date with rows ``[start, stop)`` of the frame."""
+        for level in range(len(self.levels)):
+            if level > 0:
+                start, stop = start // 2, -(-stop // 2)
+                ## in bands, so temporaries stay small for wide frames
+                for band_start in range(start, stop, band):
+                    self._downsample(level, band_start, min(band_start + band, stop))
+            if stop > start:
+                self._dirty[level][start // self.tile_size:(stop - 1) // self.tile_size + 1] = True
+
+
+if __name__ == "__main__":
+    import time
+
+    def reference_level(image, level):
+        for n in range(level):
+            if image.shape[0] % 2:
+                image = np.concatenate((image, image[-1:]))
+            if image.shape[1] % 2:
+                image = np.concatenate((image, image[:, -1:]), axis=1)
+            image = image.astype(np.uint16)
+            image = ((image[0::2, 0::2] + image[1::2, 0::2] + image[0::2, 1::2] + image[1::2, 1::2] + 2) >> 2).astype(np.uint8)
+        return image
+
+    def test_image_pyramid(height=1000, width=777):
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 256, (height, width), dtype=np.uint8)
+        pyramid = ImagePyramid(frame, tile_size=64)
+        assert [level.shape for level in pyramid.levels] == \
+            [(1000, 777), (500, 389), (250, 195), (125, 98), (63, 49)]
+        for level in range(len(pyramid.levels)):
+            pyramid.take_dirty(level, *map(range, pyramid.tiles(level)))
+        ## a few changed rows only update, and dirty, what depends on them
+        frame[301:307] = 255
+        pyramid.update_rows(301, 307)
+        for level in range(len(pyramid.levels)):
+            assert (pyramid.levels[level] == reference_level(frame, level)).all(), level
+        assert pyramid.take_dirty(0, range(0, 16), range(0, 2)) == [(4, 0), (4, 1)]
+        assert pyramid.take_dirty(2, *map(range, pyramid.tiles(2))) == [(1, 0), (1, 1), (1, 2), (1, 3)]
+        assert pyramid.take_dirty(2, *map(range, pyramid.tiles(2))) == []
+        assert pyramid.tile_rect(2, 1, 3) == (768, 256, 3*4, 256)
+        assert pyramid.level_for_scale(0.5) == 0 and pyramid.level_for_scale(5) == 2
+        assert pyramid.level_for_scale(1000) == 4
+        assert pyramid.visible_tiles(1, -50, 300, 100, 130) == (range(0, 2), range(0, 3))
+        print("image pyramid: OK")
+
+    def bench_image_pyramid(side=16384, rows=8):
+        frame = np.zeros((side, side), dtype=np.uint8)
+        start = time.perf_counter()
+        pyramid = ImagePyramid(frame)
+        built = time.perf_counter()
+        for row in range(0, 256, rows):
+            pyramid.update_rows(row, row + rows)
+        end = time.perf_counter()
+        extra = sum(level.nbytes for level in pyramid.levels[1:])
+        print(f'{side}x{side}: built in {built - start:.2f} s, {extra/frame.nbytes:.2f}x extra memory, '
+              f'{(end - built)/(256//rows)*1e3:.2f} ms to update {rows} rows')
+
+    test_image_pyramid()
+    bench_image_pyramid()
@@ -1,5 +1,6 @@
 
 import struct 
+import numpy as np
 def get_two_bytes(n: int):
     b = struct.pack('H', n)
     b1, b2 = list(b)
@@ -111,6 +112,33 @@ def generate_raster_packet_with_config(*args, **kwargs):
         yield packet
         n = 0
 
+def raster_stream(x_resolution, y_resolution, eight_bit_output, length, lx=None, ux=None, ly=None, uy=None):
+    '''
+    The first length bytes of the stream generate_raster_packet_with_config
+    yields (config packet, then pixels carrying their x coordinate), built
+    with numpy in one go, for tests and benchmarks that need a lot of it.
+    '''
+    config = bytes(generate_raster_config(x_resolution, y_resolution, eight_bit_output, lx, ux, ly, uy))
+    lx = 0 if lx is None else lx
+    ux = x_resolution if ux is None else ux
+    pixel_bytes = 1 if eight_bit_output else 2
+    n_pixels = -(-(length - len(config)) // pixel_bytes)
+    x = (lx + np.arange(n_pixels) % (ux - lx)).astype('>u2')
+    pixels = x.view(np.uint8)[1::2] if eight_bit_output else x.view(np.uint8)
+    return (config + pixels.tobytes())[:length]
+
+def vector_echo_stream(x_resolution, y_resolution, n_points):
+    '''
+    A gradient vector pattern of n_points (x, y, dwell), and the stream the
+    device sends back for it: a config packet, then the dwell of each point
+    echoed as a 16-bit value.
+    '''
+    y, x = np.divmod(np.arange(n_points) % (x_resolution*y_resolution), x_resolution)
+    pattern = np.stack((x, y, (x + y) % 200), axis=1).astype(np.uint16)
+    config = bytes(generate_raster_config(x_resolution, y_resolution, False))
+    config = config[:14] + bytes([3]) + config[15:]
+    return pattern, config + pattern[:, 2].astype('<u2').tobytes()
+
 def generate_vector_packet():
     config = generate_vector_config(400,400)
     vec_stream = generate_vector_stream_singlepoint([255, 255, 0])
@@ -1,34 +1,187 @@
+import time
+import queue
+import logging
+import threading
 import numpy as np
-from ome_types import to_xml, OME
+import tifffile
 
-from ome_types.model import Instrument, Microscope, InstrumentRef, Image, Pixels
+if __package__:
+    from .image_pyramid import ImagePyramid
+else:
+    from image_pyramid import ImagePyramid
 
 
-microscope_jeol = Microscope(
-             manufacturer='JEOL',
-             model='Lab Mk4',
-             serial_number='L4-5678',
-         )
+SCAN_MODES = {0: "none", 1: "raster", 2: "raster pattern", 3: "vector"}
 
-ome = OME()
+## where the scan parameters of each frame are kept in the OME metadata
+ANNOTATION_NAMESPACE = "glasgow.applet.video.scan_gen/scan_parameters"
 
-instrument = Instrument(
-    microscope = microscope_jeol
-)
-ome.instruments.append(instrument)
 
-pixels = Pixels(
-    size_x = 512,
-    size_y = 512,
-    size_z = 1,
-    size_c = 1,
-    size_t = 1,
-)
+def ome_metadata(number, parameters, pixel_size = None):
+    '''
+    tifffile OME metadata for one frame: the scan parameters (see
+    ScanStream.scan_parameters) go in a map annotation, so they survive in
+    OMERO and other OME readers, and in the description.
+    '''
+    parameters = dict(parameters)
+    if "scan_mode" in parameters:
+        parameters["scan_mode"] = SCAN_MODES.get(parameters["scan_mode"], parameters["scan_mode"])
+    metadata = {
+        "axes": "YX",
+        "Name": f'frame {number}',
+        "SignificantBits": 8,
+        "Description": ", ".join(f'{key}: {value}' for key, value in parameters.items()),
+        "MapAnnotation": {"Namespace": ANNOTATION_NAMESPACE,
+                          **{key: str(value) for key, value in parameters.items()}},
+    }
+    if pixel_size is not None:
+        metadata.update(PhysicalSizeX = pixel_size, PhysicalSizeXUnit = "m",
+                        PhysicalSizeY = pixel_size, PhysicalSizeYUnit = "m")
+    return metadata
 
-image = Image(pixels)
-ome.images.append(image)
 
-print(ome.to_xml())
+class OmeTiffWriter:
+    """
+    Append frames, as they complete, to a tiled, pyramidal OME-TIFF file.
 
-# array = np.random.randint(0, 255,size = (512,512))
-# array = array.astype(np.uint8)
\ No newline at end of file
+    Each frame is written as its own OME image, so nothing but the frame being written is held
+    in memory, however long the acquisition. The frame is cut into ``tile`` by ``tile`` tiles,
+    compressed with ``compression`` (any tifffile codec, or ``None``), and followed in SubIFDs by
+    the 2x downsampled levels of an :class:`ImagePyramid`, down to a single tile.
+
+    :meth:`write_frame` writes synchronously. To keep up with acquisition, :meth:`start` a
+    writer thread and hand frames to :meth:`submit` instead, which copies the frame into a
+    bounded queue and never blocks; frames that do not fit in the queue are counted in
+    :attr:`dropped`. If writing fails (a full disk, say), the thread logs the exception and
+    stops, and the exception is raised again from the next :meth:`submit` or :meth:`close`.
+    """
+    def __init__(self, path, tile = 256, compression = "zlib", pixel_size = None,
+                 depth = 4, maxworkers = None, logger = None):
+        self.path = path
+        self._tif = tifffile.TiffWriter(path, bigtiff = True, ome = True)
+        self._options = dict(tile = (tile, tile), compression = compression,
+                             photometric = "minisblack", maxworkers = maxworkers)
+        self._tile = tile
+        self._pixel_size = pixel_size
+        self._queue = queue.Queue(depth)
+        self._thread = None
+        self._logger = logger or logging.getLogger(__name__)
+        self.frames = 0
+        self.dropped = 0
+        self.error = None
+
+    def write_frame(self, frame, parameters = {}):
+        levels = ImagePyramid(frame, self._tile).levels
+        self._tif.write(frame, subifds = len(levels) - 1, **self._options,
+                        metadata = ome_metadata(self.frames, parameters, self._pixel_size))
+        for level in levels[1:]:
+            self._tif.write(level, subfiletype = 1, **self._options)
+        self.frames += 1
+
+    def start(self):
+        self._thread = threading.Thread(target = self._run, name = "scan_gen OME-TIFF writer",
+                                        daemon = True)
+        self._thread.start()
+
+    def submit(self, frame, parameters = {}):
+        """Queue a copy of ``frame`` for the writer thread. Returns ``False`` if it was dropped."""
+        if self.error is not None:
+            raise self.error
+        try:
+            self._queue.put_nowait((frame.copy(), dict(parameters)))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _run(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                self.write_frame(*item)
+        except Exception as error:
+            self._logger.exception(f'writing {self.path} failed')
+            self.error = error
+
+    def close(self):
+        """Write what is queued, then finish the file; the OME-XML is written last."""
+        if self._thread is not None:
+            ## a thread that has failed no longer empties the queue
+            while self._thread.is_alive():
+                try:
+                    self._queue.put(None, timeout = 0.1)
+                    break
+                except queue.Full:
+                    pass
+            self._thread.join()
+            self._thread = None
+        try:
+            self._tif.close()
+        finally:
+            self._logger.info(f'wrote {self.frames} frames to {self.path}, dropped {self.dropped}')
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    def test_ome_tiff_writer(directory):
+        path = os.path.join(directory, "test.ome.tif")
+        rng = np.random.default_rng(3)
+        frames = [rng.integers(0, 256, (300, 700), dtype=np.uint8) for n in range(3)]
+        parameters = {"x_width": 700, "y_height": 300, "x_lower": 0, "x_upper": 700,
+                      "y_lower": 0, "y_upper": 300, "scan_mode": 1, "eight_bit_output": 1}
+        with OmeTiffWriter(path, tile = 128, pixel_size = 1e-8) as writer:
+            writer.start()
+            for frame in frames:
+                assert writer.submit(frame, parameters)
+        with tifffile.TiffFile(path) as tif:
+            assert tif.is_ome and len(tif.series) == 3
+            for frame, series in zip(frames, tif.series):
+                assert (series.asarray() == frame).all()
+                assert [level.shape for level in series.levels] == \
+                    [(300, 700), (150, 350), (75, 175), (38, 88)]
+                assert series.pages[0].is_tiled and series.pages[0].compression == 8
+            assert (tif.series[1].levels[1].asarray() == ImagePyramid(frames[1], 128).levels[1]).all()
+            assert "scan_mode" in tif.ome_metadata and "raster" in tif.ome_metadata
+
+        ## a failed write is raised from submit and close, not hung on
+        writer = OmeTiffWriter(os.path.join(directory, "failing.ome.tif"), depth = 1)
+        writer._logger = logging.getLogger("ome tiff writer test")
+        writer._logger.disabled = True
+        writer.start()
+        writer.submit(np.zeros((2, 3, 4, 5, 6), dtype=np.uint8))
+        writer._thread.join(5)
+        for call in (lambda: writer.submit(frames[0]), writer.close):
+            try:
+                call()
+                assert False, "no error after a failed write"
+            except ValueError:
+                pass
+        print("ome tiff writer: OK")
+
+    def bench_ome_tiff_writer(directory, side = 4096, frames = 8):
+        path = os.path.join(directory, "bench.ome.tif")
+        y, x = np.mgrid[0:side, 0:side]
+        frame = ((x ^ y) & 0xFF).astype(np.uint8)
+        start = time.perf_counter()
+        with OmeTiffWriter(path) as writer:
+            for n in range(frames):
+                writer.write_frame(frame)
+        end = time.perf_counter()
+        print(f'{side}x{side}: {frames*frame.nbytes/(end - start)/1e6:.0f} MB/s, '
+              f'{frames/(end - start):.1f} frames/s, {os.path.getsize(path)/(frames*frame.nbytes):.2f} of raw size')
+
+    with tempfile.TemporaryDirectory() as directory:
+        test_ome_tiff_writer(directory)
+        bench_ome_tiff_writer(directory)
@@ -0,0 +1,99 @@
+import numpy as np
+
+
+## The codes PixelCompressor makes of the 8-bit pixel stream, one byte each:
+##   0ddddddd   one pixel, the previous one + d (7-bit, wrapping)
+##   10aaabbb   two pixels, the previous one + a, then + b (3-bit two's complement)
+##   11nnnnnn   the previous pixel n + 1 more times
+## 0xFF is never a code, so config packets are found as in an uncompressed stream
+PAIR = 0x80
+RUN = 0xC0
+
+## per code: what it adds to the previous pixel, as a byte that wraps, what
+## its last pixel adds to its first, and how many pixels are like each
+_codes = np.arange(256)
+_first = ((_codes >> 3 & 0x7) ^ 4) - 4
+_second = ((_codes & 0x7) ^ 4) - 4
+_pair = (_codes >= PAIR) & (_codes < RUN)
+STEPS = np.select([_codes < PAIR, _pair], [_codes, _first + _second], 0).astype(np.uint8)
+SECOND_STEP = np.where(_pair, _second, 0).astype(np.uint8)
+COUNTS = np.stack([np.ones(256), np.select([_codes < PAIR, _pair], [0, 1], _codes & 0x3F)],
+                  axis=1).astype(np.intp)
+
+
+class PixelDecoder:
+    '''
+    Expands the codes in a packet back into pixels, without a loop over them.
+
+    Every code is a whole byte, so a packet always ends on a code boundary,
+    and the only state kept from one packet to the next is the last pixel,
+    which every code is relative to. It is 0 after a config packet, as it
+    is for PixelCompressor.
+
+    Every code adds to the previous pixel, so the last pixel of each code
+    is a running sum of what they add, in bytes, which wrap as the 7-bit
+    pixels do. A pair's first pixel is its last one less its second step,
+    and a run's first is its last. The first and last pixel of each code
+    are then repeated for the pixels like them.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.previous = 0
+
+    def decode(self, data):
+        '''The pixels in data, as a uint8 array.'''
+        codes = np.frombuffer(data, dtype=np.uint8)
+        if len(codes) == 0:
+            return codes
+        ## np.take is several times faster than indexing the tables with codes
+        ends = np.cumsum(np.take(STEPS, codes), dtype=np.uint8)
+        ends += np.uint8(self.previous)
+        pixels = np.empty((len(codes), 2), dtype=np.uint8)
+        np.subtract(ends, np.take(SECOND_STEP, codes), out=pixels[:, 0])
+        pixels[:, 1] = ends
+        pixels &= 0x7F
+        pixels = np.repeat(pixels.ravel(), np.take(COUNTS, codes, axis=0).ravel())
+        self.previous = int(pixels[-1])
+        return pixels
+
+
+if __name__ == "__main__":
+    import time
+
+    def test_pixel_decoder():
+        decoder = PixelDecoder()
+        ## a config packet leaves the previous pixel at 0
+        assert decoder.decode(bytes([0xC2, 0x8B, 0x7B, 0x80 | 0x20, 0x0A])).tolist() == \
+            [0, 0, 0, 1, 4, 127, 127 - 4, 127 - 4, 5]
+        ## and carry on from the last pixel of the packet before
+        assert decoder.decode(bytes([0xC0, 0x9C])).tolist() == [5, 8, 4]
+        decoder.reset()
+        assert decoder.decode(bytes([0x81])).tolist() == [0, 1]
+        ## steps wrap around 7 bits
+        decoder.reset()
+        assert decoder.decode(bytes([0xBF])).tolist() == [127, 126]
+        assert decoder.decode(bytes([0xFE])).tolist() == [126]*63
+        assert len(decoder.decode(b"")) == 0
+        ## the same pixels, however the codes are split
+        rng = np.random.default_rng(3)
+        codes = rng.integers(0, 255, 20000).astype(np.uint8).tobytes()
+        whole = PixelDecoder().decode(codes)
+        split = PixelDecoder()
+        cuts = np.sort(rng.integers(0, len(codes), 50))
+        parts = [split.decode(codes[a:b]) for a, b in zip([0, *cuts], [*cuts, len(codes)])]
+        assert (np.concatenate(parts) == whole).all()
+        print("pixel decoder: OK")
+
+    def bench_pixel_decoder():
+        rng = np.random.default_rng(0)
+        codes = rng.integers(0, 255, 16384).astype(np.uint8).tobytes()
+        decoder = PixelDecoder()
+        start = time.perf_counter()
+        pixels = sum(len(decoder.decode(codes)) for n in range(200))
+        elapsed = time.perf_counter() - start
+        print(f'{200*16384/elapsed/1e6:.0f} MB/s of codes, {pixels/elapsed/1e6:.0f} Mpixel/s')
+
+    test_pixel_decoder()
+    bench_pixel_decoder()
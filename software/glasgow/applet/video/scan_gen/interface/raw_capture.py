@@ -0,0 +1,349 @@
+import os
+import time
+import asyncio
+import inspect
+import numpy as np
+
+if __package__:
+    from .config_scanner import ConfigScanner, CONFIG_MARKER
+else:
+    from config_scanner import ConfigScanner, CONFIG_MARKER
+
+
+## A capture is two files:
+##   <path>        the packets as read, back to back, append-only
+##   <path>.idx    a header, then one fixed-size record per packet
+## Index header, little-endian: magic, record size (u4), version (u4), wall clock
+## time of the start of the capture (f8, seconds since the epoch).
+## Each record gives where the packet is in the data file, when it was read (seconds
+## since the start of the capture), whether a config packet ended in it, and the 14
+## parameter bytes of the config in effect at the end of it (zero before the first).
+INDEX_MAGIC = b"SGCAPIX1"
+INDEX_VERSION = 1
+INDEX_HEADER = np.dtype([("magic", "S8"), ("record_size", "<u4"), ("version", "<u4"),
+                         ("start_time", "<f8")])
+INDEX_RECORD = np.dtype([("offset", "<u8"), ("time", "<f8"), ("length", "<u4"),
+                         ("has_config", "u1"), ("config", "u1", (14,))])
+
+
+def index_path(path):
+    return path + ".idx"
+
+
+class CaptureWriter:
+    '''
+    Appends packets to a capture, and a record of each to its index.
+
+    The config packets in the stream are found as they are written, with a
+    ConfigScanner, so that a reader can start decoding at any packet with
+    the right scan parameters (see CaptureReader.config_before).
+
+    Both files are only ever appended to, so a capture cut short by a crash
+    is still readable up to the last complete index record.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._data = open(path, "wb")
+        self._index = open(index_path(path), "wb")
+        self._start = time.perf_counter()
+        header = np.zeros((), dtype=INDEX_HEADER)
+        header["magic"] = INDEX_MAGIC
+        header["record_size"] = INDEX_RECORD.itemsize
+        header["version"] = INDEX_VERSION
+        header["start_time"] = time.time()
+        self._index.write(header.tobytes())
+        self._record = np.zeros((), dtype=INDEX_RECORD)
+        self._scanner = ConfigScanner()
+        self.packets = 0
+        self.bytes = 0
+
+    def write(self, packet):
+        record = self._record
+        record["offset"] = self.bytes
+        record["time"] = time.perf_counter() - self._start
+        record["length"] = len(packet)
+        record["has_config"] = 0
+        for config, data in self._scanner.scan(packet):
+            if config is not None:
+                record["has_config"] = 1
+                record["config"] = np.frombuffer(config, dtype=np.uint8)
+        self._data.write(packet)
+        self._index.write(record.tobytes())
+        self.packets += 1
+        self.bytes += len(packet)
+
+    def flush(self):
+        ## data first, so an index record never points past the end of the data
+        self._data.flush()
+        self._index.flush()
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureReader:
+    '''
+    Random access to a capture, through memory maps of the data and index:
+    nothing is read from disk until a packet is looked at.
+
+    A capture that is still being written can be read; it is seen as it was
+    when the reader was opened.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(index_path(path), "rb") as f:
+            header = np.frombuffer(f.read(INDEX_HEADER.itemsize), dtype=INDEX_HEADER)
+        if len(header) != 1 or header["magic"][0] != INDEX_MAGIC:
+            raise ValueError(f"{index_path(path)} is not a capture index")
+        if header["record_size"][0] != INDEX_RECORD.itemsize:
+            raise ValueError(f"{index_path(path)} has {header['record_size'][0]}-byte records, "
+                             f"expected {INDEX_RECORD.itemsize}")
+        self.start_time = float(header["start_time"][0])
+        records = (os.path.getsize(index_path(path)) - INDEX_HEADER.itemsize) // INDEX_RECORD.itemsize
+        ## np.memmap cannot map an empty file
+        if records > 0:
+            self.index = np.memmap(index_path(path), dtype=INDEX_RECORD, mode="r",
+                                   offset=INDEX_HEADER.itemsize, shape=(records,))
+        else:
+            self.index = np.zeros(0, dtype=INDEX_RECORD)
+        size = os.path.getsize(path)
+        if size > 0:
+            self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+        ## a record whose packet did not make it to disk is not part of the capture
+        if len(self.index) and self.index["offset"][-1] + self.index["length"][-1] > size:
+            ends = self.index["offset"] + self.index["length"]
+            self.index = self.index[:np.searchsorted(ends, size, side="right")]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def duration(self):
+        return float(self.index["time"][-1]) if len(self.index) else 0.0
+
+    def packet(self, n):
+        '''The bytes of packet n, as a read-only array over the memory map.'''
+        record = self.index[n]
+        offset, length = int(record["offset"]), int(record["length"])
+        return self.data[offset:offset + length]
+
+    def config_packets(self):
+        '''Indices of the packets that a config packet ended in.'''
+        return np.flatnonzero(self.index["has_config"])
+
+    def packet_at(self, seconds):
+        '''The first packet read at or after seconds into the capture.'''
+        return int(np.searchsorted(self.index["time"], seconds))
+
+    def config_before(self, n):
+        '''
+        The 18-byte config packet in effect at the start of packet n, or None
+        if there was none yet.
+        '''
+        configs = np.flatnonzero(self.index["has_config"][:n])
+        if len(configs) == 0:
+            return None
+        marker = bytes([CONFIG_MARKER]*2)
+        return marker + self.index["config"][configs[-1]].tobytes() + marker
+
+    def packets(self, start = 0, stop = None):
+        '''
+        Yields packets start to stop (exclusive), led by the config in effect
+        at start, if any, so that they decode with the right scan parameters.
+        Raster data carries no position, so start at one of config_packets()
+        for the pixels to land where they did in the full stream.
+        '''
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start > 0:
+            config = self.config_before(start)
+            if config is not None:
+                yield config
+        for n in range(start, stop):
+            yield self.packet(n)
+
+    def close(self):
+        self.index = self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def replay(reader, write, start = 0, stop = None, speed = None):
+    '''
+    Feeds packets of a capture to write, e.g. ScanStream.writeto or a
+    socket's write, which may be a coroutine function.
+
+    With speed None the packets go as fast as write takes them; otherwise
+    they are paced by their recorded times, speed times as fast as they
+    were read. Returns the number of packets written.
+    '''
+    stop = len(reader) if stop is None else min(stop, len(reader))
+    if start >= stop:
+        return 0
+    times = reader.index["time"]
+    t0 = float(times[start])
+    ## packets() leads with a config, if there is one in effect at start,
+    ## and it goes out with the first of the packets
+    led = 1 if start > 0 and reader.config_before(start) is not None else 0
+    began = time.perf_counter()
+    n = 0
+    for packet in reader.packets(start, stop):
+        if speed is not None and n > led:
+            due = (float(times[start + n - led]) - t0)/speed
+            delay = due - (time.perf_counter() - began)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        result = write(packet)
+        if inspect.isawaitable(result):
+            await result
+        else:
+            ## let the rest of the event loop run between packets
+            await asyncio.sleep(0)
+        n += 1
+    return stop - start
+
+
+def serve(path, speed = None, start = 0, loop = False):
+    '''
+    Serves a capture on the data port, as the applet does with live data, so
+    the GUI can be used offline. Commands are acknowledged and ignored.
+    '''
+    if __package__:
+        from .scan_server import ServerHost
+    else:
+        from scan_server import ServerHost
+
+    async def process_cmds(cmds):
+        print("cmds (ignored in replay):", cmds)
+
+    async def send(packet):
+        await server_host.publish(memoryview(packet))
+
+    async def main():
+        data_server_future = asyncio.get_running_loop().create_future()
+        server_host.start_servers(data_server_future)
+        await data_server_future
+        with CaptureReader(path) as reader:
+            print(f'replaying {len(reader)} packets, {reader.duration:.1f} s, from {path}')
+            while True:
+                await replay(reader, send, start, speed = speed)
+                if not loop:
+                    break
+        await server_host.close()
+
+    server_host = ServerHost(process_cmds, None)
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1:
+        import argparse
+        parser = argparse.ArgumentParser(description="replay a raw capture on the data port")
+        parser.add_argument("path", help="capture file, with its .idx next to it")
+        parser.add_argument("--speed", type=float, default=None,
+                            help="times the recorded rate (default: as fast as possible)")
+        parser.add_argument("--start", type=float, default=0,
+                            help="seconds into the capture to start at")
+        parser.add_argument("--loop", action="store_true", help="replay again when done")
+        args = parser.parse_args()
+        with CaptureReader(args.path) as reader:
+            start = reader.packet_at(args.start)
+        serve(args.path, args.speed, start, args.loop)
+        sys.exit()
+
+    import tempfile
+    from scan_stream import ScanStream
+    from mock_output import generate_raster_packet_with_config
+
+    def mock_capture(path, packets, x_width=400, y_height=300):
+        ## a raster stream whose scan parameters change part way through
+        first = generate_raster_packet_with_config(x_width, y_height, True)
+        second = generate_raster_packet_with_config(x_width, y_height, True, lx=50, ux=350)
+        stream = [bytes(next(first)) for n in range(packets//2)] + \
+                 [bytes(next(second)) for n in range(packets - packets//2)]
+        with CaptureWriter(path) as writer:
+            for packet in stream:
+                writer.write(packet)
+        return stream
+
+    def test_raw_capture(directory):
+        path = os.path.join(directory, "capture.bin")
+        stream = mock_capture(path, 40)
+        with CaptureReader(path) as reader:
+            assert len(reader) == 40
+            assert all(reader.packet(n).tobytes() == stream[n] for n in range(40))
+            assert list(reader.config_packets()) == [0, 20]
+            assert reader.config_before(0) is None
+            assert reader.config_before(25) == stream[20][:18]
+            ## decoding from the second config, at full speed and at a recorded pace,
+            ## gives the same frame as decoding the whole stream
+            direct = ScanStream()
+            for packet in stream:
+                direct.writeto(packet)
+            for speed in (None, 1000.0):
+                replayed = ScanStream()
+                assert asyncio.run(replay(reader, replayed.writeto, 20, speed = speed)) == 20
+                assert (replayed.x_lower, replayed.x_upper) == (50, 350)
+                ## outside the region being scanned, direct still has the earlier frames
+                assert (replayed.buffer[:, 50:350] == direct.buffer[:, 50:350]).all()
+        ## a torn write leaves the index ahead of the data
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 100)
+        with CaptureReader(path) as reader:
+            assert len(reader) == 39
+        print("raw capture: OK")
+
+    def test_replay_pacing(directory, packets=6, interval=0.02):
+        ## each packet of a paced replay goes out no sooner than it was read,
+        ## whether or not a config leads it
+        path = os.path.join(directory, "paced.bin")
+        with CaptureWriter(path) as writer:
+            for n in range(packets):
+                writer.write(bytes([n])*16)
+                time.sleep(interval)
+        with CaptureReader(path) as reader:
+            times = reader.index["time"] - reader.index["time"][0]
+            sent = []
+            began = time.perf_counter()
+            def write(packet):
+                sent.append(time.perf_counter() - began)
+            assert asyncio.run(replay(reader, write, speed = 1.0)) == packets
+            assert len(sent) == packets
+            assert all(sent[n] >= times[n] - 0.002 for n in range(packets))
+            assert sent[-1] < times[-1] + interval
+        print("replay pacing: OK")
+
+    def bench_raw_capture(directory, packets=4096):
+        path = os.path.join(directory, "bench.bin")
+        packet = bytes(np.random.default_rng(0).integers(0, 255, 16384, dtype=np.uint8))
+        start = time.perf_counter()
+        with CaptureWriter(path) as writer:
+            for n in range(packets):
+                writer.write(packet)
+        written = time.perf_counter()
+        with CaptureReader(path) as reader:
+            stream = ScanStream()
+            n = asyncio.run(replay(reader, stream.writeto))
+        replayed = time.perf_counter()
+        print(f'{packets*16384/(written - start)/1e6:.0f} MB/s captured, '
+              f'{n*16384/(replayed - written)/1e6:.0f} MB/s replayed into ScanStream')
+
+    with tempfile.TemporaryDirectory() as directory:
+        test_raw_capture(directory)
+        test_replay_pacing(directory)
+        bench_raw_capture(directory)
@@ -0,0 +1,111 @@
+class RingBuffer:
+    """
+    A fixed-capacity byte ring that is written in arbitrary amounts and read in whole chunks.
+
+    The storage is allocated once. Since ``capacity`` is a multiple of ``chunk_size`` and reads
+    always consume whole chunks, a chunk never straddles the end of the storage, and every chunk
+    can be handed out as a ``memoryview`` into the ring without copying.
+    """
+    def __init__(self, capacity=64*16384, chunk_size=16384):
+        assert capacity % chunk_size == 0, "capacity must be a multiple of chunk_size"
+        self._storage    = bytearray(capacity)
+        self._view       = memoryview(self._storage)
+        self._capacity   = capacity
+        self._chunk_size = chunk_size
+        self._rpos   = 0
+        self._length = 0
+        self._rtotal = 0
+        self._wtotal = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    def __len__(self):
+        """Number of bytes written and not yet read."""
+        return self._length
+
+    def writable(self):
+        """Number of bytes that can be written without overrunning unread data."""
+        return self._capacity - self._length
+
+    def clear(self):
+        """Discard all unread data."""
+        self._rpos   = 0
+        self._length = 0
+
+    def write_view(self):
+        """
+        Return a ``memoryview`` of the largest contiguous free region, for filling in place
+        (e.g. with ``recv_into``). Call :meth:`commit` with the number of bytes filled.
+        """
+        wpos = (self._rpos + self._length) % self._capacity
+        if wpos >= self._rpos and self._length < self._capacity:
+            end = self._capacity
+        else:
+            end = self._rpos
+        return self._view[wpos:end]
+
+    def commit(self, length):
+        """Mark ``length`` bytes filled through :meth:`write_view` as written."""
+        if length > self._capacity - self._length:
+            raise BufferError(f"cannot commit {length} bytes, "
+                              f"only {self._capacity - self._length} free")
+        self._length += length
+        self._wtotal += length
+
+    def write(self, data):
+        """Copy ``data`` into the ring, wrapping around the end of the storage if needed."""
+        data = memoryview(data).cast("B")
+        if len(data) > self._capacity - self._length:
+            raise BufferError(f"cannot write {len(data)} bytes, "
+                              f"only {self._capacity - self._length} free")
+        while data:
+            region = self.write_view()
+            length = min(len(region), len(data))
+            region[:length] = data[:length]
+            self.commit(length)
+            data = data[length:]
+
+    def chunks(self):
+        """
+        Yield each complete unread chunk as a ``memoryview`` into the ring.
+
+        A chunk is consumed once the consumer asks for the next one (or finishes iterating),
+        so the view stays valid while it is being parsed.
+        """
+        while self._length >= self._chunk_size:
+            yield self._view[self._rpos:self._rpos + self._chunk_size]
+            self._rpos = (self._rpos + self._chunk_size) % self._capacity
+            self._length -= self._chunk_size
+            self._rtotal += self._chunk_size
+
+
+if __name__ == "__main__":
+    def test_ring_buffer():
+        ring = RingBuffer(capacity=4*8, chunk_size=8)
+        stream = bytes(n % 251 for n in range(4096))
+        received = bytearray()
+        offset = 0
+        ## odd write sizes force the write side to wrap at every position
+        for size in [3, 5, 13, 1, 7, 29, 2, 11] * 8:
+            size = min(size, ring.writable())
+            ring.write(stream[offset:offset + size])
+            offset += size
+            for chunk in ring.chunks():
+                assert len(chunk) == 8
+                received.extend(chunk)
+        assert received == stream[:len(received)]
+        assert len(received) + len(ring) == offset
+        try:
+            ring.write(bytes(ring.writable() + 1))
+            assert False, "overrun not detected"
+        except BufferError:
+            pass
+        print("ring buffer: OK")
+
+    test_ring_buffer()
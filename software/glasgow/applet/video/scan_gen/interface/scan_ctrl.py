@@ -26,6 +26,10 @@ class frame_vars:
     y_lower_limit = "ly"
     y_upper_limit = "uy"
     dwell_time = "dw"
+    boxcar_average = "ba"
+    compress_output = "co"
+    vector_commands = "vc"
+    serpentine = "sr"
 
 class cmd_encoder:
     def set_scan_mode(self, scan_mode):
@@ -49,60 +53,59 @@ def test_cmd_encoder():
 
 
 class ScanCtrl:
-    def __init__(self):
-        self.cmd = cmd_encoder()
-
+    ## each method returns a list of (code, value) commands; lists can be
+    ## concatenated and sent as one request (see cmd_protocol)
     def set_scan_mode(self, val):
-        msg = "sc0000" + str(val)
-        return msg
+        return [("sc", val)]
 
     def set_frame_resolution(self, x_resolution_val, y_resolution_val):
-        msg1 = self.cmd.set_frame(frame_vars.x_full_frame_resolution, x_resolution_val)
-        msg2 = self.cmd.set_frame(frame_vars.y_full_frame_resolution, y_resolution_val)
-        return (msg1+msg2)
+        return [(frame_vars.x_full_frame_resolution, x_resolution_val),
+                (frame_vars.y_full_frame_resolution, y_resolution_val)]
 
     def set_x_resolution(self, x_resolution_val):
-        msg = self.cmd.set_frame(frame_vars.x_full_frame_resolution, x_resolution_val)
-        return msg
+        return [(frame_vars.x_full_frame_resolution, x_resolution_val)]
 
     def set_y_resolution(self, y_resolution_val):
-        msg = self.cmd.set_frame(frame_vars.y_full_frame_resolution, y_resolution_val)
-        return msg
+        return [(frame_vars.y_full_frame_resolution, y_resolution_val)]
 
     def set_dwell_time(self, dwell_val):
-        msg = self.cmd.set_frame(frame_vars.dwell_time, dwell_val)
-        return msg
+        return [(frame_vars.dwell_time, dwell_val)]
 
-    def set_ROI(self, x_upper, x_lower, y_upper, y_lower):
-        msg1 = self.cmd.set_frame(frame_vars.x_upper_limit, x_upper)
-        msg2 = self.cmd.set_frame(frame_vars.x_lower_limit, x_lower)
-        msg3 = self.cmd.set_frame(frame_vars.y_upper_limit, y_upper)
-        msg4 = self.cmd.set_frame(frame_vars.y_lower_limit, y_lower)
-        return (msg1+msg2+msg3+msg4)
+    def set_boxcar_average(self, val):
+        return [(frame_vars.boxcar_average, val)]
+
+    def set_compress_output(self, val):
+        return [(frame_vars.compress_output, val)]
 
+    def set_vector_commands(self, val):
+        return [(frame_vars.vector_commands, val)]
+
+    def set_serpentine(self, val):
+        return [(frame_vars.serpentine, val)]
+
+    def set_ROI(self, x_upper, x_lower, y_upper, y_lower):
+        return [(frame_vars.x_upper_limit, x_upper),
+                (frame_vars.x_lower_limit, x_lower),
+                (frame_vars.y_upper_limit, y_upper),
+                (frame_vars.y_lower_limit, y_lower)]
 
     def raise_config_flag(self):
-        msg = self.cmd.set_data_format(data_format.config, True)   
-        return msg
+        return [(data_format.config, 1)]
     
     def lower_config_flag(self):
-        msg = self.cmd.set_data_format(data_format.config, False)   
-        return msg
+        return [(data_format.config, 0)]
+
+    def strobe_config(self):
+        return self.raise_config_flag() + self.lower_config_flag()
 
     def pause(self):
-        msg = self.cmd.set_data_format(data_format.pause, 0)   
-        return msg
+        return [(data_format.pause, 0)]
     
     def unpause(self):
-        msg = self.cmd.set_data_format(data_format.pause, 1)   
-        return msg
+        return [(data_format.pause, 1)]
 
     def set_8bit_output(self):
-        msg = self.cmd.set_data_format(data_format.eight_bit, True)   
-        return msg
+        return [(data_format.eight_bit, 1)]
     
     def set_16bit_output(self):
-        msg = self.cmd.set_data_format(data_format.eight_bit, False)   
-        return msg
-
-
+        return [(data_format.eight_bit, 0)]
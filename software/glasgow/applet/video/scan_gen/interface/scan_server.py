@@ -1,32 +1,207 @@
 import asyncio
-import functools
+import collections
+import logging
+import time
 import sys
 
+if __package__:
+    from .cmd_protocol import read_request, encode_ack, ACK_OK, ACK_ERROR
+else:
+    from cmd_protocol import read_request, encode_ack, ACK_OK, ACK_ERROR
+
 
 async def get_data():
     data = bytes([5]*16384)
     return data
     #future.set_result(data)
 
+
+## What a subscriber's queue does when the subscriber falls behind:
+##   block        hold up publishing (and so reading from the device) until there is room
+##   drop-oldest  make room by discarding the oldest packet waiting
+##   decimate     once the queue is half full, only take every nth packet; drop if full
+POLICIES = ("block", "drop-oldest", "decimate")
+
+## Commands handled by the server itself, not passed on to process_cmds:
+##   ds  bind this command session to the data connection whose client port is the value
+##   sp  backpressure policy of the bound data connection, an index into POLICIES
+##   sn  decimation factor of the bound data connection
+SERVER_COMMANDS = ("ds", "sp", "sn")
+
+
+class SubscriberStats:
+    '''
+    Counters for one data connection: packets and bytes sent, packets
+    dropped by its policy, the deepest its queue has been, and the time
+    publishing was held up by it (block policy only).
+    '''
+    def __init__(self, name, policy):
+        self.name = name
+        self.policy = policy
+        self.connected_at = time.perf_counter()
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.blocked_time = 0.0
+
+    @property
+    def mb_per_s(self):
+        return self.bytes/max(time.perf_counter() - self.connected_at, 1e-9)/1e6
+
+    def __str__(self):
+        return (f"{self.name} ({self.policy}): {self.packets} packets, {self.mb_per_s:.1f} MB/s, "
+                f"{self.dropped} dropped, max depth {self.max_depth}, "
+                f"blocked {self.blocked_time:.3f} s")
+
+
+class Subscriber:
+    '''
+    One data connection, with its own queue of packets waiting to be sent,
+    and its own policy for when the queue is full (see POLICIES).
+
+    Raster data carries no position, so a client that has packets dropped
+    sees its pixels shift until the next config packet or frame marker.
+    '''
+    def __init__(self, reader, writer, depth = 64, policy = "block", decimation = 4):
+        self.reader = reader
+        self.writer = writer
+        self.depth = depth
+        self.policy = policy
+        self.decimation = decimation
+        self.queue = collections.deque()
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._room = asyncio.Event()
+        self._offered = 0
+        peer = writer.get_extra_info('peername')
+        ## the client's end of the connection, which it names to bind its command session
+        self.port = peer[1] if peer else None
+        self.stats = SubscriberStats(f'{peer[0]}:{peer[1]}' if peer else "subscriber", policy)
+
+    def set_policy(self, policy, decimation = None):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown policy {policy!r}, expected one of {POLICIES}")
+        self.policy = self.stats.policy = policy
+        if decimation is not None:
+            if decimation < 1:
+                raise ValueError(f"cannot decimate by {decimation}")
+            self.decimation = decimation
+        self._room.set()
+
+    async def put(self, packet):
+        if self.closed:
+            return
+        if self.policy == "decimate" and len(self.queue) >= self.depth//2:
+            self._offered += 1
+            if self._offered % self.decimation:
+                self.stats.dropped += 1
+                return
+        if len(self.queue) >= self.depth:
+            if self.policy == "block":
+                started_at = time.perf_counter()
+                while len(self.queue) >= self.depth and not self.closed and self.policy == "block":
+                    self._room.clear()
+                    await self._room.wait()
+                self.stats.blocked_time += time.perf_counter() - started_at
+                if self.closed:
+                    return
+            if len(self.queue) >= self.depth:
+                if self.policy == "drop-oldest":
+                    self.queue.popleft()
+                else:
+                    self.stats.dropped += 1
+                    return
+                self.stats.dropped += 1
+        self.queue.append(packet)
+        self.stats.max_depth = max(self.stats.max_depth, len(self.queue))
+        self._ready.set()
+
+    async def run(self):
+        '''Send queued packets until the connection closes, or close() is called and the queue is empty.'''
+        try:
+            while True:
+                while not self.queue:
+                    if self.closed:
+                        return
+                    self._ready.clear()
+                    await self._ready.wait()
+                packet = self.queue.popleft()
+                self._room.set()
+                self.writer.write(packet)
+                await self.writer.drain()
+                self.stats.packets += 1
+                self.stats.bytes += len(packet)
+        except ConnectionError:
+            pass
+        finally:
+            self.closed = True
+            self._room.set()
+            self.writer.close()
+
+    def close(self):
+        '''Stop taking packets; the ones queued are still sent.'''
+        self.closed = True
+        self._ready.set()
+        self._room.set()
+
+    def abort(self):
+        '''Stop taking packets, and drop the ones queued.'''
+        self.queue.clear()
+        self.close()
+
+
+class CommandSession:
+    '''One command connection, and the data connection it is bound to, if any.'''
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.subscriber = None
+        self.requests = 0
+
+
 class ServerHost:
-    def __init__(self, process_cmd, queue):
+    '''
+    Serves commands on PORT and scan data on PORT + 1, to any number of
+    clients at once: e.g. a recorder, a live viewer and an analysis client.
+
+    Every packet given to publish() goes to every data connection, through
+    a queue of its own, so each can have its own backpressure policy (see
+    POLICIES), set by the client over its command session. Each command
+    connection is a session of its own, whose requests are answered in
+    order.
+
+    data_reader and data_writer are those of the oldest data connection
+    still open, which is the one patterns are read from; both are None
+    while no data client is connected (see wait_data_reader()).
+    '''
+    def __init__(self, process_cmds, queue, depth = 64, policy = "block", decimation = 4,
+                 logger = None):
         self.streaming = None
         self.HOST = "127.0.0.1"  # Standard loopback interface address (localhost)
         self.PORT = 1237  # Port to listen on (non-privileged ports are > 1023)
         self.queue = queue
-        self.process_cmd = process_cmd
+        self.process_cmds = process_cmds
+        self.depth = depth
+        self.policy = policy
+        self.decimation = decimation
+        self.subscribers = []
+        ## set whenever a data client connects
+        self.data_connected = asyncio.Event()
+        self.sessions = []
+        self._tasks = set()
+        self._logger = logger or logging.getLogger(__name__)
 
 
     def start_servers(self, data_server_future):
         self.data_server_future = data_server_future
         try:
-            # self.cmd_reader_future = future
             loop = asyncio.get_event_loop()
             loop.create_task(self.start_cmd_server(self.HOST, self.PORT))
             loop.create_task(self.start_data_server(self.HOST, self.PORT+1))
         except Exception as e:
             print("error:", e)
-    
+
     async def start_cmd_server(self, host, port):
         print("starting cmd server at", host, port)
         self.cmd_server = await asyncio.start_server(self.handle_cmd, host, port)
@@ -34,49 +209,118 @@ class ServerHost:
 
     async def start_data_server(self, host, port):
         print("starting data server at", host, port)
-        #self.streaming = True
         self.data_server = await asyncio.start_server(self.handle_data, host, port)
         await self.data_server.serve_forever()
 
-    # async def stopdata(self):
-    #     print("closing data writer")
-    #     self.streaming.cancel()
-    #     self.data_writer.close()
-    #     await self.data_writer.wait_closed()
+    @property
+    def data_reader(self):
+        subscriber = self._oldest_open()
+        return subscriber.reader if subscriber else None
+
+    @property
+    def data_writer(self):
+        subscriber = self._oldest_open()
+        return subscriber.writer if subscriber else None
+
+    def _oldest_open(self):
+        return next((subscriber for subscriber in self.subscribers if not subscriber.closed), None)
+
+    async def wait_data_reader(self):
+        '''Return data_reader, waiting for a data client to connect if there is none.'''
+        while self.data_reader is None:
+            self.data_connected.clear()
+            await self.data_connected.wait()
+        return self.data_reader
+
+    def drop_data_connection(self, reader):
+        '''Close the data connection reader belongs to, e.g. once its client has hung up.'''
+        for subscriber in self.subscribers:
+            if subscriber.reader is reader:
+                subscriber.abort()
+
+    @property
+    def stats(self):
+        return [subscriber.stats for subscriber in self.subscribers]
+
+    def log_stats(self, level = logging.DEBUG):
+        for stats in self.stats:
+            self._logger.log(level, "subscriber %s", stats)
+
+    async def publish(self, packet):
+        '''Queue packet for every data connection; waits only on those with the block policy.'''
+        for subscriber in list(self.subscribers):
+            await subscriber.put(packet)
 
     async def handle_cmd(self, reader, writer):
-        self.cmd_reader = reader
-        self.cmd_writer = writer
-        #loop = asyncio.get_running_loop()
-        #self.cmd_server_closed_future = loop.create_future()
-        #loop.create_task(self.read_cmds())
-    #async def read_cmds(self):
-        async def read_cmd():
-            print("awaiting cmd read")
-            data = await self.cmd_reader.readexactly(7)
-            message = data.decode()
-            print("cmd:", message)
-            self.queue.submit(self.process_cmd(message))
-            await self.queue.poll()
-            #await self.process_cmd(message)
-
-        await read_cmd()
-        while len(self.cmd_reader._buffer) >= 7:
+        ## one connection carries every request from a client, until it closes
+        session = CommandSession(reader, writer)
+        self.sessions.append(session)
+        print("cmd server made connection")
+        while True:
             try:
-                print("reading additional cmds")
-                await read_cmd()
-            except asyncio.IncompleteReadError:
-                print("unable to read 7 bytes from cmd stream")
+                request_id, commands = await read_request(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                print("cmd client disconnected")
                 break
+            session.requests += 1
+            print(f'cmds {request_id}: {commands}')
+            try:
+                device_commands = [(c, val) for c, val in commands if c not in SERVER_COMMANDS]
+                for c, val in commands:
+                    if c in SERVER_COMMANDS:
+                        self.process_server_cmd(session, c, val)
+                if device_commands:
+                    await self.process_cmds(device_commands)
+                status = ACK_OK
+            except Exception as err:
+                print(f'error processing cmds {request_id}: {err}')
+                status = ACK_ERROR
+            writer.write(encode_ack(request_id, status))
+            await writer.drain()
+        self.sessions.remove(session)
+        writer.close()
 
+    def process_server_cmd(self, session, c, val):
+        if c == "ds":
+            for subscriber in self.subscribers:
+                if subscriber.port == val:
+                    session.subscriber = subscriber
+                    return
+            raise ValueError(f"no data connection from port {val}")
+        if session.subscriber is None:
+            raise ValueError(f"{c} needs the session bound to a data connection (ds) first")
+        if c == "sp":
+            if val >= len(POLICIES):
+                raise ValueError(f"unknown policy {val}")
+            session.subscriber.set_policy(POLICIES[val])
+        elif c == "sn":
+            session.subscriber.set_policy(session.subscriber.policy, val)
 
     async def handle_data(self, reader, writer):
-        self.data_reader = reader
-        self.data_writer = writer
-        print("data server made connection")
-        addr = writer.get_extra_info('peername')
-        print(f"addr: {addr!r}")
-        self.data_server_future.set_result("done")
+        subscriber = Subscriber(reader, writer, self.depth, self.policy, self.decimation)
+        self.subscribers.append(subscriber)
+        self.data_connected.set()
+        print(f"data server made connection: {subscriber.stats.name}")
+        if not self.data_server_future.done():
+            self.data_server_future.set_result("done")
+        task = asyncio.ensure_future(subscriber.run())
+        self._tasks.add(task)
+        try:
+            await task
+        finally:
+            self._tasks.discard(task)
+            self.subscribers.remove(subscriber)
+            self._logger.info("subscriber disconnected: %s", subscriber.stats)
+
+    async def close(self):
+        '''Send what is queued to each data connection, then close them and stop serving.'''
+        for subscriber in list(self.subscribers):
+            subscriber.close()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        for server in (getattr(self, "cmd_server", None), getattr(self, "data_server", None)):
+            if server is not None:
+                server.close()
 
 
 
@@ -86,11 +330,113 @@ def main():
     queue = TaskQueue()
     loop = asyncio.get_event_loop()
     data_server_future = loop.create_future()
-    def process_cmd(cmd):
-        print("cmd:", cmd)
-    server_host = ServerHost(queue, process_cmd)
+    async def process_cmds(cmds):
+        print("cmds:", cmds)
+    server_host = ServerHost(process_cmds, queue)
     server_host.start_servers(data_server_future)
     loop.run_forever()
 
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:] != ["test"]:
+        main()
+        sys.exit()
+
+    if __package__:
+        from .cmd_protocol import encode_request, read_ack
+    else:
+        from cmd_protocol import encode_request, read_ack
+
+    def test_fan_out(port = 41337, packets = 600):
+        received_cmds = []
+
+        async def process_cmds(cmds):
+            received_cmds.append(cmds)
+
+        async def client(policy, decimation, delay, bind = True):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port + 1)
+            cmd_reader, cmd_writer = await asyncio.open_connection("127.0.0.1", port)
+            data_port = writer.get_extra_info('sockname')[1]
+            ## each client sets its own policy over its own command session
+            commands = [("ds", data_port), ("sp", POLICIES.index(policy)), ("sn", decimation)]
+            cmd_writer.write(encode_request(1, commands if bind else commands[1:]))
+            cmd_writer.write(encode_request(2, [("rx", 512)]))
+            acks = [await read_ack(cmd_reader), await read_ack(cmd_reader)]
+            received = []
+            ## a slow client takes a packet at a time, and more than the socket buffers
+            ## can hold is published, so its queue fills up
+            while data := await reader.read(16384 if delay else 1 << 20):
+                received.append(data)
+                await asyncio.sleep(delay)
+            cmd_writer.close()
+            return acks, b"".join(received)
+
+        async def run():
+            server_host = ServerHost(process_cmds, None, depth = 8)
+            server_host.PORT = port
+            server_host.start_servers(asyncio.get_running_loop().create_future())
+            await asyncio.sleep(0.1)
+            clients = [asyncio.ensure_future(client(*args)) for args in
+                       (("block", 1, 0), ("drop-oldest", 1, 0.002), ("decimate", 4, 0.002),
+                        ("drop-oldest", 1, 0, False))]
+            while len(server_host.subscribers) < 4 or len(received_cmds) < 4:
+                await asyncio.sleep(0.01)
+            stats = {subscriber.stats.name: subscriber.stats for subscriber in server_host.subscribers}
+            policies = [subscriber.policy for subscriber in server_host.subscribers]
+            for n in range(packets):
+                await server_host.publish(bytes([n % 256])*16384)
+            await server_host.close()
+            return policies, list(stats.values()), await asyncio.gather(*clients)
+
+        policies, stats, results = asyncio.run(run())
+        assert sorted(policies) == sorted(["block", "drop-oldest", "decimate", "block"])
+        assert received_cmds == [[("rx", 512)]]*4
+        (block_acks, block), (drop_acks, dropped), (decimate_acks, decimated), (unbound_acks, unbound) = results
+        assert block_acks == drop_acks == decimate_acks == [(1, ACK_OK), (2, ACK_OK)]
+        ## sp without ds has no data connection to apply to
+        assert unbound_acks == [(1, ACK_ERROR), (2, ACK_OK)]
+        ## a blocking subscriber gets everything, in order; the others fall behind and lose packets
+        assert block == b"".join(bytes([n % 256])*16384 for n in range(packets))
+        assert len(dropped) < len(block) and len(decimated) < len(block)
+        by_policy = {s.policy: s for s in stats}
+        blocking = [s for s in stats if s.policy == "block"]
+        assert all(s.dropped == 0 for s in blocking) and max(s.blocked_time for s in blocking) > 0
+        assert by_policy["drop-oldest"].dropped == packets - len(dropped)//16384
+        assert by_policy["decimate"].dropped == packets - len(decimated)//16384
+        print("fan-out server: OK")
+        for s in stats:
+            print(f"  {s}")
+
+    def test_reconnect(port = 41339):
+        async def run():
+            server_host = ServerHost(None, None)
+            server_host.PORT = port
+            server_host.start_servers(asyncio.get_running_loop().create_future())
+            await asyncio.sleep(0.1)
+            assert server_host.data_reader is None
+            for n in range(2):
+                ## a pattern reader waits for a connection rather than failing without one
+                waiting = asyncio.ensure_future(server_host.wait_data_reader())
+                await asyncio.sleep(0.05)
+                assert not waiting.done()
+                _, writer = await asyncio.open_connection("127.0.0.1", port + 1)
+                writer.write(bytes([n])*4)
+                reader = await asyncio.wait_for(waiting, 1)
+                assert await reader.readexactly(4) == bytes([n])*4
+                ## the client hangs up; its connection is not waited on again
+                writer.close()
+                try:
+                    await reader.readexactly(4)
+                    assert False
+                except asyncio.IncompleteReadError:
+                    server_host.drop_data_connection(reader)
+                assert server_host.data_reader is None
+                while server_host.subscribers:
+                    await asyncio.sleep(0.01)
+            await server_host.close()
+
+        asyncio.run(run())
+        print("reconnecting pattern client: OK")
+
+    test_fan_out()
+    test_reconnect()
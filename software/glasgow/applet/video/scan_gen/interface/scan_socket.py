@@ -7,11 +7,19 @@ if __name__ == "interface.scan_socket":
     sys.path.append(path)
     from interface.scan_ctrl import ScanCtrl
     from interface.scan_stream import ScanStream
+    from interface.ring_buffer import RingBuffer
+    from interface.raw_capture import CaptureWriter
+    from interface.cmd_protocol import encode_request, read_ack, ACK_OK, CommandError
+    from interface.scan_server import POLICIES
     from pattern_generators.patterngen_utils import packet_from_generator
 
 else:
     from scan_ctrl import ScanCtrl
     from scan_stream import ScanStream
+    from ring_buffer import RingBuffer
+    from raw_capture import CaptureWriter
+    from cmd_protocol import encode_request, read_ack, ACK_OK, CommandError
+    from scan_server import POLICIES
     from ..pattern_generators.patterngen_utils import packet_from_generator
 
 import logging
@@ -25,20 +33,32 @@ import time
 
 class ConnectionManager:
     def __init__(self):
-        self.scan_stream = ScanStream()
+        ## received bytes are written once into this ring and parsed in place
+        self.stream_buffer = RingBuffer(chunk_size = 16384)
+        self.scan_stream = ScanStream(self.stream_buffer)
         self.scan_ctrl = ScanCtrl()
 
         self.data_writer = None
         self.data_reader = None
 
+        ## one command connection, opened on first use; requests on it are
+        ## answered in order, so only one may be outstanding at a time
+        self.cmd_writer = None
+        self.cmd_reader = None
+        self.cmd_lock = asyncio.Lock()
+        self.request_id = 0
+
         self.stream_pattern = False
 
         self.scan_mode = 0
 
         self.pattern_loop = None
         self.pattern_done = False
+        ## vector patterns are sent as commands, see set_vector_commands
+        self.vector_commands = False
 
-        # self.text_file = open("socket_packets.txt", "w")
+        ## received data is also appended here while capturing, see start_capture
+        self.capture = None
 
         self.logging = False
 
@@ -59,7 +79,7 @@ class ConnectionManager:
     
     def set_patterngen(self, gen):
         print(f'gen: {gen}')
-        self.pattern_loop = packet_from_generator(gen)
+        self.pattern_loop = packet_from_generator(gen, vector_commands = self.vector_commands)
         print(f'pattern loop: {self.pattern_loop}')
         self.pattern_done = False
 
@@ -104,16 +124,19 @@ class ConnectionManager:
                             r = await self.write_points(n)
                             print("result", r)
                     await asyncio.sleep(0)
-                    data = await reader.readexactly(16384)
+                    if self.stream_pattern == True:
+                        ## keep patterns paced at one 16384-byte read per write
+                        data = await reader.readexactly(16384)
+                    else:
+                        data = await reader.read(self.stream_buffer.writable())
                     n += 1
                     if print_debug:
                         print(f'recieved data {n}')
                     logger.info(f'recieved data {n}, length {len(data)}')
-                    if self.logging:
-                        self.text_file.write("=====Received=====\n")
-                        self.text_file.write(str(list(data)))
-                        logger.info(f'wrote data {n} to text file')
-                    self.scan_stream.writeto(data)
+                    if self.capture is not None:
+                        self.capture.write(data)
+                    self.stream_buffer.write(data)
+                    self.scan_stream.readfrom()
 
                 else:
                     print("at eof?")
@@ -128,6 +151,17 @@ class ConnectionManager:
                     logging.debug("continous read error" + repr(reader))
                 break
 
+    def start_capture(self, path):
+        ## raw packets with an index, for replay with raw_capture.py
+        self.stop_capture()
+        self.capture = CaptureWriter(path)
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            logger.info(f'captured {self.capture.packets} packets to {self.capture.path}')
+            self.capture = None
+
     async def open_data_client(self):
         host = "127.0.0.1"  # Standard loopback interface address (localhost)
         port = 1238  # Port to listen on (non-privileged ports are > 1023)
@@ -142,7 +176,7 @@ class ConnectionManager:
     async def open_cmd_client(self):
         host = "127.0.0.1"  # Standard loopback interface address (localhost)
         port = 1237  # Port to listen on (non-privileged ports are > 1023)
-        print("opening data client")
+        print("opening cmd client")
         loop = asyncio.get_event_loop()
         future_con = loop.create_future()
         loop.create_task(self.open_connection(host, port, future_con))
@@ -150,20 +184,35 @@ class ConnectionManager:
         self.cmd_reader, self.cmd_writer = await future_con
         #await self.start_reading()
 
-    async def cmd_client(self, message, print_debug = True):
-        HOST = "127.0.0.1"  # Standard loopback interface address (localhost)
-        PORT = 1237  # Port to listen on (non-privileged ports are > 1023)
-        loop = asyncio.get_event_loop()
-        future_con = loop.create_future()
-        loop.create_task(self.open_connection(HOST, PORT, future_con))
-        await asyncio.sleep(0)
-        reader, writer = await future_con
-        if print_debug:
-            print(f'Send: {message!r}')
-        writer.write(message.encode())
-        await writer.drain()
+    async def send_cmds(self, commands, print_debug = True):
+        async with self.cmd_lock:
+            if self.cmd_writer is None:
+                await self.open_cmd_client()
+            self.request_id = (self.request_id + 1) % 65536
+            if print_debug:
+                print(f'Send {self.request_id}: {commands!r}')
+            try:
+                self.cmd_writer.write(encode_request(self.request_id, commands))
+                await self.cmd_writer.drain()
+                request_id, status = await read_ack(self.cmd_reader)
+                if request_id != self.request_id:
+                    raise CommandError(f'expected ack for request {self.request_id}, got {request_id}')
+            except Exception:
+                ## the connection is dead or out of step; the next command opens a new one
+                self.cmd_writer.close()
+                self.cmd_writer = self.cmd_reader = None
+                raise
+        if status != ACK_OK:
+            raise CommandError(f'request {request_id} failed: {commands!r}')
         if print_debug:
-            print("sent")
+            print(f'ack {request_id}')
+
+    async def set_subscription(self, policy = "block", decimation = 4):
+        ## what the server does with this client's data when it falls behind,
+        ## see scan_server.POLICIES; the data connection must be open
+        data_port = self.data_writer.get_extra_info('sockname')[1]
+        await self.send_cmds([("ds", data_port), ("sp", POLICIES.index(policy)),
+                              ("sn", decimation)])
 
     async def start_reading(self):
         print("start reading")
@@ -174,37 +223,65 @@ class ScanInterface(ConnectionManager):
     def __init__(self):
         super().__init__()
 
+    async def send(self, *cmd_lists):
+        ## any number of ScanCtrl command lists, as one request
+        await self.send_cmds([cmd for cmd_list in cmd_lists for cmd in cmd_list])
+
     async def strobe_config(self):
-        await self.cmd_client(self.scan_ctrl.raise_config_flag())
-        await self.cmd_client(self.scan_ctrl.lower_config_flag())
+        await self.send(self.scan_ctrl.strobe_config())
 
     async def set_x_resolution(self, xval):
-        await self.cmd_client(self.scan_ctrl.set_x_resolution(xval))
+        await self.send(self.scan_ctrl.set_x_resolution(xval))
 
     async def set_y_resolution(self, yval):
-        await self.cmd_client(self.scan_ctrl.set_y_resolution(yval))
+        await self.send(self.scan_ctrl.set_y_resolution(yval))
 
     async def set_dwell_time(self, dval):
-        await self.cmd_client(self.scan_ctrl.set_dwell_time(dval))
+        await self.send(self.scan_ctrl.set_dwell_time(dval))
+
+    async def set_boxcar_average(self, val):
+        await self.send(self.scan_ctrl.set_boxcar_average(val))
+
+    async def set_compress_output(self, val):
+        await self.send(self.scan_ctrl.set_compress_output(val))
+
+    async def set_serpentine(self, val):
+        await self.send(self.scan_ctrl.set_serpentine(val))
+
+    async def set_vector_commands(self, val):
+        ## applies to patterns set after it, from the next config strobe
+        self.vector_commands = bool(val)
+        await self.send(self.scan_ctrl.set_vector_commands(val))
 
     async def set_scan_mode(self, mode):
         self.scan_mode = mode
-        await self.cmd_client(self.scan_ctrl.set_scan_mode(mode))
+        await self.send(self.scan_ctrl.set_scan_mode(mode))
 
     async def set_8bit_output(self):
-        await self.cmd_client(self.scan_ctrl.set_8bit_output())
+        await self.send(self.scan_ctrl.set_8bit_output())
     
     async def set_16bit_output(self):
-        await self.cmd_client(self.scan_ctrl.set_16bit_output())
+        await self.send(self.scan_ctrl.set_16bit_output())
     
     async def pause(self):
-        await self.cmd_client(self.scan_ctrl.pause())
+        await self.send(self.scan_ctrl.pause())
 
     async def unpause(self):
-        await self.cmd_client(self.scan_ctrl.unpause())
+        await self.send(self.scan_ctrl.unpause())
 
     async def set_ROI(self, x_upper, x_lower, y_upper, y_lower):
-        await self.cmd_client(self.scan_ctrl.set_ROI(x_upper, x_lower, y_upper, y_lower))
+        await self.send(self.scan_ctrl.set_ROI(x_upper, x_lower, y_upper, y_lower))
+
+    async def configure(self, x_resolution, y_resolution, mode, eight_bit_output,
+                        x_upper = 0, x_lower = 0, y_upper = 0, y_lower = 0):
+        ## a full reconfigure, ending with a config strobe, in one round trip
+        self.scan_mode = mode
+        await self.send(
+            self.scan_ctrl.set_frame_resolution(x_resolution, y_resolution),
+            self.scan_ctrl.set_ROI(x_upper, x_lower, y_upper, y_lower),
+            self.scan_ctrl.set_scan_mode(mode),
+            self.scan_ctrl.set_8bit_output() if eight_bit_output else self.scan_ctrl.set_16bit_output(),
+            self.scan_ctrl.strobe_config())
 
 
 
@@ -214,18 +291,12 @@ async def main():
     con.logging = True
 
     async def raster_test():
-        await con.set_x_resolution(400)
-        await con.set_y_resolution(400)
-        await con.set_scan_mode(1)
-        await con.strobe_config()
+        await con.configure(400, 400, 1, True)
         await con.open_data_client()
         await con.unpause()
 
     async def vector_test():
-        await con.set_x_resolution(1024)
-        await con.set_y_resolution(1024)
-        await con.set_scan_mode(3)
-        await con.strobe_config()
+        await con.configure(1024, 1024, 3, False)
         con.stream_pattern = True
         await con.open_data_client()
         await con.unpause()
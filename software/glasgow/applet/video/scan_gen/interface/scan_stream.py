@@ -1,4 +1,3 @@
-import re
 import array
 import numpy as np
 import time
@@ -6,6 +5,17 @@ import time
 #import matplotlib.pyplot as plt
 #from mock_output import generate_raster_packet_with_config, generate_vector_packet, get_two_bytes
 
+if __package__:
+    from .ring_buffer import RingBuffer
+    from .config_scanner import ConfigScanner
+    from .frame_integrator import FrameIntegrator
+    from .pixel_decoder import PixelDecoder
+else:
+    from ring_buffer import RingBuffer
+    from config_scanner import ConfigScanner
+    from frame_integrator import FrameIntegrator
+    from pixel_decoder import PixelDecoder
+
 import struct 
 def get_two_bytes(n: int):
     b = struct.pack('H', n)
@@ -13,7 +23,7 @@ def get_two_bytes(n: int):
     return b2, b1
 
 class ScanStream:
-    def __init__(self):
+    def __init__(self, stream_buffer = None):
         self.y_height = 512
         self.x_width = 512
 
@@ -25,324 +35,312 @@ class ScanStream:
         self.y_upper = self.y_height
         self.y_lower = 0
 
-        ## frame-shaped buffer
-        self.buffer = np.zeros(shape = (self.y_height,self.x_width),dtype = np.uint8) 
-
-        self.config_match = re.compile(b'\xff{2}.{14}\xff{2}', flags=re.DOTALL)
+        ## frame-shaped buffer, a view of _storage, which is only reallocated
+        ## when a frame does not fit in it
+        self._storage = np.zeros(self.y_height*self.x_width, dtype = np.uint8)
+        self.buffer = self._storage.reshape(self.y_height, self.x_width)
+        ## rows [start, stop) of buffer written since the display last took them
+        self.dirty_rows = None
+        ## integrates successive frames as they arrive, see set_integration
+        self.integrator = None
+        ## called with display_buffer and scan_parameters() as each raster frame
+        ## completes, before the next one starts overwriting it
+        self.frame_listeners = []
+
+        ## finds config packets, including ones split across two packets
+        self.config_scanner = ConfigScanner()
 
         self.scan_mode = 0
         self.eight_bit_output = 0
+        ## set by the config packet when the device compresses the 8-bit
+        ## pixel stream, see PixelDecoder
+        self.compressed_output = 0
+        self.pixel_decoder = PixelDecoder()
+        ## set by the config packet when every other line of the region is
+        ## scanned right to left, see XY_Scan_Gen
+        self.serpentine = 0
+
+        ## x, y, dwell of each point in the vector pattern; the device echoes
+        ## the dwell of each point back as a 16-bit value. Setting patterngen
+        ## also clears point_buffer, the place to stash a byte of an
+        ## incomplete echoed point until it is completed in the next packet
         self.patterngen = None
+        self.echo_mismatches = 0
 
-        ## place to stash <6 bytes of an incomplete vector point
-        ## until the point is completed in the next packet
-        self.point_buffer = bytearray()
-
-        ## stream-shaped buffer
-        self._buffer = bytearray()
+        ## stream-shaped buffer, parsed in place one 16384-byte chunk at a time.
+        ## may be shared with whatever receives the stream
+        if stream_buffer is None:
+            stream_buffer = RingBuffer(chunk_size = 16384)
+        self._buffer = stream_buffer
 
         self.totalbytes = 0
+
+        self._update_roi()
     
     def writeto(self, d:bytes, print_debug = False):
         if print_debug:
-            print(f'extend {len(d)} bytes')
-        self._buffer.extend(d)
-        if print_debug:
-            print(f'length: {len(self._buffer)}')
-        self.readfrom()
+            print(f'write {len(d)} bytes')
+        d = memoryview(d).cast('B')
+        while len(d) > 0:
+            ## readfrom leaves less than one chunk behind, so a burst larger
+            ## than the ring is taken in ring-sized pieces
+            length = min(len(d), self._buffer.writable())
+            self._buffer.write(d[:length])
+            d = d[length:]
+            self.readfrom(print_debug)
     
     def readfrom(self, print_debug = False):
         if print_debug:
             print(f'buffer len: {len(self._buffer)}')
-        while len(self._buffer) >= 16384:
+        for chunk in self._buffer.chunks():
             if print_debug:
                 print("chunk 16384")
-            d = self._buffer[:16384]
-            self._buffer = self._buffer[16384:]
-            if print_debug:
-                print(f'new buffer length: {len(self._buffer)}')
-            self.parse_config_from_data(d)
+            self.parse_config_from_data(chunk)
         
 
 
     def clear_buffer(self):
-        self.buffer = np.zeros(shape=(self.y_height, self.x_width),
-                    dtype = np.uint8)
+        frame_size = self.y_height*self.x_width
+        if frame_size > self._storage.size:
+            self._storage = np.zeros(frame_size, dtype = np.uint8)
+        else:
+            self._storage[:frame_size] = 0
+        ## a new view even if the shape is unchanged, so the display sees it changed
+        self.buffer = self._storage[:frame_size].reshape(self.y_height, self.x_width)
+        if self.integrator is not None:
+            self.integrator.resize(self.buffer.shape)
+        self.mark_dirty(0, self.y_height)
         print("cleared buffer")
 
+    def set_integration(self, mode = None, n = 4):
+        '''
+        Integrate frames as they arrive (see FrameIntegrator for the modes), or
+        stop integrating if mode is None. The display shows display_buffer.
+        '''
+        if mode is None:
+            self.integrator = None
+        else:
+            self.integrator = FrameIntegrator(mode, n, self.buffer.shape)
+            self.integrator.first_row = self.y_lower
+        self.mark_dirty(0, self.y_height)
+
+    def scan_parameters(self):
+        '''The scan parameters from the last config packet'''
+        return {"x_width": self.x_width, "y_height": self.y_height,
+                "x_lower": self.x_lower, "x_upper": self.x_upper,
+                "y_lower": self.y_lower, "y_upper": self.y_upper,
+                "scan_mode": self.scan_mode, "eight_bit_output": self.eight_bit_output,
+                "compressed_output": self.compressed_output, "serpentine": self.serpentine}
+
+    def frame_complete(self):
+        for listener in self.frame_listeners:
+            listener(self.display_buffer, self.scan_parameters())
+
+    @property
+    def display_buffer(self):
+        '''The integrated frame when integrating, otherwise buffer; not a copy'''
+        if self.integrator is None:
+            return self.buffer
+        return self.integrator.frame
+
+    def mark_dirty(self, start, stop):
+        if self.dirty_rows is None:
+            self.dirty_rows = (start, stop)
+        else:
+            self.dirty_rows = (min(self.dirty_rows[0], start), max(self.dirty_rows[1], stop))
+
+    def take_dirty_rows(self):
+        '''
+        The rows (start, stop) of buffer written since the last call, or None
+        if nothing changed. If buffer was replaced (on a resolution change or
+        clear_buffer), it is a different array from the one displayed before.
+        '''
+        dirty_rows, self.dirty_rows = self.dirty_rows, None
+        return dirty_rows
+
     def check_left_sync(self):
         b1, b2 = get_two_bytes(self.x_lower)
         print(f'checking if buffer[{self.current_y},{self.x_lower}] == {b2}')
         assert(self.buffer[self.current_y,self.x_lower] == b2)
 
-    
-    def new_points_to_frame(self, m:memoryview, print_debug = True):
-        data_length = len(m)
-        if print_debug:
-            print("\tdata length:", data_length)
-            print("\tframe size (x, y):", self.x_width, self.y_height)
-            print("\tcurrent x, current y:", self.current_x, self.current_y)
-            print("\tx lower, x upper:", self.x_lower, self.x_upper)
-            print("\ty lower, y upper:", self.y_lower, self.y_upper)
-        
-        buffer_segment_start = 0
-        buffer_segment_end = 0
-
-        while True:
-            ## not bothering to deal with the case of 1 pixel by 1 pixel
-            if (self.x_upper - self.x_lower) <= 1:
-                break
-            if (self.y_upper - self.y_lower) <= 1:
-                break
-            #     
-            # [....................................]
-            #
-            #             LX    CX     UX
-            #             │      │     │
-            #    (0,0)    │      │     │
-            #      ┌──────┼──────┼─────┼─────┐RX
-            #      │      │      │     │     │
-            #      │      │      │     │     │
-            # LY───┼──────┼──────┼─────┼─────┤
-            #      │      │      │     │     │
-            #      │      │      ▼     │     │
-            #  CY──┼──────┼─────►      │     │
-            #      │      │            │     │
-            #      │      │            │     │
-            # UY───┼──────┼────────────┼─────┤
-            #      │      │            │     │
-            #      └──────┴────────────┴─────┘
-            #     RY
-
-            # [######..............................]
-            #
-            #             LX    CX     UX
-            #             │      │     │
-            #    (0,0)    │      │     │
-            #      ┌──────┼──────┼─────┼─────┐RX
-            #      │      │      │     │     │
-            #      │      │      │     │     │
-            # LY───┼──────┼──────┼─────┼─────┤
-            #      │      │      │     │     │
-            #      │      │      ▼     │     │
-            #  CY──┼──────┼─────►######│     │
-            #      │      │            │     │
-            #      │      │            │     │
-            # UY───┼──────┼────────────┼─────┤
-            #      │      │            │     │
-            #      └──────┴────────────┴─────┘
-            #     RY
-            #
-            
-
-            ### ===========================STEP A: FIRST LINE================================
-            if not self.current_x == self.x_lower:
-                if print_debug:
-                    print("\t===STEP 1: FIRST LINE===")
-                buffer_segment_end += self.x_upper - self.current_x
-                if buffer_segment_end > data_length: ## if the data doesn't reach the end of the line
-                    self.buffer[self.current_y][self.current_x:(self.current_x+data_length)] =\
-                        m[buffer_segment_start:data_length].cast('B')
-                    break
-                
-
-                if print_debug:
-                    print(f'\t\t packet [{buffer_segment_start}:{buffer_segment_end}] out of {data_length}')
-                    print(f'\t\t      {self.x_lower: <5}    {self.current_x: <5}           {self.x_upper: <5}')
-                    print(f'\t\t{self.current_y: <5} [--------#################]     ')
-
-                self.buffer[self.current_y][self.current_x:self.x_upper] =\
-                    m[buffer_segment_start:buffer_segment_end].cast('B')
-                buffer_segment_start += buffer_segment_end
-                
-                self.current_x = self.x_lower
-
-
-                self.current_y += 1
-                ### roll over into the next frame if necessary
-                if self.current_y == self.y_upper:
-                    if print_debug:
-                        print(f'\tat end of frame, y = {self.current_y} --> y = {self.y_upper}')
-                    self.current_y = self.y_lower
-            
-
-            ### ===========================STEP 2: FULL LINES TO END OF FRAME================================
-            full_lines = (data_length - buffer_segment_start)//(self.x_upper - self.x_lower)
-            total_full_lines = full_lines
-            if print_debug:
-                print("\t===STEP 2: FULL LINES TO END OF FRAME===")
-                print(f'\t\tpacket contains {full_lines} full lines')
-
-            while (self.current_y + full_lines) >= self.y_upper:
-                #  [######..............................]
-                #        ^
-                #
-                #       LX         UX
-                #       |          |
-                #   CY──............ 
-                #       ............
-                #       ............
-                #   UY──............──lines_left_in_frame
-                #       ............──full_lines
-                #       .....  
-                #   
-
-                lines_left_in_frame = self.y_upper - self.current_y
-
-                
-                #             LX           UX
-                #             CX           │
-                #    (0,0)    │            │
-                #      ┌──────┼────────────┼─────┐RX
-                #      │      │            │     │
-                #      │      │            │     │
-                # LY───┼──────┼────────────┼─────┤
-                #      │      │            │     │
-                #      │      |            │     │
-                #      │      ▼      ######│     │
-                #  CY──┼──────►++++++++++++│     │
-                #      │      │++++++++++++│     │
-                # UY───┼──────┼────────────┼─────┤
-                #      │      │            │     │
-                #      └──────┴────────────┴─────┘
-                #     RY
-                #
-                # [######++++++++++++++++++++++++......]  
-
-                buffer_segment_end += (self.x_upper - self.x_lower)*lines_left_in_frame
-
-                if print_debug:
-                    print(f'\t\t packet [{buffer_segment_start}:{buffer_segment_end}] out of {data_length}')
-                    print(f'\t\t with shape ({lines_left_in_frame},{self.x_upper-self.x_lower})')
-                    print(f'\t\t      {self.x_lower: <5}                    {self.x_upper: <5}')
-                    print(f'\t\t{self.current_y: <5} [+++++++++++++++++++++++++]     ')
-                    print(f'\t\t      [+++++++++++++++++++++++++]     +{lines_left_in_frame} lines')
-                    print(f'\t\t{self.y_upper: <5}                    {full_lines - lines_left_in_frame} remaining / {total_full_lines} total')
-                    
-                self.buffer[self.current_y:self.y_upper,self.x_lower:self.x_upper] = \
-                    m[buffer_segment_start:buffer_segment_end]\
-                        .cast('B',shape = (lines_left_in_frame, (self.x_upper - self.x_lower)))
-                
-                buffer_segment_start = buffer_segment_end
-                full_lines -= lines_left_in_frame
-                self.current_y = self.y_lower
-
-            #if self.current_y + full_lines < self.y_upper: 
-            if full_lines > 0:
-                if print_debug:
-                    print(f'\t===STEP 2B: FULL LINES, SAME FRAME ===')
-                #  [######..............................]
-                #        ^
-                #
-                #       LX         UX
-                #       |          |
-                #   CY__............ 
-                #       ............__ full_lines
-                #       ......
-                #   UY__   
-                #     
-
-                #
-                #             LX           UX
-                #             CX           │
-                #    (0,0)    │            │
-                #      ┌──────┼────────────┼─────┐RX
-                #      │      │            │     │
-                #      │      │            │     │
-                # LY───┼──────┼────────────┼─────┤
-                #      │      │            │     │
-                #      │      |            │     │
-                #      │      ▼      ######│     │
-                #  CY──┼──────►++++++++++++│     │
-                #      │      │++++++++++++│     │
-                # UY───┼──────┼────────────┼─────┤
-                #      │      │            │     │
-                #      └──────┴────────────┴─────┘
-                #     RY
-                #
-                # [######++++++++++++++++++++++++......]
-
-                buffer_segment_end += (self.x_upper - self.x_lower)*full_lines
-                
-                if print_debug:
-                    print(f'\t\t packet [{buffer_segment_start}:{buffer_segment_end}] out of {data_length}')
-                    print(f'\t\t with shape ({full_lines},{self.x_upper-self.x_lower})')
-                    print(f'\t\t      {self.x_lower: <5}                    {self.x_upper: <5}')
-                    print(f'\t\t{self.current_y: <5} [+++++++++++++++++++++++++]     ')
-                    print(f'\t\t      [+++++++++++++++++++++++++]     +{full_lines} lines')
-                    print(f'\t\t{self.current_y+full_lines: <5}                    0 remaining / {total_full_lines} total')
-                self.buffer[self.current_y:self.current_y + full_lines, self.x_lower:self.x_upper] = \
-                    m[buffer_segment_start:buffer_segment_end]\
-                        .cast('B', shape = (full_lines, self.x_upper - self.x_lower))
-                
-                buffer_segment_start = buffer_segment_end
-                self.current_y += full_lines
-
-
-            #             LX    CX     UX
-            #             |     |      │
-            #    (0,0)    │     |      │
-            #      ┌──────┼─────┼──────┼─────┐RX
-            #      │      │     |      │     │
-            #      │      │     |      │     │
-            # LY───┼──────┼─────┼──────┼─────┤
-            #      │      │     |      │     │
-            #      │      |     |      │     │
-            #      │      |     |######│     │
-            #      |      |+++++|++++++│     │
-            #      │      │+++++▼++++++│     │
-            # CY───┼──────►@@@@@@      │     │
-            # UY───┼──────┼────────────┼─────┤
-            #      │      │            │     │
-            #      └──────┴────────────┴─────┘
-            #     RY
-            #
-            # [######++++++++++++++++++++++++@@@@@@]  
-            #                               ^     ^ 
-
-            ### ===========================STEP 3: LAST LINE================================
-            remaining_points = data_length - buffer_segment_start
-            self.current_x = self.x_lower + remaining_points
-
-
-            
-
-
-            if remaining_points > 0:
-                if print_debug:
-                    print("\t===STEP 3: LAST LINE===")
-                    print(f'\t\t{remaining_points} remaining, brings current x to {self.current_x}')
-                    print(f'\t\t packet [{buffer_segment_start}:{data_length}] out of {data_length}')
-                    print(f'\t\t      {self.x_lower: <5}    {self.current_x: <5}           {self.x_upper: <5}')
-                    print(f'\t\t{self.current_y: <5} [@@@@@@@@-----------------]     ')
-
-                self.buffer[self.current_y, self.x_lower:self.current_x] = \
-                    m[buffer_segment_start:data_length].cast('B')
-
-            
-            break
+    def _update_roi(self):
+        '''
+        Precompute the flat-index arithmetic used to stuff a packet into the
+        region of interest. The ROI is treated as a ring of
+        roi_width * roi_height pixels in raster order; _roi_position is the
+        ring address of the next pixel to arrive.
+
+                 LX          UX
+            (0,0)│           │
+              ┌──┼───────────┼──┐
+           LY─┼──0 1 2 3 ....│  │   ring address k lives at
+              │  │...........│  │   row = LY + k // roi_width
+           UY─┼──┼───────────┼──┤   col = LX + k % roi_width
+              └──┴───────────┴──┘
+
+        If the ROI spans the full frame width, its rows are contiguous in the
+        flattened frame buffer, and a run of ring addresses is a plain slice.
+        Otherwise, a table of flat indices is built once per configuration
+        and a run of ring addresses is a slice of that table.
+
+        In a serpentine scan, every other row of the ROI arrives right to
+        left, starting with the second, so the table is always used, with
+        those rows reversed in it: the pixels of a packet are put back in
+        order by the same scatter that writes them to the frame.
+        '''
+        self.x_upper = min(self.x_upper, self.x_width)
+        self.y_upper = min(self.y_upper, self.y_height)
+        self._roi_width = max(self.x_upper - self.x_lower, 0)
+        self._roi_height = max(self.y_upper - self.y_lower, 0)
+        self._roi_size = self._roi_width * self._roi_height
+
+        if (self.x_lower == 0) & (self.x_upper == self.x_width) & (not self.serpentine):
+            self._roi_index = None
+            self._roi_offset = self.y_lower * self.x_width
+        else:
+            rows = np.arange(self.y_lower, self.y_upper, dtype=np.intp) * self.x_width
+            columns = np.arange(self.x_lower, self.x_upper, dtype=np.intp)
+            self._roi_index = rows[:, None] + columns[None, :]
+            if self.serpentine:
+                self._roi_index[1::2] = self._roi_index[1::2, ::-1]
+            self._roi_index = self._roi_index.ravel()
+            self._roi_offset = 0
+
+        if self.integrator is not None:
+            self.integrator.first_row = self.y_lower
+
+        if self._roi_size > 0:
+            row, column = self.current_y - self.y_lower, self.current_x - self.x_lower
+            if self.serpentine & (row % 2 == 1):
+                column = self._roi_width - 1 - column
+            self._roi_position = (row * self._roi_width + column) % self._roi_size
+        else:
+            self._roi_position = 0
 
-        #self.check_left_sync()
-            
+    def _stuff_run(self, start, stop, pixels):
+        ## write pixels to ring addresses [start, stop), which must not wrap
+        frame = self.buffer.reshape(-1)
+        if self._roi_index is None:
+            index = slice(self._roi_offset + start, self._roi_offset + stop)
+        else:
+            index = self._roi_index[start:stop]
+        frame[index] = pixels
+        if self.integrator is not None:
+            self.integrator.add(index, pixels, self.buffer)
+        self.mark_dirty(self.y_lower + start // self._roi_width,
+                        self.y_lower + (stop - 1) // self._roi_width + 1)
+
+    def new_points_to_frame(self, m:memoryview, print_debug = False):
+        if isinstance(m, np.ndarray):
+            pixels = m
+        else:
+            pixels = np.frombuffer(m, dtype=np.uint8)
+        data_length = len(pixels)
+        roi_size = self._roi_size
+        if (data_length == 0) | (roi_size == 0):
+            return
+
+        start = self._roi_position
+        if data_length > roi_size:
+            ## the packet covers the ROI more than once; only the newest
+            ## roi_size pixels are still visible afterwards
+            start = (start + data_length - roi_size) % roi_size
+            pixels = pixels[data_length - roi_size:]
+            data_length = roi_size
+
+        stop = start + data_length
+        if stop <= roi_size:
+            self._stuff_run(start, stop, pixels)
+            if stop == roi_size:
+                self.frame_complete()
+        else:
+            ## roll over into the next frame
+            first = roi_size - start
+            self._stuff_run(start, roi_size, pixels[:first])
+            self.frame_complete()
+            self._stuff_run(0, stop - roi_size, pixels[first:])
+        self._roi_position = stop % roi_size
+
+        y, x = divmod(self._roi_position, self._roi_width)
+        if self.serpentine & (y % 2 == 1):
+            x = self._roi_width - 1 - x
+        self.current_y = self.y_lower + y
+        self.current_x = self.x_lower + x
 
+        if print_debug:
+            print(f'\tstuffed {data_length} pixels at ring address {start}, '
+                  f'now at x: {self.current_x}, y: {self.current_y}')
+
+
+    @property
+    def patterngen(self):
+        return self._pattern
+
+    @patterngen.setter
+    def patterngen(self, pattern):
+        ## the pattern is materialized once as a (3, N) array of x, y, dwell
+        ## rows, so each packet of echoed points can look up its block of
+        ## coordinates by slicing
+        if pattern is None:
+            self._pattern = None
+        elif hasattr(pattern, "__array__"):
+            ## an array, or a pattern_generators.PatternStream
+            self._pattern = np.ascontiguousarray(np.asarray(pattern).reshape(-1, 3).T, dtype=np.uint16)
+        else:
+            self._pattern = np.ascontiguousarray(
+                np.fromiter(pattern, dtype=np.uint16).reshape(-1, 3).T)
+        self._pattern_position = 0
+        self.point_buffer = bytearray()
 
-    def points_to_vector(self, m:memoryview, print_debug = True):
-        self.point_buffer.extend(m)
-        while len(self.point_buffer) >= 2:
-            point = self.point_buffer[:2]
-            self.point_buffer = self.point_buffer[2:]
-            a = memoryview(point).cast('H').tolist()[0]
-            if print_debug:
-                print(f' a: {a}')
-            x2 = next(self.patterngen)
-            y2 = next(self.patterngen)
-            a2 = next(self.patterngen)
-            if print_debug:
-                print(f' x2: {x2}, y2: {y2}, a2: {a2}')
-            self.buffer[y2][x2] = a
-            self.totalbytes += 6
-            print(f'total bytes: {self.totalbytes}')
-            assert(a == a2)
+    def _stuff_points(self, values:np.ndarray, print_debug = False):
+        count = len(values)
+        self.totalbytes += 6*count
+        if self._pattern is None:
+            return
+        pattern_length = self._pattern.shape[1]
+        start = self._pattern_position
+        stop = start + count
+        if stop <= pattern_length:
+            x, y, dwell = self._pattern[:, start:stop]
+        else:
+            ## the pattern repeats
+            x, y, dwell = np.take(self._pattern, np.arange(start, stop), axis=1, mode='wrap')
+        self._pattern_position = stop % pattern_length
+
+        ## the frame keeps the low byte of each value
+        in_frame = (x < self.x_width) & (y < self.y_height)
+        if not in_frame.all():
+            x, y, values = x[in_frame], y[in_frame], values[in_frame]
+        if len(y):
+            self.buffer[y, x] = values
+            if self.integrator is not None:
+                ## the low byte, as kept in buffer
+                self.integrator.add(y.astype(np.intp)*self.x_width + x, values.astype(np.uint8), self.buffer)
+            self.mark_dirty(int(y.min()), int(y.max()) + 1)
+
+        mismatches = np.count_nonzero(values != dwell)
+        self.echo_mismatches += mismatches
+        if print_debug:
+            print(f'\tstuffed {count} points, {mismatches} did not match the pattern, '
+                  f'total bytes: {self.totalbytes}')
+
+    def points_to_vector(self, m:memoryview, print_debug = False):
+        m = memoryview(m).cast('B')
+        if self.point_buffer:
+            ## complete the point left over from the previous packet
+            remaining = 2 - len(self.point_buffer)
+            self.point_buffer.extend(m[:remaining])
+            m = m[remaining:]
+            if len(self.point_buffer) < 2:
+                return
+            self._stuff_points(np.frombuffer(self.point_buffer, dtype='<u2'), print_debug)
+            self.point_buffer = bytearray()
+        whole = len(m) & ~1
+        if whole:
+            ## each echoed point is one 16-bit value
+            values = np.frombuffer(m[:whole], dtype='<u2')
+            self._stuff_points(values, print_debug)
+        self.point_buffer.extend(m[whole:])
 
     def handle_data_with_config(self, data:memoryview, config = None, print_debug = None):
         if not config == None:
@@ -360,15 +358,13 @@ class ScanStream:
             pass
 
         if len(data) > 0: 
+            if self.compressed_output:
+                data = self.pixel_decoder.decode(data)
             if (self.scan_mode == 1) | (self.scan_mode == 2):
                 if self.eight_bit_output == 0:
-                    start = time.perf_counter()
-                    #data = data.cast('H')
-                    eight_bit_data = data.tobytes()[1::2]
-                    data = memoryview(eight_bit_data)
-                    end = time.perf_counter()
-                    if print_debug:
-                        print(f'16 to 8 time {end-start}')
+                    ## keep the second byte of each 16-bit sample, as a
+                    ## strided view rather than a copy
+                    data = np.frombuffer(data, dtype=np.uint8)[1::2]
                 start = time.perf_counter()
                 self.new_points_to_frame(data)
                 end = time.perf_counter()
@@ -395,7 +391,12 @@ class ScanStream:
         ly = ly1*256 + ly2
 
         self.scan_mode = mode
-        self.eight_bit_output = eight_bit
+        ## bit 1 is set if the 8-bit stream is compressed
+        self.eight_bit_output = eight_bit & 1
+        self.compressed_output = (eight_bit >> 1) & 1
+        ## bit 2 is set for a serpentine scan
+        self.serpentine = (eight_bit >> 2) & 1
+        self.pixel_decoder.reset()
 
         ## Any time a config packet is recieved, reset to the beginning of the frame
         self.current_x = lx
@@ -412,103 +413,182 @@ class ScanStream:
             self.y_height = y_height
             self.clear_buffer()
 
+        self._update_roi()
 
 
 
-    def parse_config_from_data(self, d:bytes, print_debug=True):
-        n = re.finditer(self.config_match, d)
-        prev_stop = 0
-        prev_config = None
-        try: 
-            match = next(n)
-            start, stop = match.span()
-            config = match.group()
-            data = d[prev_stop:start]
-            if print_debug:
-                print(f'[{prev_stop}----data----{start}]')
-            prev_stop = stop
-            prev_config = config
-            self.handle_data_with_config(memoryview(data))
-            if print_debug:
-                print(f'[{start}--config--{stop}]')
-
-            while True:
-                try:
-                    match = next(n)
-                    start, stop = match.span()
-                    config = match.group()
-                    data = d[prev_stop:start]
-                    if print_debug:
-                        print(f'[{prev_stop}----data----{start}]')
-                    self.handle_data_with_config(memoryview(data), memoryview(prev_config[2:16]))
-                    if print_debug:
-                        print(f'[{start}config{stop}]')
-                    prev_stop = stop
-                    prev_config = config
-                except StopIteration:
-                    data = d[prev_stop:]
-                    if print_debug:
-                        print(f'[{prev_stop}----data----]\t stop iteration')
-                    if prev_config == None:
-                        self.handle_data_with_config(memoryview(data))
-                    else:
-                        self.handle_data_with_config(memoryview(data), memoryview(prev_config[2:16]))
-                    break
-
-        except StopIteration:
+    def parse_config_from_data(self, d:bytes, print_debug=False):
+        for config, data in self.config_scanner.scan(d):
             if print_debug:
-                print("No config packets in here")
-            self.handle_data_with_config(memoryview(d))
-
-
-            
-
-
+                print(f'[----data----{len(data)}]', "with new config" if config is not None else "")
+            self.handle_data_with_config(data, config)
 
 
 
 if __name__ == "__main__":
-    from mock_output import generate_raster_packet_with_config, generate_vector_packet, get_two_bytes
-    import matplotlib.pyplot as plt
-    def test_frame_stuffing():
-        #data = [4, 5, 6] + [n for n in range(0,6)]*10 + [0, 1, 2]
+    from mock_output import generate_raster_packet_with_config, generate_raster_config, vector_echo_stream
+
+    def test_frame_stuffing(x_width=837, y_height=536, eight_bit_output=True, **roi):
+        ## mock pixels carry the low byte of their own x coordinate
         s = ScanStream()
-        packet_generator = generate_raster_packet_with_config(837, 536, True)
-        for n in range(1000):
-            data = next(packet_generator)
-            d = bytes(data)
-            try:
-                s.writeto(d)
-                print("SUCCESS!")
-            except:
-                print("FAIL")
-                break
-            
-
-        # for n in range(100, 200):
-        #     s.change_buffer(512, 512)
-        #     packet_generator = generate_raster_packet_with_config(512,512, False, 32, 255+n, 54, 255+n)
-        #     for n in range(100):
-        #         print("=====start new packet======")
-        #         data = next(packet_generator)
-        #         d = bytes(data)
-        #         try:
-        #             s.writeto(d)
-        #         except Exception as err:
-        #             print("ERROR:", err)
-                    # break
-
-        plt.matshow(s.buffer)
-        plt.show()
-
-    def test_vector_stuffing():
+        packet_generator = generate_raster_packet_with_config(x_width, y_height, eight_bit_output, **roi)
+        lx, ux = roi.get("lx", 0), roi.get("ux", x_width)
+        ly, uy = roi.get("ly", 0), roi.get("uy", y_height)
+        frame_bytes = (ux-lx)*(uy-ly)*(1 if eight_bit_output else 2)
+        for n in range(frame_bytes//16384 + 2):
+            s.writeto(bytes(next(packet_generator)))
+        expected = (np.arange(lx, ux) & 0xFF).astype(np.uint8)
+        assert (s.buffer[ly:uy, lx:ux] == expected).all()
+        assert not s.buffer[:ly].any() and not s.buffer[uy:].any()
+        print(f'frame stuffing {x_width}x{y_height} {roi} '
+              f'{"8" if eight_bit_output else "16"}-bit: OK')
+
+    def test_dirty_rows(x_width=1000, y_height=100, ly=10, uy=90):
         s = ScanStream()
-        packet_generator = generate_vector_packet()
-        for n in range(3):
-            print("=====start new packet======")
-            data = next(packet_generator)
-            d = memoryview(bytes(data))
-            s.writeto(d)
-        
-    #test_vector_stuffing()
-    test_frame_stuffing()
\ No newline at end of file
+        packet_generator = generate_raster_packet_with_config(x_width, y_height, True, ly=ly, uy=uy)
+        s.writeto(bytes(next(packet_generator)))
+        ## the config resized the buffer, so all of it is new
+        assert s.take_dirty_rows() == (0, y_height)
+        assert s.take_dirty_rows() is None
+        ## pixels 16366 to 32750 of the ROI, i.e. rows 16 to 32
+        s.writeto(bytes(next(packet_generator)))
+        assert s.take_dirty_rows() == (ly + 16, ly + 33)
+        ## a partial row
+        s.new_points_to_frame(np.ones(100, dtype=np.uint8))
+        assert s.take_dirty_rows() == (ly + 32, ly + 33)
+        ## vector points
+        s.patterngen = np.array([[5, 60, 1], [7, 40, 1]])
+        s.points_to_vector(bytes([1, 0, 1, 0]))
+        assert s.take_dirty_rows() == (40, 61)
+        print("dirty rows: OK")
+
+    def test_integration(x_width=300, y_height=100):
+        ## two identical frames of a ROI, averaged, come out as one of them
+        s = ScanStream()
+        packet_generator = generate_raster_packet_with_config(x_width, y_height, True, ly=10, uy=90)
+        s.writeto(bytes(next(packet_generator)))
+        s.set_integration("average", 2)
+        assert s.display_buffer is s.integrator.frame
+        for n in range(4):
+            s.writeto(bytes(next(packet_generator)))
+        assert (s.display_buffer[10:90] == s.buffer[10:90]).all()
+        s.set_integration(None)
+        assert s.display_buffer is s.buffer
+        print("integration: OK")
+
+    def test_frame_listeners(x_width=300, y_height=100):
+        s = ScanStream()
+        frames = []
+        s.frame_listeners.append(lambda frame, parameters: frames.append((frame.copy(), parameters)))
+        packet_generator = generate_raster_packet_with_config(x_width, y_height, True, ly=10, uy=90)
+        for n in range(4):
+            s.writeto(bytes(next(packet_generator)))
+        ## 4 packets are 2.7 frames of the ROI
+        assert len(frames) == 2
+        frame, parameters = frames[1]
+        assert (frame[10:90] == (np.arange(x_width) & 0xFF)).all()
+        assert parameters["y_lower"] == 10 and parameters["y_upper"] == 90
+        print("frame listeners: OK")
+
+    def test_compressed_frame(x_width=200, y_height=50):
+        ## each row as PixelCompressor codes it: a step to 0, steps of 1 in
+        ## pairs, and a step of 1 for the last pixel
+        row = [0x89]*(x_width//2 - 1) + [0x01]
+        config = bytes(generate_raster_config(x_width, y_height, True))
+        config = config[:15] + bytes([3]) + config[16:]
+        stream = config + bytes([0x00] + row) + bytes([(1 - x_width) & 0x7F] + row)*(y_height - 1)
+        s = ScanStream()
+        for n in range(0, len(stream), 999):
+            s.parse_config_from_data(stream[n:n + 999])
+        assert s.compressed_output and s.eight_bit_output == 1
+        assert (s.buffer == (np.arange(x_width) & 0x7F)).all()
+        ## the next config starts over from a previous pixel of 0, and is uncompressed
+        s.parse_config_from_data(config + bytes([0xC1]) + bytes(generate_raster_config(x_width, y_height, True)) + bytes([9]))
+        assert not s.compressed_output
+        assert s.buffer[0, :3].tolist() == [9, 0, 2]
+        print("compressed frame: OK")
+
+    def test_serpentine_frame(x_width=300, y_height=7, **roi):
+        ## the pixels of each line as the beam goes along it: the low byte of
+        ## their x coordinate, with every other line of the region reversed
+        lx, ux = roi.get("lx", 0), roi.get("ux", x_width)
+        ly, uy = roi.get("ly", 0), roi.get("uy", y_height)
+        config = bytearray(generate_raster_config(x_width, y_height, True, **roi))
+        config[15] = 5 ## 8-bit, serpentine
+        line = np.arange(lx, ux, dtype=np.uint8)
+        frame = np.concatenate([line[::-1] if n % 2 else line for n in range(uy - ly)])
+        stream = bytes(config) + frame.tobytes() + frame[:len(line) + 2].tobytes()
+        s = ScanStream()
+        for n in range(0, len(stream), 777):
+            s.parse_config_from_data(stream[n:n + 777])
+        assert s.serpentine and s.scan_parameters()["serpentine"]
+        assert (s.buffer[ly:uy, lx:ux] == line).all()
+        ## two pixels into the second line of the next frame, going left
+        assert (s.current_x, s.current_y) == (ux - 3, ly + 1)
+        ## the next config that is not serpentine leaves the lines as they come
+        s.parse_config_from_data(bytes(generate_raster_config(x_width, y_height, True, **roi)) + frame.tobytes())
+        assert not s.serpentine
+        assert (s.buffer[ly + 1, lx:ux] == line[::-1]).all()
+        print(f'serpentine frame {x_width}x{y_height} {roi}: OK')
+
+    def bench_frame_stuffing(x_width=2048, y_height=2048, eight_bit_output=True, n_packets=1024, **roi):
+        s = ScanStream()
+        packet_generator = generate_raster_packet_with_config(x_width, y_height, eight_bit_output, **roi)
+        ## the first packet carries the config; the rest are recycled
+        s.writeto(bytes(next(packet_generator)))
+        packets = [bytes(next(packet_generator)) for n in range(8)]
+        start = time.perf_counter()
+        for n in range(n_packets):
+            s.writeto(packets[n % len(packets)])
+        end = time.perf_counter()
+        rate = n_packets*16384/(end-start)/1e6
+        print(f'{x_width}x{y_height} {roi} {"8" if eight_bit_output else "16"}-bit: '
+              f'{rate:.1f} MB/s, {(end-start)/n_packets*1e6:.1f} us/packet')
+
+    def test_vector_stuffing(x_width=300, y_height=200):
+        pattern, stream = vector_echo_stream(x_width, y_height, x_width*y_height)
+        s = ScanStream()
+        s.patterngen = pattern
+        ## odd chunk sizes split echoed points across packets
+        for n in range(0, len(stream), 7001):
+            s.parse_config_from_data(stream[n:n + 7001])
+        expected = pattern[:, 2].reshape(y_height, x_width)
+        assert (s.buffer == expected).all()
+        assert s.echo_mismatches == 0
+        ## a pattern given as a generator, repeating, and echoes that do not match it
+        s.patterngen = iter(pattern[:100].ravel().tolist())
+        echo = np.resize(pattern[:100, 2], 150)
+        echo[[3, 50, 120]] += 1
+        s.points_to_vector(echo.astype('<u2').tobytes())
+        assert s.echo_mismatches == 3
+        print(f'vector stuffing {x_width}x{y_height}: OK')
+
+    def bench_vector_stuffing(x_width=2048, y_height=2048, n_packets=1024):
+        pattern, stream = vector_echo_stream(x_width, y_height, 8192*n_packets)
+        s = ScanStream()
+        s.patterngen = pattern
+        s.parse_config_from_data(stream[:18])
+        start = time.perf_counter()
+        for n in range(n_packets):
+            s.points_to_vector(stream[18 + n*16384:18 + (n + 1)*16384])
+        end = time.perf_counter()
+        rate = n_packets*8192/(end-start)/1e6
+        print(f'vector {x_width}x{y_height}: {rate:.2f} Mpoints/s, '
+              f'{(end-start)/n_packets*1e6:.1f} us/packet')
+
+    test_frame_stuffing()
+    test_frame_stuffing(eight_bit_output=False)
+    test_frame_stuffing(512, 512, True, lx=15, ux=400, ly=15, uy=400)
+    test_frame_stuffing(512, 512, False, lx=15, ux=400, ly=15, uy=400)
+    test_frame_stuffing(64, 64, True, lx=3, ux=9, ly=5, uy=8)
+    test_dirty_rows()
+    test_integration()
+    test_frame_listeners()
+    test_compressed_frame()
+    test_serpentine_frame()
+    test_serpentine_frame(64, 64, lx=3, ux=9, ly=5, uy=12)
+    for eight_bit_output in (True, False):
+        bench_frame_stuffing(eight_bit_output=eight_bit_output)
+        bench_frame_stuffing(eight_bit_output=eight_bit_output, lx=100, ux=1900, ly=100, uy=1900)
+    test_vector_stuffing()
+    bench_vector_stuffing()
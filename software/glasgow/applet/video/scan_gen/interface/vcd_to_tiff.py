@@ -0,0 +1,369 @@
+import numpy as np
+
+
+class VcdSignal:
+    def __init__(self, name, width, code):
+        ## full name, with the scopes it is in, e.g. "bench.top.in_pixel"
+        self.name = name
+        self.width = width
+        self.code = code
+
+    def __repr__(self):
+        return f'VcdSignal({self.name!r}, {self.width}, {self.code!r})'
+
+
+class VcdReader:
+    '''
+    Reads a VCD, such as the Amaranth simulator writes, as a stream: only
+    the header is kept in memory, and the value changes are read a block at
+    a time and only looked at for the signals asked for, so VCDs of any
+    size can be read in bounded memory.
+
+    Each block is taken apart into lines, and the lines of the signals asked
+    for picked out, with numpy operations on the whole block, so nothing is
+    done in Python for each line.
+    '''
+    def __init__(self, path, block_size = 4 << 20):
+        self.path = path
+        self.block_size = block_size
+        self.signals = {}
+        self.timescale = None
+        self._data_offset = 0
+        self._parse_header()
+
+    def _parse_header(self):
+        ## the header is a sequence of $keyword ... $end sections, which may span lines
+        tokens = []
+        with open(self.path, "rb") as f:
+            for line in f:
+                tokens.extend(line.decode("ascii", "replace").split())
+                if "$enddefinitions" in tokens:
+                    self._data_offset = f.tell()
+                    break
+            else:
+                raise ValueError(f"{self.path} has no $enddefinitions")
+        scopes = []
+        section = []
+        for token in tokens:
+            if token != "$end":
+                section.append(token)
+                continue
+            keyword, body, section = section[0], section[1:], []
+            if keyword == "$scope":
+                scopes.append(body[1])
+            elif keyword == "$upscope":
+                scopes.pop()
+            elif keyword == "$var":
+                ## $var <type> <width> <code> <name> [<bits>]
+                width, code, name = int(body[1]), body[2], body[3]
+                full_name = ".".join(scopes + [name])
+                self.signals[full_name] = VcdSignal(full_name, width, code)
+            elif keyword == "$timescale":
+                self.timescale = " ".join(body)
+
+    def find(self, name):
+        '''
+        The signal called name: either its full name, or its own name if no
+        other signal in the VCD has the same one.
+        '''
+        if name in self.signals:
+            return self.signals[name]
+        matches = [signal for full_name, signal in self.signals.items()
+                   if full_name.rsplit(".", 1)[-1] == name]
+        if len(matches) == 1:
+            return matches[0]
+        if not matches:
+            raise KeyError(f"no signal {name!r} in {self.path}")
+        raise KeyError(f"{name!r} is ambiguous in {self.path}: "
+                       f"{', '.join(signal.name for signal in matches)}")
+
+    def _blocks(self):
+        ## whole lines only; a line cut by the end of a block goes with the next one
+        with open(self.path, "rb") as f:
+            f.seek(self._data_offset)
+            carry = b""
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    break
+                end = block.rfind(b"\n") + 1
+                if end == 0:
+                    carry += block
+                    continue
+                yield carry + block[:end]
+                carry = block[end:]
+            if carry:
+                yield carry + b"\n"
+
+    def samples(self, names, clock = None, strobe = None):
+        '''
+        Yields the values of the signals in names, sampled as they were
+        settled after each rising edge of clock, as an array with a row per
+        signal and a column per sample, one array for each block read.
+
+        Without a clock, a sample is taken each time the first signal in
+        names changes. With a strobe, only samples where it is high are kept.
+        x and z bits are read as 0.
+        '''
+        tracked = [self.find(name) for name in names]
+        trigger = self.find(clock) if clock is not None else tracked[0]
+        strobe = self.find(strobe) if strobe is not None else None
+        for signal in tracked + [trigger]:
+            if signal.width > 64:
+                raise ValueError(f"{signal.name} is {signal.width} bits wide, more than 64")
+        signals = list(dict.fromkeys(tracked + [trigger] + ([strobe] if strobe else [])))
+        ## values as of the end of the last block, and of the trigger before that
+        values = dict.fromkeys(signals, 0)
+        last_trigger = None
+        pending = False
+        for block in self._blocks():
+            lines = _VcdLines(block, max(len(signal.code) for signal in signals))
+            changes = {signal: lines.changes(signal) for signal in signals}
+
+            ## which timestamps the trigger fired in: a timestamp is the lines
+            ## after a #, and stamp 0 is the one carried over from the last block
+            where, value = changes[trigger]
+            value = value.astype(np.int64)
+            before = np.concatenate(([-1 if last_trigger is None else last_trigger], value[:-1]))
+            if clock is None:
+                fired = value != before
+                if last_trigger is None and len(value):
+                    fired[0] = True
+            else:
+                fired = (value == 1) & (before == 0)
+            stamps = np.unique(np.searchsorted(lines.timestamps, where[fired]))
+            if pending and (len(stamps) == 0 or stamps[0] != 0):
+                stamps = np.concatenate(([0], stamps))
+            ## a timestamp that runs on into the next block is sampled there
+            pending = len(stamps) > 0 and stamps[-1] == len(lines.timestamps)
+            if pending:
+                stamps = stamps[:-1]
+            at = lines.timestamps[stamps]
+
+            def value_at(signal):
+                where, value = changes[signal]
+                if len(value) == 0:
+                    return np.full(len(at), values[signal], dtype=np.uint64)
+                index = np.searchsorted(where, at) - 1
+                return np.where(index >= 0, value[np.maximum(index, 0)], values[signal]).astype(np.uint64)
+
+            if strobe is not None:
+                at = at[value_at(strobe) != 0]
+            yield np.stack([value_at(signal) for signal in tracked])
+
+            if len(value):
+                last_trigger = value[-1]
+            for signal, (_, changed_to) in changes.items():
+                if len(changed_to):
+                    values[signal] = changed_to[-1]
+        if pending and (strobe is None or values[strobe]):
+            yield np.array([[values[signal]] for signal in tracked], dtype=np.uint64)
+
+
+class _VcdLines:
+    '''
+    The value change lines of one block of a VCD, taken apart with numpy:
+    where each line starts, what kind it is, and the code of the signal it
+    changes, packed into integers, 8 characters to each, so that lines can
+    be matched to signals without looking at them one by one.
+    '''
+    def __init__(self, block, code_length):
+        a = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(a == ord("\n"))
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        ends = ends - (a[np.maximum(ends - 1, 0)] == ord("\r"))
+        first = a[np.minimum(starts, len(a) - 1)]
+        first[starts == ends] = 0
+
+        self._a = a
+        ## line numbers of the # lines
+        self.timestamps = np.flatnonzero(first == ord("#"))
+        scalar = np.isin(first, np.frombuffer(b"01xzXZ", dtype=np.uint8))
+        vector = (first == ord("b")) | (first == ord("B"))
+        ## a vector's value runs up to the first space, its code follows
+        spaces = np.flatnonzero(a == ord(" "))
+        space = spaces[np.minimum(np.searchsorted(spaces, starts), len(spaces) - 1)] \
+            if len(spaces) else starts
+        code_start = np.where(vector, space + 1, starts + 1)
+        self._lines = np.flatnonzero(scalar | vector)
+        self._vector = vector[self._lines]
+        ## a scalar's value is its first character, a vector's follows the b
+        self._value_start = starts[self._lines] + self._vector
+        self._value_end = np.where(self._vector, space[self._lines], self._value_start + 1)
+        code_start = code_start[self._lines]
+        code_end = ends[self._lines]
+        self._code_length = code_end - code_start
+        self._code = self._pack(code_start, code_end, code_length)
+
+    def _pack(self, start, end, length):
+        ## a row of words for each 8 characters of the longest code asked for
+        code = np.zeros((-(-length//8), len(start)), dtype=np.uint64)
+        for k in range(length):
+            inside = start + k < end
+            byte = self._a[np.minimum(start + k, len(self._a) - 1)].astype(np.uint64)
+            code[k//8] |= np.where(inside, byte, 0) << np.uint64(8*(k % 8))
+        return code
+
+    def changes(self, signal):
+        '''Line numbers at which signal changes, and the values it changes to.'''
+        code = signal.code.encode()
+        key = np.frombuffer(code.ljust(8*len(self._code), b"\0"), dtype="<u8")
+        match = np.flatnonzero((self._code == key[:, None]).all(axis=0) &
+                               (self._code_length == len(code)))
+        start, end = self._value_start[match], self._value_end[match]
+        value = np.zeros(len(match), dtype=np.uint64)
+        ## the value is written most significant bit first, without leading zeros
+        for bit in range(signal.width):
+            position = end - 1 - bit
+            inside = position >= start
+            one = self._a[np.maximum(position, 0)] == ord("1")
+            value |= (inside & one).astype(np.uint64) << np.uint64(bit)
+        return self._lines[match], value
+
+
+def frames(reader, width, height, signal = "in_pixel", clock = None, strobe = None):
+    '''
+    Yields the frames made of successive samples of signal (see
+    VcdReader.samples), in raster order, as (height, width) arrays. A frame
+    that the VCD ends part way through is yielded with the rest left zero.
+    Only one frame is held in memory, and it is reused: copy what is kept.
+    '''
+    bits = reader.find(signal).width
+    dtype = np.uint8 if bits <= 8 else np.uint16 if bits <= 16 else np.uint32
+    frame = np.zeros(width*height, dtype=dtype)
+    filled = 0
+    for samples in reader.samples([signal], clock, strobe):
+        samples = samples[0]
+        while len(samples):
+            n = min(len(samples), frame.size - filled)
+            frame[filled:filled + n] = samples[:n]
+            filled += n
+            samples = samples[n:]
+            if filled == frame.size:
+                yield frame.reshape(height, width)
+                filled = 0
+    if filled:
+        frame[filled:] = 0
+        yield frame.reshape(height, width)
+
+
+def vcd_to_tiff(vcd_path, tiff_path, width, height, signal = "in_pixel", clock = None,
+                strobe = None):
+    '''
+    Converts the frames in a VCD (see frames) to a multi-page TIFF, one page
+    per frame, written as each frame completes. Returns the number of frames.
+    '''
+    import tifffile
+    reader = VcdReader(vcd_path)
+    n = 0
+    with tifffile.TiffWriter(tiff_path, bigtiff = True) as tif:
+        for frame in frames(reader, width, height, signal, clock, strobe):
+            tif.write(frame, photometric = "minisblack", metadata = None)
+            n += 1
+    return n
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import time
+    import tempfile
+
+    if len(sys.argv) > 1:
+        import argparse
+        parser = argparse.ArgumentParser(description="convert the frames in a simulation VCD to TIFF")
+        parser.add_argument("vcd")
+        parser.add_argument("tiff", nargs="?")
+        parser.add_argument("--width", type=int, default=512)
+        parser.add_argument("--height", type=int, default=512)
+        parser.add_argument("--signal", default="in_pixel", help="the pixel values (default: %(default)s)")
+        parser.add_argument("--clock", help="sample on rising edges of this signal, "
+                                            "instead of on each change of the pixel values")
+        parser.add_argument("--strobe", help="only take samples where this signal is high")
+        parser.add_argument("--list", action="store_true", help="list the signals in the VCD")
+        args = parser.parse_args()
+        if args.list or args.tiff is None:
+            for signal in VcdReader(args.vcd).signals.values():
+                print(f'{signal.name} [{signal.width}]')
+            sys.exit()
+        start = time.perf_counter()
+        n = vcd_to_tiff(args.vcd, args.tiff, args.width, args.height, args.signal, args.clock, args.strobe)
+        print(f'{n} frames written to {args.tiff} in {time.perf_counter() - start:.1f} s')
+        sys.exit()
+
+    from amaranth.hdl import Module, Signal, Mux
+    from amaranth.sim import Simulator
+
+    def simulate_vcd(path, cycles):
+        ## a pixel counter with a strobe that is high two cycles out of three
+        m = Module()
+        in_pixel = Signal(8)
+        counter = Signal(2)
+        valid = Signal()
+        noise = Signal(16)
+        m.d.sync += [
+            counter.eq(Mux(counter == 2, 0, counter + 1)),
+            valid.eq(counter != 2),
+            noise.eq(noise*5 + 1),
+        ]
+        with m.If(counter != 2):
+            m.d.sync += in_pixel.eq(in_pixel + 1)
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        def bench():
+            for n in range(cycles):
+                yield
+        sim.add_sync_process(bench)
+        with sim.write_vcd(path):
+            sim.run()
+
+    def test_vcd_to_tiff(directory):
+        import tifffile
+        path = os.path.join(directory, "sim.vcd")
+        simulate_vcd(path, 200)
+        reader = VcdReader(path)
+        assert reader.find("in_pixel").width == 8 and reader.timescale == "1 ps"
+        ## lines cut by the end of a block, and timestamps running on into the next one
+        small_blocks = VcdReader(path, block_size = 61)
+        for args in ((["in_pixel"],), (["in_pixel", "valid"], "clk"), (["in_pixel"], "clk", "valid")):
+            assert (np.concatenate(list(reader.samples(*args)), axis=1) ==
+                    np.concatenate(list(small_blocks.samples(*args)), axis=1)).all()
+        ## on each change, as the old script did: 0 then 1, 2, ... (repeats are not changes)
+        changes = np.concatenate([chunk[0] for chunk in reader.samples(["in_pixel"])])
+        assert (changes[:10] == np.arange(10)).all()
+        ## on the clock, only where the strobe is high
+        sampled = np.concatenate(list(reader.samples(["in_pixel", "valid"], "clk", "valid")), axis=1)
+        assert sampled.shape == (2, 134) and (sampled[1] == 1).all()
+        assert (sampled[0] == np.arange(1, 135) % 256).all()
+        tiff_path = os.path.join(directory, "sim.tif")
+        assert vcd_to_tiff(path, tiff_path, 8, 4, clock = "clk", strobe = "valid") == 5
+        pages = tifffile.imread(tiff_path)
+        assert pages.shape == (5, 4, 8)
+        assert (pages.ravel()[:len(sampled[0])] == sampled[0]).all()
+
+        ## identifiers longer than 8 characters, the same in their first 8
+        path = os.path.join(directory, "long_codes.vcd")
+        with open(path, "w") as f:
+            f.write("$timescale 1 ps $end\n$scope module top $end\n"
+                    "$var wire 1 longcode!A clk $end\n$var wire 4 longcode!B a $end\n"
+                    "$var wire 4 longcode!AB b $end\n$upscope $end\n$enddefinitions $end\n")
+            for n in range(6):
+                f.write(f"#{2*n}\n1longcode!A\nb{n:b} longcode!B\nb{15 - n:b} longcode!AB\n"
+                        f"#{2*n + 1}\n0longcode!A\n")
+        sampled = np.concatenate(list(VcdReader(path).samples(["a", "b"], "clk")), axis=1)
+        assert (sampled == [np.arange(1, 6), 15 - np.arange(1, 6)]).all()
+        print("vcd to tiff: OK")
+
+    def bench_vcd_to_tiff(directory, cycles = 100000):
+        path = os.path.join(directory, "bench.vcd")
+        simulate_vcd(path, cycles)
+        size = os.path.getsize(path)
+        reader = VcdReader(path)
+        start = time.perf_counter()
+        n = sum(chunk.shape[1] for chunk in reader.samples(["in_pixel"], "clk", "valid"))
+        end = time.perf_counter()
+        print(f'{size/(end - start)/1e6:.0f} MB/s of VCD, {n/(end - start)/1e6:.2f} M samples/s')
+
+    with tempfile.TemporaryDirectory() as directory:
+        test_vcd_to_tiff(directory)
+        bench_vcd_to_tiff(directory)
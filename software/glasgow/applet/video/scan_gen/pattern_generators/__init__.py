@@ -1,6 +1,7 @@
 from .hilbert import hilbert
 from .rectangles import vector_rectangle, vector_gradient_rectangle
-from .patterngen_utils import packet_from_generator
+from .patterngen_utils import packet_from_generator, PatternStream
+from .vector_commands import encode_points
 
 __all__ = ["hilbert", "vector_rectangle", 
-"vector_gradient_rectangle", "packet_from_generator"]
\ No newline at end of file
+"vector_gradient_rectangle", "packet_from_generator", "PatternStream", "encode_points"]
\ No newline at end of file
@@ -2,6 +2,17 @@ import numpy as np
 from PIL import Image, ImageChops
 import os
 import time
+import hashlib
+import platformdirs
+
+if __package__:
+    from .patterngen_utils import PatternStream
+else:
+    from patterngen_utils import PatternStream
+
+
+## dwell values 0 and 1 are not usable, and are raised to this
+MIN_DWELL = 2
 
 
 def window(pixel):
@@ -17,19 +28,43 @@ def bmp_import(filename):
     return im
 
 
+def bmp_rows(filename):
+    '''
+    The pixels of an image as a (height, width) uint8 array, top row first.
 
-def bmp_to_bitstream(filename, x_width, y_height, invert_color = False):
+    For uncompressed 8-bit grayscale bitmaps this is a view of a memory map of
+    the file, so rows are only read from disk as they are used. Any other
+    image is decoded and converted to grayscale with PIL.
+    '''
     im = Image.open(filename)
-    height, width = im.size
-    im = im.convert("L")
-    if invert_color:
-        im = ImageChops.invert(im)
-    im = im.point(lambda i: window(i))
-    pattern_array = np.array(im).astype(np.uint8)
-
-    ## pad the array to fit the full frame resolution
-    padding_tb = y_height - height ## difference between height of frame and full resolution
-    padding_lr = x_width - width ## difference between width of frame and full resolution
+    width, height = im.size
+    if im.mode == "L" and len(im.tile) == 1:
+        decoder, extents, offset, args = im.tile[0]
+        if decoder == "raw" and args[0] == "L" and tuple(extents) == (0, 0, width, height):
+            rawmode, stride, orientation = args
+            rows = np.memmap(filename, dtype=np.uint8, mode="r", offset=offset,
+                             shape=(height, stride))
+            if orientation < 0:
+                ## bitmaps are stored bottom row first
+                rows = rows[::-1]
+            return rows[:, :width]
+    return np.asarray(im.convert("L"))
+
+
+def bmp_to_packet_file(filename, packet_path, x_width, y_height, invert_color = False, band_height = 256):
+    '''
+    Convert an image to a raster pattern file: one little-endian uint16 dwell
+    per pixel of the x_width * y_height frame, in scan order, which is the
+    byte layout sent to the device. The image is centered in the frame, and
+    cropped if it is larger than the frame.
+
+    The image is read and the file is written band_height rows at a time, so
+    neither has to fit in memory.
+    '''
+    rows = bmp_rows(filename)
+    height, width = rows.shape
+
+    ## pad the image to fit the full frame resolution
     #   dimension
     # ───────┬──────┐
     #        │      │
@@ -41,25 +76,109 @@ def bmp_to_bitstream(filename, x_width, y_height, invert_color = False):
     #    └───┬───┘  │
     #        │      │
     #        ▼ btm  │
-    padding_top = round(padding_tb/2) 
-    padding_bottom = padding_tb - padding_top
-    padding_left = round(padding_lr/2)
-    padding_right = padding_lr - padding_left
-    padding = ((padding_top, padding_bottom),(padding_left,padding_right))
+    ## instead of padding the array, work out where the image lands in the
+    ## frame; a negative padding crops the image
+    padding_top = round((y_height - height)/2)
+    padding_left = round((x_width - width)/2)
+    frame_top = max(padding_top, 0)
+    frame_bottom = min(padding_top + height, y_height)
+    frame_left = max(padding_left, 0)
+    frame_right = min(padding_left + width, x_width)
+
+    pattern = np.memmap(packet_path, dtype='<u2', mode="w+", shape=(y_height, x_width))
+    for band_top in range(0, y_height, band_height):
+        band_bottom = min(band_top + band_height, y_height)
+        band = pattern[band_top:band_bottom]
+        band[:] = MIN_DWELL
+        top = max(band_top, frame_top)
+        bottom = min(band_bottom, frame_bottom)
+        if (top >= bottom) | (frame_left >= frame_right):
+            continue
+        pixels = np.asarray(rows[top - padding_top:bottom - padding_top,
+                                 frame_left - padding_left:frame_right - padding_left])
+        if invert_color:
+            pixels = 255 - pixels
+        np.maximum(pixels, MIN_DWELL, out=band[top - band_top:bottom - band_top, frame_left:frame_right])
+    pattern.flush()
+    del pattern
 
-    pattern_array = np.pad(pattern_array,pad_width = padding, constant_values = 2)
-    print(pattern_array)
 
-    pattern_stream = np.ravel(pattern_array)
-    return pattern_loop(x_width*y_height, pattern_stream)
+def pattern_from_packet_file(packet_path, loop = True):
+    '''A PatternStream whose packets are read straight from a memory-mapped pattern file'''
+    return PatternStream(np.memmap(packet_path, dtype='<u2', mode="r"), loop)
+
+
+def bmp_packet_path(filename, x_width, y_height, invert_color = False):
+    '''Where the converted pattern for an image and frame size is kept in the user cache'''
+    stat = os.stat(filename)
+    key = f'{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}:{x_width}:{y_height}:{invert_color}'
+    cache_path = platformdirs.user_cache_path("GlasgowEmbedded", appauthor=False)
+    return cache_path / "scan_gen" / "patterns" / f"bmp-{hashlib.blake2s(key.encode()).hexdigest()[:16]}.u16"
+
+
+def bmp_to_bitstream(filename, x_width, y_height, invert_color = False):
+    packet_path = bmp_packet_path(filename, x_width, y_height, invert_color)
+    if not packet_path.exists():
+        packet_path.parent.mkdir(parents=True, exist_ok=True)
+        ## convert next to the cache file and rename, so a cache file is never partial
+        temp_path = packet_path.with_suffix(f".{os.getpid()}.tmp")
+        bmp_to_packet_file(filename, temp_path, x_width, y_height, invert_color)
+        os.replace(temp_path, packet_path)
+    return pattern_from_packet_file(packet_path)
 
 
 def pattern_loop(dimension, pattern_stream):
-    while 1:
-        for n in range(dimension):
-            yield pattern_stream[n]
-        print("pattern complete")
+    ## one dwell per pixel, repeated frame after frame
+    return PatternStream(pattern_stream[:dimension], loop = True)
 
 
 if __name__ == "__main__":
-    bmp_to_bitstream("Nanographs Pattern Test Logo and Gradients.bmp", 2048, invert_color=False)
\ No newline at end of file
+    import tempfile
+
+    def reference_bitstream(filename, x_width, y_height, invert_color = False):
+        ## the whole-image conversion this module used to do
+        im = Image.open(filename).convert("L")
+        if invert_color:
+            im = ImageChops.invert(im)
+        im = im.point(lambda i: window(i))
+        pattern_array = np.array(im).astype(np.uint8)
+        width, height = im.size
+        padding_top = round((y_height - height)/2)
+        padding_left = round((x_width - width)/2)
+        padding = ((padding_top, y_height - height - padding_top), (padding_left, x_width - width - padding_left))
+        return np.pad(pattern_array, pad_width = padding, constant_values = 2).ravel()
+
+    def test_bmp_to_packet_file(directory):
+        image = (np.arange(37*23).reshape(23, 37)*7 % 256).astype(np.uint8)
+        for mode in ("L", "RGB"):
+            filename = os.path.join(directory, f'test_{mode}.bmp')
+            Image.fromarray(image).convert(mode).save(filename)
+            for invert_color in (False, True):
+                packet_path = os.path.join(directory, "test.u16")
+                ## small bands, so the image starts and ends partway through a band
+                bmp_to_packet_file(filename, packet_path, 64, 50, invert_color, band_height = 8)
+                pattern = pattern_from_packet_file(packet_path, loop = False)
+                assert (np.asarray(pattern) == reference_bitstream(filename, 64, 50, invert_color)).all()
+        ## larger than the frame: cropped around the center
+        bmp_to_packet_file(filename, packet_path, 30, 20, band_height = 8)
+        cropped = np.asarray(pattern_from_packet_file(packet_path)).reshape(20, 30)
+        assert (cropped == np.maximum(image[2:22, 4:34], 2)).all()
+        print("bmp to packet file: OK")
+
+    def bench_bmp_to_packet_file(directory, side = 8192):
+        filename = os.path.join(directory, "bench.bmp")
+        Image.fromarray((np.arange(side*side) % 251).astype(np.uint8).reshape(side, side)).save(filename)
+        packet_path = os.path.join(directory, "bench.u16")
+        start = time.perf_counter()
+        bmp_to_packet_file(filename, packet_path, side, side)
+        converted = time.perf_counter()
+        n_bytes = 0
+        for packet in pattern_from_packet_file(packet_path, loop = False).packets():
+            n_bytes += len(bytes(packet)) ## read every page, as writing it to the device would
+        end = time.perf_counter()
+        print(f'{side}x{side}: converted in {converted - start:.2f} s, '
+              f'{n_bytes/(end - converted)/1e6:.0f} MB/s of packets from the memory map')
+
+    with tempfile.TemporaryDirectory() as directory:
+        test_bmp_to_packet_file(directory)
+        bench_bmp_to_packet_file(directory)
@@ -1,48 +1,118 @@
-from hilbertcurve.hilbertcurve import HilbertCurve
+import os
+import numpy as np
+import platformdirs
 
+if __package__:
+    from .patterngen_utils import PatternStream
+else:
+    from patterngen_utils import PatternStream
 
-def hilbert(dwell_time = 0):
-    N = 2 # number of dimensions
 
-    #text_file = open("hilbert.txt", "w")
-    points = []
+def hilbert_d2xy(order, d):
+    '''
+    Map distances along a Hilbert curve of the given order (a 2**order
+    square) to x, y coordinates, for a whole array of distances at once.
+    Same orientation as hilbertcurve.HilbertCurve.point_from_distance.
+    '''
+    t = np.array(d, dtype=np.int64)
+    x = np.zeros_like(t)
+    y = np.zeros_like(t)
+    s = 1
+    while s < (1 << order):
+        rx = (t >> 1) & 1
+        ry = (t ^ rx) & 1
+        ## rotate the quadrant: flip when rx and not ry, swap when not ry
+        flip = (rx == 1) & (ry == 0)
+        np.subtract(s - 1, x, out=x, where=flip)
+        np.subtract(s - 1, y, out=y, where=flip)
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        x += s*rx
+        y += s*ry
+        t >>= 2
+        s <<= 1
+    return x, y
 
-    pmax = 10
-    side = 2**pmax
-    print(side)
-    min_coord = 0
-    max_coord = side - 1
-    cmin = min_coord - 0.5
-    cmax = max_coord + 0.5
 
+def hilbert_coordinates(order = 10, side = None):
+    '''
+    x and y of every point of a sweep of Hilbert curves, from the given
+    order down to order 1, each scaled to side and offset to sit between
+    the points of the previous one.
+    '''
+    if side is None:
+        side = 2**order
+    xs = []
+    ys = []
     offset = 0
     dx = 0.5
-
-    for p in range(pmax, 0, -1):
-        hc = HilbertCurve(p, N)
+    for p in range(order, 0, -1):
         sidep = 2**p
-
-        npts = 2**(N*p)
-        pts = []
-        for i in range(npts):
-            pt = hc.point_from_distance(i)
-            x = pt[0]*side/sidep + offset
-            y = pt[1]*side/sidep + offset
-            yield int(x)
-            yield int(y)
-            yield dwell_time
-
+        x, y = hilbert_d2xy(p, np.arange(sidep*sidep))
+        xs.append((x*side/sidep + offset).astype(np.uint16))
+        ys.append((y*side/sidep + offset).astype(np.uint16))
         offset += dx
         dx *= 2
+    return np.concatenate(xs), np.concatenate(ys)
+
+
+def hilbert_cache_path(order, side):
+    cache_path = platformdirs.user_cache_path("GlasgowEmbedded", appauthor=False)
+    return cache_path / "scan_gen" / "patterns" / f"hilbert-o{order}-s{side}.npy"
+
 
+def cached_hilbert_coordinates(order = 10, side = None):
+    '''hilbert_coordinates, stored on disk the first time each order and side is used'''
+    if side is None:
+        side = 2**order
+    cache_filename = hilbert_cache_path(order, side)
+    if cache_filename.exists():
+        try:
+            x, y = np.load(cache_filename)
+            return x, y
+        except (OSError, ValueError):
+            pass ## unreadable, generate it again
+    x, y = hilbert_coordinates(order, side)
+    cache_filename.parent.mkdir(parents=True, exist_ok=True)
+    ## write next to the cache file and rename, so a cache file is never partial
+    temp_filename = cache_filename.with_suffix(f".{os.getpid()}.tmp")
+    with temp_filename.open("wb") as cache_file:
+        np.save(cache_file, np.stack((x, y)))
+    os.replace(temp_filename, cache_filename)
+    return x, y
+
+
+def hilbert(dwell_time = 0, order = 10, side = None):
+    x, y = cached_hilbert_coordinates(order, side)
+    return PatternStream.from_points(x, y, dwell_time)
 
-    
 
 if __name__ == "__main__":
+    import time
+    from hilbertcurve.hilbertcurve import HilbertCurve
+
+    def test_hilbert_d2xy():
+        for order in range(1, 7):
+            hc = HilbertCurve(order, 2)
+            expected = np.array(hc.points_from_distances(range(4**order)))
+            x, y = hilbert_d2xy(order, np.arange(4**order))
+            assert (x == expected[:, 0]).all() and (y == expected[:, 1]).all(), f'order {order}'
+        print("hilbert d2xy: OK")
+
+    def bench_hilbert(order = 10):
+        start = time.perf_counter()
+        hilbert_coordinates(order)
+        generated = time.perf_counter()
+        cached_hilbert_coordinates(order) ## written to the cache if it is not there yet
+        start_load = time.perf_counter()
+        cached_hilbert_coordinates(order)
+        end = time.perf_counter()
+        print(f'order {order}: generated in {generated - start:.3f} s, '
+              f'loaded from {hilbert_cache_path(order, 2**order)} in {end - start_load:.3f} s')
+
+    test_hilbert_d2xy()
+    bench_hilbert()
     hil = hilbert()
     for n in range(3):
         print(f'n:{n}')
         print(next(hil))
-        
-        
-    
\ No newline at end of file
@@ -1,4 +1,11 @@
 import struct
+import itertools
+import numpy as np
+
+if __package__:
+    from .vector_commands import encode_points
+else:
+    from vector_commands import encode_points
 
 def in2_out1_byte_stream(in_gen):
     while True:
@@ -8,8 +15,116 @@ def in2_out1_byte_stream(in_gen):
         yield bytes([bval[1]])
 
 
+class PatternStream:
+    '''
+    A pattern built ahead of time as one contiguous array of 16-bit values,
+    in the order and little-endian layout they are sent to the device
+    (x, y, dwell for each vector point, or one dwell per raster pixel).
+
+    Iterating over a PatternStream yields the values one at a time, so it
+    can be used anywhere a pattern generator is expected. packets() hands out
+    the same values as zero-copy memoryviews of whole packets.
+    '''
+    def __init__(self, values, loop = False):
+        self.values = np.ascontiguousarray(values, dtype='<u2').ravel()
+        self.loop = loop
+        self._position = 0
+
+    @classmethod
+    def from_points(cls, x, y, dwell, loop = False):
+        '''Interleave x, y and dwell (arrays, or a scalar dwell) as vector points'''
+        points = np.empty((len(x), 3), dtype='<u2')
+        points[:, 0] = x
+        points[:, 1] = y
+        points[:, 2] = dwell
+        return cls(points, loop)
+
+    def as_commands(self):
+        '''
+        The vector points of this pattern as commands for the device's
+        vector_commands mode, in a new PatternStream that loops if this
+        one does. See vector_commands.encode_points.
+        '''
+        points = self.values.reshape(-1, 3)
+        return PatternStream(encode_points(points[:, 0], points[:, 1], points[:, 2]), self.loop)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __array__(self, dtype = None, copy = None):
+        if dtype is None:
+            return self.values
+        return self.values.astype(dtype)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._position == len(self.values):
+            if not self.loop or len(self.values) == 0:
+                raise StopIteration
+            self._position = 0
+        val = int(self.values[self._position])
+        self._position += 1
+        return val
+
+    def packets(self, packet_size = 16384):
+        '''
+        Yield the rest of the pattern as packet_size-byte memoryviews into
+        the value array. Without loop, the last packet may be short. With
+        loop, the packet that wraps around the end of the pattern is the
+        only one that is copied.
+        '''
+        data = self.values.view(np.uint8).data
+        length = len(data)
+        position = 2*self._position
+        while length:
+            while position + packet_size <= length:
+                yield data[position:position + packet_size]
+                position += packet_size
+                self._position = position//2
+            if not self.loop:
+                if position < length:
+                    self._position = len(self.values)
+                    yield data[position:]
+                return
+            packet = bytearray(data[position:])
+            while len(packet) < packet_size:
+                packet.extend(data[:packet_size - len(packet)])
+            position = (position + packet_size) % length
+            self._position = position//2
+            yield packet
+
 
-def packet_from_generator(gen, two_bytes = True):
+def packet_from_generator(gen, two_bytes = True, vector_commands = False):
+    '''
+    Packets of the pattern gen. With vector_commands, gen is vector points,
+    which are sent as commands.
+    '''
+    if vector_commands:
+        if isinstance(gen, PatternStream):
+            return gen.as_commands().packets()
+        return _command_packets(gen)
+    if isinstance(gen, PatternStream):
+        return gen.packets()
+    return _packet_from_values(gen, two_bytes)
+
+def _command_packets(gen, points = 16384, packet_size = 16384):
+    ## the commands for each few thousand points start from an absolute point,
+    ## so they can be encoded as they come
+    pending = bytearray()
+    while True:
+        values = np.fromiter(itertools.islice(gen, 3*points), dtype=np.int64)
+        values = values[:len(values) - len(values) % 3].reshape(-1, 3)
+        if len(values):
+            pending += encode_points(values[:, 0], values[:, 1], values[:, 2]).tobytes()
+        while len(pending) >= packet_size or (pending and len(values) < points):
+            yield bytes(pending[:packet_size])
+            del pending[:packet_size]
+        if len(values) < points:
+            return
+
+def _packet_from_values(gen, two_bytes = True):
     if two_bytes:
         gen = in2_out1_byte_stream(gen)
     while True:
@@ -18,3 +133,52 @@ def packet_from_generator(gen, two_bytes = True):
             val = next(gen)
             packet.extend(val)
         yield packet
+
+
+if __name__ == "__main__":
+    import time
+
+    def test_pattern_stream():
+        values = np.arange(20000, dtype=np.uint16)
+        ## packets are the on-wire bytes of the values, in order
+        packets = [bytes(p) for p in packet_from_generator(PatternStream(values))]
+        assert [len(p) for p in packets] == [16384, 16384, 7232]
+        assert b"".join(packets) == values.astype('<u2').tobytes()
+        ## iterating yields the same values as a generator would
+        stream = PatternStream(values[:10], loop = True)
+        assert [next(stream) for n in range(15)] == list(range(10)) + list(range(5))
+        ## looping packets continue across the end of the pattern
+        stream = PatternStream(values[:5000], loop = True)
+        packet_loop = stream.packets()
+        looped = b"".join(bytes(next(packet_loop)) for n in range(3))
+        assert looped == np.resize(values[:5000], 3*8192).astype('<u2').tobytes()
+        print("pattern stream: OK")
+
+    def test_command_packets():
+        from vector_commands import decode_commands
+        x, y = np.divmod(np.arange(40000), 300)
+        stream = PatternStream.from_points(x, y, 2)
+        ## the commands for a generator of values are made in pieces
+        for pattern in (stream, iter(stream.values.tolist())):
+            data = b"".join(bytes(p) for p in packet_from_generator(pattern, vector_commands = True))
+            decoded = decode_commands(np.frombuffer(data, dtype='<u2'))
+            assert (np.stack(decoded, axis=1) == stream.values.reshape(-1, 3)).all()
+            assert len(data) < len(stream.values)
+        print("command packets: OK")
+
+    def bench_packets(n_values = 2048*2048):
+        values = np.arange(n_values, dtype=np.uint16)
+        def value_generator():
+            for val in values.tolist():
+                yield val
+        for label, pattern in (("generator", value_generator()), ("PatternStream", PatternStream(values))):
+            packets = packet_from_generator(pattern)
+            start = time.perf_counter()
+            for n in range(32):
+                next(packets)
+            end = time.perf_counter()
+            print(f'{label}: {32*16384/(end-start)/1e6:.1f} MB/s')
+
+    test_pattern_stream()
+    test_command_packets()
+    bench_packets()
@@ -0,0 +1,185 @@
+import numpy as np
+
+
+## The commands VectorCommandDecoder expands into vector points, in 16-bit
+## little-endian words. A header word has the command in its top 3 bits and a
+## count n in the other 13:
+##   POINTS n, then n x (x, y, dwell)
+##   XY n,     then n x (x, y), with the dwell time of the point before
+##   MOVES n,  then n x (dx, dy), signed bytes, each from the point before
+##   LINE n,   then (dx, dy) once, for n points each that step from the one before
+##   DWELL,    then the dwell time for XY, MOVES and LINE
+POINTS = 0
+XY = 1
+MOVES = 2
+LINE = 3
+DWELL = 4
+MAX_COUNT = 0x1FFF
+
+## a run of the same step is a LINE if it is at least this long; shorter
+## ones cost no more as MOVES, and do not split a MOVES in two
+MIN_LINE = 4
+## words after the header, for each point (POINTS, XY, MOVES), or for the command (LINE)
+_OPERAND_WORDS = np.array([3, 2, 1, 1])
+
+
+def _signed_16(values):
+    return ((values + 0x8000) & 0xFFFF) - 0x8000
+
+
+def encode_points(x, y, dwell):
+    '''
+    The commands for a stream of vector points, as an array of 16-bit
+    words: a line or a repeated step for runs of the same small step, a
+    move of under 128 in x and y for the rest of the small steps, and an
+    XY for the rest of the points, all with the dwell time of the point
+    before, unless it changes. A point whose dwell time changes is a
+    POINTS, as every point of the stream would be without commands.
+
+    The first point is always a POINTS, so the commands do not depend on
+    where the beam was: a pattern can loop, and a stream can be encoded
+    in pieces. Found without a loop over the points.
+    '''
+    x = np.asarray(x, dtype=np.int64) & 0xFFFF
+    y = np.asarray(y, dtype=np.int64) & 0xFFFF
+    dwell = np.broadcast_to(np.asarray(dwell, dtype=np.int64) & 0xFFFF, x.shape)
+    count = len(x)
+    if count == 0:
+        return np.zeros(0, dtype='<u2')
+
+    ## what each point is, from the one before
+    step_x = _signed_16(np.diff(x, prepend=x[0]))
+    step_y = _signed_16(np.diff(y, prepend=y[0]))
+    kind = np.full(count, XY)
+    small = (step_x >= -128) & (step_x < 128) & (step_y >= -128) & (step_y < 128)
+    kind[small] = MOVES
+    kind[np.diff(dwell, prepend=-1) != 0] = POINTS
+    step = (step_x & 0xFF) | (step_y & 0xFF) << 8
+
+    ## runs of the same step long enough for a line
+    moves = kind == MOVES
+    starts = np.flatnonzero(moves & ~(np.roll(moves, 1) & (np.roll(step, 1) == step)))
+    ends = np.flatnonzero(moves & ~(np.roll(moves, -1) & (np.roll(step, -1) == step))) + 1
+    lines = ends - starts >= MIN_LINE
+    in_line = np.bincount(starts[lines], minlength=count + 1) - np.bincount(ends[lines], minlength=count + 1)
+    kind[np.cumsum(in_line[:-1]) > 0] = LINE
+
+    ## a command for each run of points of the same kind, starting over
+    ## for each line, and every MAX_COUNT points
+    boundary = np.ones(count, dtype=bool)
+    boundary[1:] = kind[1:] != kind[:-1]
+    boundary[starts[lines]] = True
+    first = np.flatnonzero(boundary)
+    length = np.diff(first, append=count)
+    pieces = -(-length//MAX_COUNT)
+    piece = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    first = np.repeat(first, pieces) + piece*MAX_COUNT
+    length = np.minimum(np.repeat(length, pieces) - piece*MAX_COUNT, MAX_COUNT)
+
+    command = kind[first]
+    size = 1 + np.where(command == LINE, 1, _OPERAND_WORDS[command]*length)
+    offset = np.cumsum(size) - size
+    words = np.empty(size.sum(), dtype='<u2')
+    words[offset] = command << 13 | length
+    line = command == LINE
+    words[offset[line] + 1] = step[first[line]]
+
+    ## then the operands of each point, where its command puts them
+    group = np.repeat(np.arange(len(first)), length)
+    index = np.arange(count) - first[group]
+    for each, values in ((POINTS, (x, y, dwell)), (XY, (x, y)), (MOVES, (step,))):
+        mine = kind == each
+        at = offset[group[mine]] + 1 + len(values)*index[mine]
+        for n, value in enumerate(values):
+            words[at + n] = value[mine]
+    return words
+
+
+def decode_commands(words):
+    '''The x, y and dwell of the points the commands make, to check them by.'''
+    words = np.asarray(words, dtype=np.int64)
+    x = y = dwell = 0
+    points = []
+    position = 0
+    while position < len(words):
+        command, count = words[position] >> 13, words[position] & MAX_COUNT
+        position += 1
+        if command == POINTS:
+            operands = words[position:position + 3*count].reshape(-1, 3)
+            points.append(operands.T)
+            position += 3*count
+        elif command == XY:
+            operands = words[position:position + 2*count].reshape(-1, 2)
+            points.append(np.stack([operands[:, 0], operands[:, 1], np.full(count, dwell)]))
+            position += 2*count
+        elif command in (MOVES, LINE):
+            if command == MOVES:
+                steps = words[position:position + count]
+                position += count
+            else:
+                steps = np.full(count, words[position])
+                position += 1
+            step_x = ((steps & 0xFF) ^ 0x80) - 0x80
+            step_y = ((steps >> 8) ^ 0x80) - 0x80
+            points.append(np.stack([(x + np.cumsum(step_x)) & 0xFFFF, (y + np.cumsum(step_y)) & 0xFFFF,
+                                    np.full(count, dwell)]))
+        elif command == DWELL:
+            dwell = int(words[position])
+            position += 1
+        if command <= LINE and count:
+            x, y, dwell = (int(value) for value in points[-1][:, -1])
+    if not points:
+        return tuple(np.zeros(0, dtype=np.int64) for n in range(3))
+    return tuple(np.concatenate(points, axis=1))
+
+
+if __name__ == "__main__":
+    import time
+    from hilbert import hilbert_d2xy
+    from rectangles import rectangle_coordinates
+
+    def round_trip(x, y, dwell):
+        words = encode_points(x, y, dwell)
+        decoded = decode_commands(words)
+        dwell = np.broadcast_to(dwell, np.shape(x))
+        assert all((np.asarray(a, dtype=np.int64) & 0xFFFF == b).all() for a, b in zip((x, y, dwell), decoded))
+        return words
+
+    def test_vector_commands():
+        ## a filled rectangle: a jump and a line for each row
+        x, y = rectangle_coordinates(1024, 1024, 10, 500, 20, 30)
+        words = round_trip(x, y, 5)
+        assert len(words) == (1 + 3) + 2 + (1 + 2 + 2)*(10 - 1)
+        ## the dwell time of every point different
+        x, y = rectangle_coordinates(64, 64)
+        assert len(round_trip(x, y, x + y)) == 3*64*64 + 1
+        ## a Hilbert curve, of steps of 4 in runs of 1 to 3
+        x, y = hilbert_d2xy(6, np.arange(1 << 12))
+        words = round_trip(x*4, y*4, 2)
+        assert len(words) < 1.2*len(x)
+        ## steps too big to move, wrapping around, repeats, and changing dwell times
+        rng = np.random.default_rng(0)
+        x = np.cumsum(rng.choice([0, 1, -1, 127, -128, 128, 3000], 50000)) & 0xFFFF
+        y = np.cumsum(rng.choice([0, 0, 1, -200, -128], 50000)) & 0xFFFF
+        round_trip(x, y, rng.choice([1, 1, 1, 1, 2], 50000))
+        ## more points than fit in one command
+        round_trip(np.arange(20000), np.zeros(20000), 1)
+        round_trip(np.arange(20000)*7 % 50, np.arange(20000)*300, 1)
+        round_trip([5], [6], 7)
+        assert len(encode_points([], [], 1)) == 0
+        print("vector commands: OK")
+
+    def bench_vector_commands(side = 2048):
+        x, y = rectangle_coordinates(side, side)
+        dwell = np.ones(len(x), dtype=np.int64)
+        hx, hy = hilbert_d2xy(11, np.arange(side*side))
+        for name, points in (("rectangle", (x, y, dwell)), ("hilbert", (hx, hy, dwell)),
+                             ("gradient", (x, y, x + y))):
+            start = time.perf_counter()
+            words = encode_points(*points)
+            elapsed = time.perf_counter() - start
+            print(f'{name}: {side*side/elapsed/1e6:.0f} Mpoint/s, '
+                  f'{2*len(words)/(side*side):.3f} bytes per point (6 as points)')
+
+    test_vector_commands()
+    bench_vector_commands()
@@ -0,0 +1,139 @@
+import logging
+import contextlib
+
+
+__all__ = ["RegisterBank"]
+
+
+class RegisterBank:
+    """
+    Host-side shadow of the applet's registers, for writing them in as few control transfers
+    as possible.
+
+    ``registers`` maps each register name to its ``(address, width)``, with the width in bytes.
+    A multi-byte register is written with a single ``write_register`` call of that width, so a
+    16-bit parameter costs one control transfer rather than one per byte.
+
+    Values are staged with :meth:`set` and written by :meth:`flush`. A register is only written
+    if its staged value differs from the last value written to it, and only the last value
+    staged for a register is written. Inside :meth:`batch`, flushing is deferred until the
+    outermost batch exits.
+
+    Strobes (where every edge matters, like the configuration flag) go through :meth:`write`,
+    which flushes staged values first and then writes unconditionally.
+    """
+    def __init__(self, device, registers, logger=None, level=logging.DEBUG):
+        self._device    = device
+        self._registers = dict(registers)
+        self._logger    = logger or logging.getLogger(__name__)
+        self._level     = level
+        self._shadow    = {}
+        self._staged    = {}
+        self._batch_depth = 0
+        self.transfers  = 0
+
+    def __contains__(self, name):
+        return name in self._registers
+
+    def get(self, name):
+        """Return the last value written to register ``name``, or ``None`` if it was never written."""
+        return self._shadow.get(name)
+
+    def invalidate(self):
+        """Forget the shadow copy, e.g. after the device was reset, so every register is rewritten."""
+        self._shadow.clear()
+
+    def stage(self, name, value):
+        """Stage ``value`` for register ``name`` without writing it."""
+        address, width = self._registers[name]
+        if not 0 <= value < (1 << (8 * width)):
+            raise ValueError(f"value {value} does not fit {width}-byte register {name}")
+        ## keep registers in the order they were first staged in
+        self._staged[name] = value
+
+    async def set(self, name, value):
+        """Stage ``value`` for register ``name``, and flush unless inside :meth:`batch`."""
+        self.stage(name, value)
+        if self._batch_depth == 0:
+            await self.flush()
+
+    async def write(self, name, value):
+        """Flush staged values, then write ``value`` to register ``name`` even if unchanged."""
+        await self.flush()
+        self.stage(name, value)
+        self._shadow.pop(name, None)
+        await self.flush()
+
+    async def flush(self):
+        """Write every staged value that differs from the shadow copy."""
+        staged, self._staged = self._staged, {}
+        for name, value in staged.items():
+            if self._shadow.get(name) == value:
+                continue
+            address, width = self._registers[name]
+            await self._device.write_register(address, value, width=width)
+            self._shadow[name] = value
+            self.transfers += 1
+            self._logger.log(self._level, "REG: %s = %d", name, value)
+
+    @contextlib.asynccontextmanager
+    async def batch(self):
+        """Defer flushing until the outermost batch exits."""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        if self._batch_depth == 0:
+            await self.flush()
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    class RecordingDevice:
+        def __init__(self):
+            self.writes = []
+
+        async def write_register(self, addr, value, width=1):
+            self.writes.append((addr, value.to_bytes(width, byteorder="big")))
+
+    def test_register_bank():
+        device = RecordingDevice()
+        bank = RegisterBank(device, {
+            "x_full_resolution": (1, 2), "x_lower_limit": (2, 2), "step_size": (3, 1),
+            "configuration": (4, 1),
+        })
+
+        async def run():
+            async with bank.batch():
+                await bank.set("x_full_resolution", 2047)
+                await bank.set("x_lower_limit", 5)
+                await bank.set("x_lower_limit", 6)
+                await bank.set("step_size", 8)
+                assert device.writes == []
+            ## one transfer per changed register, 16-bit values in one go
+            assert device.writes == [(1, b"\x07\xff"), (2, b"\x00\x06"), (3, b"\x08")]
+            ## unchanged registers are not rewritten
+            await bank.set("x_full_resolution", 2047)
+            await bank.set("step_size", 8)
+            assert len(device.writes) == 3
+            ## a strobe writes both edges, after anything staged before it
+            async with bank.batch():
+                await bank.set("x_lower_limit", 0)
+                await bank.write("configuration", 1)
+                await bank.write("configuration", 0)
+            assert device.writes[3:] == [(2, b"\x00\x00"), (4, b"\x01"), (4, b"\x00")]
+            bank.invalidate()
+            await bank.set("step_size", 8)
+            assert device.writes[-1] == (3, b"\x08")
+            try:
+                bank.stage("step_size", 256)
+                assert False, "overflow not detected"
+            except ValueError:
+                pass
+
+        asyncio.run(run())
+        print("register bank: OK")
+
+    test_register_bank()
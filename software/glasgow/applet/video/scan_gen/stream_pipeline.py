@@ -0,0 +1,210 @@
+import time
+import asyncio
+import logging
+
+if __package__:
+    from .interface.raw_capture import CaptureWriter
+else:
+    from interface.raw_capture import CaptureWriter
+
+
+__all__ = ["StreamPipeline", "SinkStats", "RawCapture"]
+
+
+class SinkStats:
+    """
+    Backpressure counters for one sink of a :class:`StreamPipeline`.
+
+    :attr packets:
+        Packets handed to the sink.
+    :attr max_depth:
+        Most packets ever waiting in the sink's queue.
+    :attr stalls:
+        Times the reader found the queue full and had to wait for room.
+    :attr stall_time:
+        Seconds the reader spent waiting for room, i.e. not reading.
+    :attr dropped:
+        Packets dropped from a full queue of a sink that is not lossless, oldest first.
+    """
+    def __init__(self, name):
+        self.name       = name
+        self.packets    = 0
+        self.bytes      = 0
+        self.max_depth  = 0
+        self.stalls     = 0
+        self.stall_time = 0.0
+        self.dropped    = 0
+
+    def __str__(self):
+        return (f"{self.name}: {self.packets} packets, {self.bytes} bytes, "
+                f"max depth {self.max_depth}, {self.stalls} stalls ({self.stall_time:.3f} s), "
+                f"{self.dropped} dropped")
+
+
+class StreamPipeline:
+    """
+    Read packets in one task and hand each of them to several sinks, each served by its own
+    task through its own bounded queue.
+
+    A slow sink (e.g. a socket whose client is busy) is absorbed by its queue instead of holding
+    up the next read. When the queue of a lossless sink (e.g. a capture) fills up, the reader
+    waits for room rather than dropping data, and the time spent waiting is recorded in that
+    sink's :class:`SinkStats`. Any other sink never holds up the reader: its oldest packet is
+    dropped to make room, and counted.
+    """
+    def __init__(self, read_packet, depth=64, logger=None, report_every=1024):
+        self._read_packet  = read_packet
+        self._depth        = depth
+        self._logger       = logger or logging.getLogger(__name__)
+        self._report_every = report_every
+        self._sinks        = []
+        self.packets       = 0
+
+    def add_sink(self, name, consume, lossless=True):
+        """
+        Add a sink; ``consume`` is a coroutine function called with each packet, in order. If
+        ``lossless`` is false, the sink loses its oldest packets rather than hold up the reader.
+        """
+        self._sinks.append((asyncio.Queue(self._depth), consume, SinkStats(name), lossless))
+
+    @property
+    def stats(self):
+        return [stats for queue, consume, stats, lossless in self._sinks]
+
+    def log_stats(self, level=logging.DEBUG):
+        for stats in self.stats:
+            self._logger.log(level, "pipeline %s", stats)
+
+    async def _serve(self, queue, consume):
+        while True:
+            packet = await queue.get()
+            await consume(packet)
+            queue.task_done()
+
+    async def _put(self, queue, stats, lossless, packet):
+        if queue.full() and not lossless:
+            queue.get_nowait()
+            queue.task_done()
+            stats.dropped += 1
+            queue.put_nowait(packet)
+        elif queue.full():
+            stats.stalls += 1
+            started_at = time.perf_counter()
+            await queue.put(packet)
+            stats.stall_time += time.perf_counter() - started_at
+        else:
+            queue.put_nowait(packet)
+        stats.packets += 1
+        stats.bytes += len(packet)
+        stats.max_depth = max(stats.max_depth, queue.qsize())
+
+    async def run(self):
+        """
+        Read and distribute packets until reading or a sink fails, and re-raise the error. If
+        reading fails, the packets already queued are delivered first.
+        """
+        consumers = [asyncio.ensure_future(self._serve(queue, consume))
+                     for queue, consume, stats, lossless in self._sinks]
+        reader = asyncio.ensure_future(self._produce())
+        try:
+            ## whichever stops first (they only stop on error) stops the rest
+            done, pending = await asyncio.wait([reader, *consumers],
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if reader in done:
+                ## deliver what was already read, unless a sink fails meanwhile
+                drained = asyncio.ensure_future(
+                    asyncio.gather(*(queue.join() for queue, consume, stats, lossless in self._sinks)))
+                await asyncio.wait([drained, *consumers], return_when=asyncio.FIRST_COMPLETED)
+                drained.cancel()
+            for task in done:
+                task.result()
+        finally:
+            for task in [reader, *consumers]:
+                task.cancel()
+            await asyncio.gather(reader, *consumers, return_exceptions=True)
+            self.log_stats(logging.INFO)
+
+    async def _produce(self):
+        while True:
+            packet = await self._read_packet()
+            self.packets += 1
+            for queue, consume, stats, lossless in self._sinks:
+                await self._put(queue, stats, lossless, packet)
+            if self.packets % self._report_every == 0:
+                self.log_stats()
+
+
+class RawCapture:
+    """
+    Append packets to a raw capture (see :class:`CaptureWriter`): the packets as read, and an
+    index of when each was read and the scan parameters in effect. Writes run in the default
+    executor so that a slow disk holds up only the capture sink, not the event loop.
+    """
+    def __init__(self, path):
+        self._writer = CaptureWriter(path)
+
+    async def write(self, packet):
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.write, packet)
+
+    def close(self):
+        self._writer.close()
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    if __package__:
+        from .interface.raw_capture import CaptureReader
+    else:
+        from interface.raw_capture import CaptureReader
+
+    def test_stream_pipeline():
+        packets = [bytes([n]) * 16384 for n in range(200)]
+        received = []
+
+        async def run(capture_path):
+            source = iter(packets)
+            async def read_packet():
+                try:
+                    return next(source)
+                except StopIteration:
+                    raise EOFError
+            async def slow_socket(packet):
+                ## a sink slower than the reader fills its queue
+                await asyncio.sleep(0.0005)
+                received.append(packet)
+            async def slow_capture(packet):
+                await asyncio.sleep(0.0005)
+                await capture.write(packet)
+
+            capture = RawCapture(capture_path)
+            pipeline = StreamPipeline(read_packet, depth=8)
+            pipeline.add_sink("socket", slow_socket, lossless=False)
+            pipeline.add_sink("capture", slow_capture)
+            try:
+                await pipeline.run()
+            except EOFError:
+                pass
+            capture.close()
+            return pipeline
+
+        with tempfile.TemporaryDirectory() as directory:
+            capture_path = os.path.join(directory, "capture.bin")
+            pipeline = asyncio.run(run(capture_path))
+            with open(capture_path, "rb") as f:
+                captured = f.read()
+            with CaptureReader(capture_path) as reader:
+                indexed = len(reader)
+        socket_stats, capture_stats = pipeline.stats
+        ## the socket never holds up the reader, and loses its oldest packets instead;
+        ## the capture holds it up, and loses nothing
+        assert socket_stats.stalls == 0 and socket_stats.dropped > 0
+        assert len(received) == len(packets) - socket_stats.dropped and received[-1] == packets[-1]
+        assert all(a[0] < b[0] for a, b in zip(received, received[1:]))
+        assert socket_stats.packets == len(packets) and socket_stats.max_depth == 8
+        assert captured == b"".join(packets) and indexed == len(packets)
+        assert capture_stats.stalls > 0 and capture_stats.dropped == 0
+        print(f"stream pipeline: OK\n  {socket_stats}\n  {capture_stats}")
+
+    test_stream_pipeline()